@@ -0,0 +1,272 @@
+""" Replay-speed benchmark of the odometry pipeline (no plotting): dataset
+    load, merge/iteration, measurements, prediction, correction, full
+    filter run and error computation on experiment3 and on synthetic
+    missions made of experiment3 repeated.
+"""
+import sys
+import json
+import resource
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from timeit import default_timer as timer
+from util import o2ca2_dataset as dataset
+from util import measurement_8state as meas
+from util import mapping_ops_3dof as mops3dof
+from util import scan_matching
+from ekf.ekf import EKF8State
+import odometry
+
+PERCENTILES = (50, 90, 99)
+# absolute differences below these are noise, whatever the tolerance
+SLACK = {"_s": 0.01, "_ms": 1.0, "_us": 10.0, "_mb": 5.0}
+
+
+def latency(f, args, repeat=5):
+    """Per-call latency percentiles (us) of f over a list of arguments"""
+    samples = np.empty(len(args))
+    for i, a in enumerate(args):
+        start = timer()
+        for r in range(repeat):
+            f(*a)
+        samples[i] = (timer() - start) / repeat
+    return dict(("p%d_us" % p, v * 1e6) for p, v in zip(PERCENTILES, np.percentile(samples, PERCENTILES)))
+
+
+def logs(D):
+    """Log data of each sensor of an in-memory dataset"""
+    return dict(zip(D.keys, next(D.iter_blocks())[0]))
+
+
+def stage_load():
+    """Parsing the text logs and reading the binary cache"""
+    result = {}
+    start = timer()
+    D = dataset.O2CA2Dataset(odometry.filenames)
+    result["load_text_s"] = timer() - start
+    dataset.O2CA2Dataset(odometry.filenames, cache=True)
+    start = timer()
+    dataset.O2CA2Dataset(odometry.filenames, cache=True)
+    result["load_cached_s"] = timer() - start
+    result["msgs"] = len(D)
+    return result
+
+
+def stage_calls(D, samples=2000):
+    """Per-call latency of the measurements, prediction and correction"""
+    data = logs(D)
+    config = odometry.dvl_config
+    stdev_dvl = {
+        "bottom": np.append(config["stdev_bottom"], config["stdev_depth"]),
+        "water": np.append(config["stdev_water"], config["stdev_depth"])
+        }
+    imu_config = odometry.imu_config
+    stdev_imu = np.array([imu_config["stdev_orientation"][2], imu_config["stdev_angular_velocity"][2]])
+    rng = np.random.RandomState(0)
+
+    def rows(k):
+        return [data[k][i] for i in rng.randint(0, len(data[k]), min(samples, len(data[k])))]
+
+    result = {}
+    result["dvl"] = latency(meas.dvl, [(r, config["pose"], stdev_dvl) for r in rows("dvl")])
+    result["imu"] = latency(meas.imu, [(r, imu_config["pose"], stdev_imu) for r in rows("imu")])
+    result["gps"] = latency(meas.gps, [(r,) for r in rows("gps")])
+
+    start = timer()
+    meas.dvl_batch(data["dvl"], config["pose"], stdev_dvl)
+    meas.imu_batch(data["imu"], imu_config["pose"], stdev_imu)
+    meas.gps_batch(data["gps"])
+    result["batch_measurements_s"] = timer() - start
+
+    Q = np.diag(odometry.ekf_config["stdev_velocity_model"][[0, 1, 2, 5], ]**2)
+    ekf = EKF8State(Q)
+    x = np.array([1., 2., 3., 0.7, 0.5, -0.2, 0.1, 0.05])
+    P = np.eye(8)
+    dts = np.diff(data["imu"][:samples + 1, 0])
+    result["predict"] = latency(ekf.prediction, [(x, P, dt) for dt in dts])
+
+    z_dvl, R_dvl, _ = meas.dvl_batch(data["dvl"][:samples], config["pose"], stdev_dvl)
+    z_imu, R_imu = meas.imu_batch(data["imu"][:samples], imu_config["pose"], stdev_imu)
+
+    def correct(z, index, R):
+        ekf.prediction(x, P, 0.1)
+        ekf.selection_correction(z, index, R)
+
+    predict = result["predict"]["p50_us"]
+    for name, args in [("correct_dvl", [(z, meas.DVL_INDEX, R) for z, R in zip(z_dvl, R_dvl)]),
+                       ("correct_imu", [(z, meas.IMU_INDEX, R) for z, R in zip(z_imu, R_imu)])]:
+        # minus the median prediction that sets up each correction
+        result[name] = dict((k, v - predict) for k, v in latency(correct, args).items())
+    return result
+
+
+def stage_mission(scale):
+    """Iteration, filter run and errors of a mission repeated scale
+    times, with the peak memory of the process"""
+    D = dataset.O2CA2Dataset(odometry.filenames, cache=True)
+    if scale > 1:
+        D = dataset.O2CA2Dataset.from_arrays(dataset.tile(logs(D), scale))
+    msgs = len(D)
+    result = {"scale": scale, "msgs": msgs}
+
+    start = timer()
+    for _type, data in D:
+        pass
+    elapsed = timer() - start
+    result["iterate_s"] = elapsed
+    result["iterate_msgs_per_s"] = msgs / elapsed
+
+    start = timer()
+    r = odometry.run(D)
+    elapsed = timer() - start
+    result["run_s"] = elapsed
+    result["run_msgs_per_s"] = msgs / elapsed
+
+    start = timer()
+    odometry.run(D, lazy=True)
+    elapsed = timer() - start
+    result["run_lazy_s"] = elapsed
+    result["run_lazy_msgs_per_s"] = msgs / elapsed
+
+    start = timer()
+    odometry.errors(r)
+    result["errors_s"] = timer() - start
+    result["peak_memory_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return result
+
+
+def stage_matching(sizes=(100, 1000, 10000)):
+    """Iteration time of the scan matchers against the scan size, on
+    synthetic scans of the walls of a 50x20m tank"""
+    rng = np.random.RandomState(0)
+    x = np.array([0.4, -0.3, 0.05])
+    P0 = np.diag([0.5, 0.5, 0.1])**2
+    result = {}
+    for size in sizes:
+        k = size // 4
+        u = rng.uniform(0, 1, (4, k))
+        ref = np.r_[np.c_[50*u[0], np.zeros(k)], np.c_[50*u[1], np.full(k, 20.)],
+                    np.c_[np.zeros(k), 20*u[2]], np.c_[np.full(k, 50.), 20*u[3]]]
+        new = mops3dof.compose_batch(mops3dof.inv_batch(x)[0], ref)[0] + rng.normal(0, 0.05, ref.shape)
+        cov = np.tile(np.eye(2) * 0.05**2, (len(ref), 1, 1))
+
+        start = timer()
+        tree = scan_matching.cKDTree(ref)
+        result["tree_%d_ms" % size] = (timer() - start) * 1e3
+        for name, match in [
+                ("icp", lambda: scan_matching.icp(ref, new, tree=tree)),
+                ("pic", lambda: scan_matching.pic(ref, cov, new, cov, np.zeros(3), P0, tree=tree))]:
+            start = timer()
+            info = match()[2]
+            elapsed = timer() - start
+            result["%s_%d" % (name, size)] = {
+                "iterations": info["iterations"],
+                "iteration_ms": elapsed / info["iterations"] * 1e3}
+    return result
+
+
+def _isolated(args):
+    """Pool worker: runs a stage in its own process"""
+    name, arg = args
+    if name == "load":
+        return stage_load()
+    if name == "calls":
+        return stage_calls(dataset.O2CA2Dataset(odometry.filenames, cache=True))
+    if name == "matching":
+        return stage_matching(arg)
+    return stage_mission(arg)
+
+
+def run(scales=(1, 10), matching_sizes=(100, 1000, 10000)):
+    """ Runs every stage, each one in a new process so peak memory is
+    not shared between them.
+
+    :param scales: mission lengths, in times experiment3
+    :param matching_sizes: points per scan of the scan matching stage
+    :type scales: list of integers
+    :type matching_sizes: list of integers
+    :return: results of each stage
+    :rtype: dictionary
+    """
+    jobs = [("load", None), ("calls", None), ("matching", matching_sizes)] + \
+        [("mission", s) for s in scales]
+    pool = Pool(1, maxtasksperchild=1)
+    try:
+        results = pool.map(_isolated, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    report = {"load": results[0], "calls": results[1], "matching": results[2]}
+    for s, r in zip(scales, results[3:]):
+        report["mission_x%d" % s] = r
+    return report
+
+
+def flatten(report, prefix=""):
+    """Flat {'stage.metric': value} view of a report"""
+    flat = {}
+    for k, v in report.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, prefix + k + "."))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+def regressions(report, baseline, tolerance=0.25):
+    """ Metrics worse than the baseline by more than tolerance: rates
+    (*_per_s) lower, times (*_s, *_us) and memory (*_mb) higher by
+    more than tolerance and SLACK.
+
+    :return: (metric, baseline, value) of each regression
+    :rtype: list of 3-element tuples
+    """
+    current = flatten(report)
+    failed = []
+    for k, ref in sorted(flatten(baseline).items()):
+        if k not in current or not ref:
+            continue
+        value = current[k]
+        if k.endswith("_per_s"):
+            worse = value < ref * (1 - tolerance)
+        else:
+            slack = [v for unit, v in SLACK.items() if k.endswith(unit)]
+            if not slack:
+                continue
+            worse = value > ref * (1 + tolerance) and value - ref > slack[0]
+        if worse:
+            failed.append((k, ref, value))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10],
+                        help="mission lengths in times experiment3 (e.g. 1 10 100)")
+    parser.add_argument("--matching-sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="points per scan of the scan matching benchmark")
+    parser.add_argument("--save", help="store the results as baseline json")
+    parser.add_argument("--check", help="fail if worse than this baseline json")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative regression (default 0.25)")
+    args = parser.parse_args()
+
+    report = run(args.scales, args.matching_sizes)
+    for k, v in sorted(flatten(report).items()):
+        print("%-40s %12.3f" % (k, v))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.check:
+        with open(args.check) as f:
+            failed = regressions(report, json.load(f), args.tolerance)
+        for k, ref, value in failed:
+            print("REGRESSION %s: %.3f (baseline %.3f)" % (k, value, ref))
+        if failed:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
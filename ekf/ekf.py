@@ -1,4 +1,6 @@
+import math
 import numpy as np
+from scipy.linalg.lapack import dpotrf, dpotrs, dtrtrs
 
 
 class EKFBase(object):
@@ -11,32 +13,176 @@ class EKFBase(object):
         self._P = []
         self._I = np.eye(state_size)
         self._initialized = False
+        self._y = None  # last innovation
+        self._S = None  # last innovation covariance
+        self._accepted = None  # last measurement elements used
+        self._buffers = {}
 
-    def correction(self, z, H, R):
+    def _get_buffers(self, size):
+        """Preallocated work arrays for measurements of a given size"""
+        try:
+            return self._buffers[size]
+        except KeyError:
+            n = len(self._I)
+            b = (np.empty((n, size)), np.empty((size, size)),
+                 np.empty((n, n)), np.empty((n, n)), np.empty((n, n)))
+            self._buffers[size] = b
+            return b
+
+    def correction(self, z, H, R, joseph=True):
         """ EKF correction/update with a measurement z,
-        observation model H, observation noise R
+        observation model H, observation noise R.
+        The innovation covariance is solved with a Cholesky factorization
+        and the covariance is updated in Joseph form and symmetrized,
+        so it stays symmetric and positive definite over long runs.
 
         :param z: measurement
         :param H: observation model
         :param R: observation noise
+        :param joseph: Joseph form update, otherwise (I-KH)P
         :type z: 1d array
         :type H: 2d array
         :type R: 2d array
+        :type joseph: bool
+        :return: updated state x and covariance P
+        :rtype: 2-emement tuple (x, P)
+        """
+        x = np.ravel(self._x)
+        PHt, S, IKH, T, U = self._get_buffers(len(R))
+
+        np.dot(self._P, H.T, out=PHt)
+        np.dot(H, PHt, out=S)
+        S += R
+        self._y = np.ravel(z) - np.dot(H, x)
+        self._S = S.copy()
+
+        # K = PH'S^-1 -> K' = S^-1 HP with the Cholesky factor of S.
+        # LAPACK is called directly, cho_factor/cho_solve overhead is
+        # larger than the update itself for such small matrices
+        c, info = dpotrf(S.T, lower=0, clean=0, overwrite_a=1)
+        if info != 0:
+            raise np.linalg.LinAlgError("Innovation covariance is not positive definite")
+        K = dpotrs(c, PHt.T, lower=0)[0].T
+
+        self._x = x + np.dot(K, self._y)
+        self._accepted = np.ones(len(self._y), dtype=bool)
+
+        np.dot(K, H, out=IKH)
+        np.subtract(self._I, IKH, out=IKH)
+        np.dot(IKH, self._P, out=T)
+        if joseph:
+            np.dot(T, IKH.T, out=U)
+            U += np.dot(np.dot(K, R), K.T)
+            T = U
+        P = T + T.T
+        P *= 0.5
+        self._P = P
+        return (self._x, self._P)
+
+    def selection_correction(self, z, index, R, gate=None):
+        """ EKF correction/update with a measurement z of the state
+        elements in index (an observation model H that is a 0/1 row
+        selector), observation noise R. HPH' and PH' are taken from P
+        instead of computing the dense products with H.
+        With S = U'U and W = U^-T HP the update is P - W'W, which is the
+        Joseph form for the optimal gain and symmetric by construction.
+        Scalar measurements and gated measurements with a diagonal R are
+        processed with sequential_correction.
+
+        :param z: measurement
+        :param index: state index of each measurement element
+        :param R: observation noise
+        :param gate: per-element outlier threshold (see sequential_correction)
+        :type z: 1d array
+        :type index: 1d int array
+        :type R: 2d array
+        :type gate: float
+        :return: updated state x and covariance P
+        :rtype: 2-emement tuple (x, P)
+        """
+        if len(R) == 1 or gate is not None:
+            if len(R) > 1 and np.count_nonzero(R - np.diag(R.diagonal())):
+                raise ValueError("Per-element gating requires a diagonal R")
+            return self.sequential_correction(z, index, R.diagonal(), gate)
+
+        PHt, S = self._get_buffers(len(R))[0:2]
+
+        np.take(self._P, index, axis=1, out=PHt)
+        np.take(PHt, index, axis=0, out=S)
+        S += R
+        self._y = z - self._x[index]
+        self._S = S.copy()
+        self._accepted = np.ones(len(z), dtype=bool)
+
+        U, info = dpotrf(S.T, lower=0, clean=0, overwrite_a=1)
+        if info != 0:
+            raise np.linalg.LinAlgError("Innovation covariance is not positive definite")
+        W = dtrtrs(U, PHt.T, lower=0, trans=1)[0]
+        v = dtrtrs(U, self._y, lower=0, trans=1)[0]
+
+        self._x = self._x + np.dot(v, W)
+        self._P = self._P - np.dot(W.T, W)
+        return (self._x, self._P)
+
+    def sequential_correction(self, z, index, r, gate=None):
+        """ EKF correction/update with a measurement z of the state
+        elements in index with independent noise (diagonal R) applied as
+        one scalar update per element, so no matrix is factorized and
+        each element can be rejected on its own.
+
+        :param z: measurement
+        :param index: state index of each measurement element
+        :param r: observation noise variances (diagonal of R)
+        :param gate: an element is rejected when its squared normalized
+            innovation y^2/s exceeds gate (e.g. 9 for 3 sigma)
+        :type z: 1d array
+        :type index: 1d int array
+        :type r: 1d array
+        :type gate: float
         :return: updated state x and covariance P
         :rtype: 2-emement tuple (x, P)
         """
-        x = np.c_[self._x]
-        z = np.c_[z]
+        x = self._x.copy()
+        P = self._P.copy()
+        y = np.empty(len(z))
+        s = np.empty(len(z))
+        self._accepted = np.ones(len(z), dtype=bool)
 
-        h = np.dot(H, x)
-        y = z - h
-        S = np.dot(np.dot(H, self._P), H.T) + R
-        K = np.dot(np.dot(self._P, H.T), np.linalg.inv(S))
+        for i, (j, zi, ri) in enumerate(zip(np.ravel(index).tolist(), z.tolist(), r.tolist())):
+            p = P[j]  # row j = column j, P is symmetric
+            s[i] = si = float(p[j]) + ri
+            y[i] = yi = zi - float(x[j])
+            if gate is not None and yi * yi > gate * si:
+                self._accepted[i] = False
+                continue
+            k = p / si
+            x += yi * k
+            P -= (k[:, None] * k) * si  # kk' is exactly symmetric, kp' is not
 
-        self._x = (x + np.dot(K, y)).T[0]  # 1d array
-        self._P = np.dot((self._I - np.dot(K, H)), self._P)
+        self._y = y
+        self._S = np.diag(s)
+        self._x = x
+        self._P = P
         return (self._x, self._P)
 
+    def innovation(self):
+        """ Innovation and its covariance of the last correction,
+        e.g. for gating with the Mahalanobis distance y'S^-1y.
+
+        :return: innovation y and covariance S
+        :rtype: 2-element tuple (y, S)
+        """
+        return (self._y, self._S)
+
+    def accepted(self):
+        """ Measurement elements used by the last correction (all of
+        them unless rejected by a gate).
+
+        :return: mask of accepted elements
+        :rtype: 1d bool array
+        """
+        return self._accepted
+
     def set_initialized(self, value):
         self._initialized = value
 
@@ -48,51 +194,95 @@ class EKF8State(EKFBase):
     """
     def __init__(self, Q):
         super(EKF8State, self).__init__(Q, 8)
+        self._deferred = 0.0  # elapsed time not propagated yet
+        # J = [Jx Jq] and M = diag(P, Q), so that JMJ' = JxPJx' + JqQJq'.
+        # Only the non-constant elements are updated on each prediction
+        self._J = np.zeros((8, 12))
+        self._J[:, 0:8] = np.eye(8)
+        self._J[4:8, 8:12] = np.eye(4)
+        self._M = np.zeros((12, 12))
+        self._M[8:12, 8:12] = Q
 
-    def __constant_velocity_model(self, x_prev, dt):
-        cy = np.cos(x_prev[3])
-        sy = np.sin(x_prev[3])
+    def __constant_velocity_model(self, x_prev, dt, cy, sy):
+        x0, x1, x2, x3, x4, x5, x6, x7 = x_prev
 
         x = np.array([
-            x_prev[0] + x_prev[4]*dt*cy - x_prev[5]*dt*sy,
-            x_prev[1] + x_prev[4]*dt*sy + x_prev[5]*dt*cy,
-            x_prev[2] + x_prev[6]*dt,
-            x_prev[3] + x_prev[7]*dt,
-            x_prev[4],
-            x_prev[5],
-            x_prev[6],
-            x_prev[7]])
-
-        # Jacobian respect to vector x
-        Jx = np.array([
-            [1, 0, 0, -(x_prev[4]*dt)*sy-(x_prev[5]*dt)*cy, dt*cy, -dt*sy, 0, 0],
-            [0, 1, 0,  (x_prev[4]*dt)*cy-(x_prev[5]*dt)*sy, dt*sy,  dt*cy, 0, 0],
-            [0, 0, 1, 0, 0, 0, dt, 0],
-            [0, 0, 0, 1, 0, 0, 0, dt],
-            [0, 0, 0, 0, 1, 0, 0, 0],
-            [0, 0, 0, 0, 0, 1, 0, 0],
-            [0, 0, 0, 0, 0, 0, 1, 0],
-            [0, 0, 0, 0, 0, 0, 0, 1]])
-        return (x, Jx)
-
-    def __acceleration_noise_jacobian(self, x_prev, dt):
-        cy = np.cos(x_prev[3])
-        sy = np.sin(x_prev[3])
+            x0 + x4*dt*cy - x5*dt*sy,
+            x1 + x4*dt*sy + x5*dt*cy,
+            x2 + x6*dt,
+            x3 + x7*dt,
+            x4,
+            x5,
+            x6,
+            x7])
+
+        # Jacobian respect to vector x (J[:, 0:8]), the rest is identity
+        J = self._J
+        J[0, 3] = -(x4*dt)*sy-(x5*dt)*cy
+        J[0, 4] = dt*cy
+        J[0, 5] = -dt*sy
+        J[1, 3] = (x4*dt)*cy-(x5*dt)*sy
+        J[1, 4] = dt*sy
+        J[1, 5] = dt*cy
+        J[2, 6] = dt
+        J[3, 7] = dt
+        return x
+
+    def __acceleration_noise_jacobian(self, x_prev, dt, cy, sy):
+        x4 = x_prev[4]
+        x5 = x_prev[5]
         dt2 = dt**2
 
-        return np.array([
-            [0.5*dt2*cy, -0.5*dt2*sy, 0, -0.5*(x_prev[4]*dt)*dt2*sy-0.5*(x_prev[5]*dt)*dt2*cy],
-            [0.5*dt2*sy,  0.5*dt2*cy, 0,  0.5*(x_prev[4]*dt)*dt2*cy-0.5*(x_prev[5]*dt)*dt2*sy],
-            [0, 0, 0.5*dt2, 0],
-            [0, 0, 0, 0.5*dt2],
-            [dt, 0, 0, 0],
-            [0, dt, 0, 0],
-            [0, 0, dt, 0],
-            [0, 0, 0, dt]])
+        # Jacobian respect to the noise (J[:, 8:12])
+        J = self._J
+        J[0, 8] = 0.5*dt2*cy
+        J[0, 9] = -0.5*dt2*sy
+        J[0, 11] = -0.5*(x4*dt)*dt2*sy-0.5*(x5*dt)*dt2*cy
+        J[1, 8] = 0.5*dt2*sy
+        J[1, 9] = 0.5*dt2*cy
+        J[1, 11] = 0.5*(x4*dt)*dt2*cy-0.5*(x5*dt)*dt2*sy
+        J[2, 10] = 0.5*dt2
+        J[3, 11] = 0.5*dt2
+        J[4, 8] = J[5, 9] = J[6, 10] = J[7, 11] = dt
+
+    def jacobians(self):
+        """ Jacobians of the last prediction respect to the state and
+        the acceleration noise.
+
+        :return: Jx and Jq
+        :rtype: 2-element tuple (8x8 array, 8x4 array)
+        """
+        return (self._J[:, 0:8].copy(), self._J[:, 8:12].copy())
+
+    def set_initialized(self, value):
+        super(EKF8State, self).set_initialized(value)
+        self._deferred = 0.0
+
+    def defer(self, dt):
+        """ Lazy prediction: accumulates dt without propagating the
+        state, the next prediction (or flush) covers the elapsed time.
+
+        :param dt: delta time
+        :type dt: float
+        :return: time elapsed since the last propagation
+        :rtype: float
+        """
+        self._deferred += float(dt)
+        return self._deferred
+
+    def flush(self, x_prev, P_prev):
+        """ Propagates x_prev and P_prev over the deferred time, e.g.
+        when the current state is needed.
+
+        :return: predition x and covariance P
+        :rtype: 2-emement tuple (x, P)
+        """
+        return self.prediction(x_prev, P_prev, 0.0)
 
     def prediction(self, x_prev, P_prev, dt):
     	""" EKF prediction based on the previous state x_prev and
-        covariance P_prev using a constant velocity model.
+        covariance P_prev using a constant velocity model. Deferred time
+        (see defer) is added to dt.
 
         :param x_prev: vector state at t-1 [x, y, z, yaw, u, v, w, r]
         :param P_prev: covariance at t-1
@@ -103,15 +293,261 @@ class EKF8State(EKFBase):
         :return: predition x and covariance P
         :rtype: 2-emement tuple (x, P)
         """
-        if len(x_prev.shape) is 2:
-            x_prev = x_prev.T[0]
+        x_prev = np.ravel(x_prev).tolist()
+        dt = float(dt) + self._deferred
+        self._deferred = 0.0
+        cy = math.cos(x_prev[3])
+        sy = math.sin(x_prev[3])
 
-        self._x, Jx = self.__constant_velocity_model(x_prev, dt)
-        Jq = self.__acceleration_noise_jacobian(x_prev, dt)
+        self._x = self.__constant_velocity_model(x_prev, dt, cy, sy)
+        self.__acceleration_noise_jacobian(x_prev, dt, cy, sy)
 
-        self._P = np.dot(np.dot(Jx, P_prev), Jx.T) + np.dot(np.dot(Jq, self._Q), Jq.T)
+        self._M[0:8, 0:8] = P_prev
+        self._P = np.dot(np.dot(self._J, self._M), self._J.T)
         return (self._x, self._P)
 
+    def predict_many(self, x_prev, P_prev, dt):
+        """ Predictions at many times in one vectorized call, each one
+        a single step of dt from x_prev and P_prev (e.g. the posterior of
+        the last correction). The filter state is not modified.
+
+        :param x_prev: vector state, shared or one per prediction
+        :param P_prev: covariance, shared or one per prediction
+        :param dt: delta time of each prediction
+        :type x_prev: 1d array (8) or 2d array (Nx8)
+        :type P_prev: 2d array (8x8) or 3d array (Nx8x8)
+        :type dt: 1d array (N)
+        :return: predition x and covariance P
+        :rtype: 2-emement tuple (Nx8 array, Nx8x8 array)
+        """
+        dt = np.ravel(dt).astype(float)
+        n = len(dt)
+        batch = EKF8StateBatch(np.broadcast_to(self._Q, (n, 4, 4)))
+        return batch.prediction(
+            np.broadcast_to(x_prev, (n, 8)), np.broadcast_to(P_prev, (n, 8, 8)), dt)
+
+
+# elements of the EKF8State Jacobians that depend on the state and dt
+_J_ROWS = np.array([0, 0, 0, 1, 1, 1, 2, 3, 0, 0, 0, 1, 1, 1, 2, 3, 4, 5, 6, 7])
+_J_COLS = np.array([3, 4, 5, 3, 4, 5, 6, 7, 8, 9, 11, 8, 9, 11, 10, 11, 8, 9, 10, 11])
+
+
+class EKF8StateBatch(object):
+    """
+    N independent EKF8State filters, e.g. with different noise settings,
+    run together: states are Nx8 and covariances Nx8x8 arrays and every
+    step is a single broadcast operation over the N filters.
+    """
+    def __init__(self, Q):
+        """
+        :param Q: model uncertainty of each filter
+        :type Q: 3d array (Nx4x4)
+        """
+        self._Q = np.asarray(Q, dtype=float)
+        n = len(self._Q)
+        self._x = np.zeros((n, 8))
+        self._P = np.zeros((n, 8, 8))
+        self._y = None
+        self._S = None
+        self._accepted = None
+        self._initialized = False
+
+        # same stacked system as EKF8State: P = J diag(P, Q) J'
+        self._J = np.zeros((n, 8, 12))
+        self._J[:, :, 0:8] = np.eye(8)
+        self._J[:, 4:8, 8:12] = np.eye(4)
+        self._M = np.zeros((n, 12, 12))
+        self._M[:, 8:12, 8:12] = self._Q
+
+    def __len__(self):
+        return len(self._Q)
+
+    def prediction(self, x_prev, P_prev, dt):
+        """ EKF prediction of every filter based on the previous states
+        x_prev and covariances P_prev using a constant velocity model.
+
+        :param x_prev: vector states at t-1 [x, y, z, yaw, u, v, w, r]
+        :param P_prev: covariances at t-1
+        :param dt: delta time abs(t - t-1), shared or one per filter
+        :type x_prev: 2d array (Nx8)
+        :type P_prev: 3d array (Nx8x8)
+        :type dt: float or 1d array
+        :return: predition x and covariance P
+        :rtype: 2-emement tuple (Nx8 array, Nx8x8 array)
+        """
+        x_prev = np.asarray(x_prev)
+        n = len(x_prev)
+        dt = np.asarray(dt, dtype=float) + np.zeros(n)
+        yaw, u, v = x_prev[:, 3:6].T
+        dtc = dt * np.cos(yaw)
+        dts = dt * np.sin(yaw)
+        h = 0.5 * dt
+        # displacement in x and y, the Jacobian respect to the yaw is [-dy, dx]
+        dx = u*dtc - v*dts
+        dy = u*dts + v*dtc
+
+        x = x_prev.copy()
+        x[:, 0:4] += np.array([dx, dy, x_prev[:, 6]*dt, x_prev[:, 7]*dt]).T
+
+        # the non-constant elements of J, as in EKF8State, in one assignment
+        J = self._J
+        J[:, _J_ROWS, _J_COLS] = np.array([
+            -dy, dtc, -dts, dx, dts, dtc, dt, dt,
+            h*dtc, -h*dts, -(h*dt)*dy, h*dts, h*dtc, (h*dt)*dx, h*dt, h*dt,
+            dt, dt, dt, dt]).T
+
+        self._M[:, 0:8, 0:8] = P_prev
+        self._x = x
+        self._P = np.matmul(np.matmul(J, self._M), J.transpose(0, 2, 1))
+        return (self._x, self._P)
+
+    def correction(self, z, H, R):
+        """ EKF correction/update of every filter with a measurement z,
+        observation model H, observation noise R (Joseph form).
+
+        :param z: measurement, shared or one per filter
+        :param H: observation model, shared or one per filter
+        :param R: observation noise, shared or one per filter
+        :type z: 1d array (m) or 2d array (Nxm)
+        :type H: 2d array (mx8) or 3d array (Nxmx8)
+        :type R: 2d array (mxm) or 3d array (Nxmxm)
+        :return: updated state x and covariance P
+        :rtype: 2-emement tuple (Nx8 array, Nx8x8 array)
+        """
+        Ht = np.swapaxes(H, -1, -2)
+        PHt = np.matmul(self._P, Ht)
+        self._y = z - np.einsum('...ij,...j->...i', H, self._x)
+        self._S = np.matmul(H, PHt) + R
+        K = np.swapaxes(np.linalg.solve(self._S, np.swapaxes(PHt, 1, 2)), 1, 2)
+
+        self._x = self._x + np.einsum('nij,nj->ni', K, self._y)
+        IKH = np.eye(8) - np.matmul(K, H)
+        KRKt = np.matmul(np.matmul(K, R), np.swapaxes(K, 1, 2))
+        P = np.matmul(np.matmul(IKH, self._P), np.swapaxes(IKH, 1, 2)) + KRKt
+        self._P = 0.5 * (P + np.swapaxes(P, 1, 2))
+        return (self._x, self._P)
+
+    def initialization(self, z, index, R):
+        """ Initializes every filter from its first measurement z of the
+        state elements in index, the rest of the state is zero.
+
+        :param z: measurement, shared or one per filter
+        :param index: state index of each measurement element
+        :param R: observation noise, shared or one per filter
+        :type z: 1d array (m) or 2d array (Nxm)
+        :type index: 1d int array
+        :type R: 2d array (mxm) or 3d array (Nxmxm)
+        :return: state x and covariance P
+        :rtype: 2-emement tuple (Nx8 array, Nx8x8 array)
+        """
+        n = len(self)
+        index = np.ravel(index)
+        self._x = np.zeros((n, 8))
+        self._x[:, index] = z
+        self._P = np.zeros((n, 8, 8))
+        self._P[:, index[:, None], index] = R
+        self.set_initialized(True)
+        return (self._x, self._P)
+
+    def selection_correction(self, z, index, R, gate=None):
+        """ EKF correction/update of every filter with a measurement z of
+        the state elements in index, observation noise R. Gated
+        measurements are processed with sequential_correction.
+
+        :param z: measurement, shared or one per filter
+        :param index: state index of each measurement element
+        :param R: observation noise, shared or one per filter
+        :param gate: per-element outlier threshold, shared or one per
+            filter (see sequential_correction)
+        :type z: 1d array (m) or 2d array (Nxm)
+        :type index: 1d int array
+        :type R: 2d array (mxm) or 3d array (Nxmxm)
+        :type gate: float or 1d array (N)
+        :return: updated state x and covariance P
+        :rtype: 2-emement tuple (Nx8 array, Nx8x8 array)
+        """
+        if gate is not None:
+            R = np.asarray(R)
+            r = np.diagonal(R, axis1=-2, axis2=-1)
+            if np.count_nonzero(R - r[..., None] * np.eye(r.shape[-1])):
+                raise ValueError("Per-element gating requires a diagonal R")
+            return self.sequential_correction(z, index, r, gate)
+
+        PHt = self._P[:, :, index]
+        self._y = z - self._x[:, index]
+        self._S = PHt[:, index, :] + R
+        K = np.swapaxes(np.linalg.solve(self._S, np.swapaxes(PHt, 1, 2)), 1, 2)
+
+        self._x = self._x + np.einsum('nij,nj->ni', K, self._y)
+        # P - KHP - PH'K' + KSK' = P - KHP for the optimal gain
+        P = self._P - np.matmul(K, np.swapaxes(PHt, 1, 2))
+        self._P = 0.5 * (P + np.swapaxes(P, 1, 2))
+        self._accepted = np.ones(self._y.shape, dtype=bool)
+        return (self._x, self._P)
+
+    def sequential_correction(self, z, index, r, gate=None):
+        """ EKF correction/update of every filter with a measurement z of
+        the state elements in index with independent noise (diagonal R),
+        one scalar update per element as EKF8State.sequential_correction.
+
+        :param z: measurement, shared or one per filter
+        :param index: state index of each measurement element
+        :param r: observation noise variances, shared or one per filter
+        :param gate: an element is rejected when y^2/s exceeds gate,
+            shared or one per filter (inf or None to not gate)
+        :type z: 1d array (m) or 2d array (Nxm)
+        :type index: 1d int array
+        :type r: 1d array (m) or 2d array (Nxm)
+        :type gate: float or 1d array (N)
+        :return: updated state x and covariance P
+        :rtype: 2-emement tuple (Nx8 array, Nx8x8 array)
+        """
+        index = np.ravel(index)
+        n, m = len(self), len(index)
+        z = np.broadcast_to(z, (n, m))
+        r = np.broadcast_to(r, (n, m))
+        gate = np.inf if gate is None else np.asarray(gate, dtype=float)
+        x = self._x.copy()
+        P = self._P.copy()
+        y = np.empty((n, m))
+        s = np.empty((n, m))
+        self._accepted = np.empty((n, m), dtype=bool)
+
+        for i, j in enumerate(index.tolist()):
+            p = P[:, j].copy()  # row j = column j, P is symmetric
+            s[:, i] = si = p[:, j] + r[:, i]
+            y[:, i] = yi = z[:, i] - x[:, j]
+            self._accepted[:, i] = ok = ~(yi * yi > gate * si)
+            k = p / si[:, None] * ok[:, None]  # zero gain if rejected
+            x += yi[:, None] * k
+            P -= (k[:, :, None] * k[:, None, :]) * si[:, None, None]
+
+        self._y = y
+        self._S = s[:, :, None] * np.eye(m)
+        self._x = x
+        self._P = P
+        return (self._x, self._P)
+
+    def innovation(self):
+        """ Innovations and their covariances of the last correction.
+
+        :return: innovation y and covariance S
+        :rtype: 2-element tuple (Nxm array, Nxmxm array)
+        """
+        return (self._y, self._S)
+
+    def accepted(self):
+        """ Measurement elements used by the last correction of each
+        filter (all of them unless rejected by a gate).
+
+        :return: mask of accepted elements
+        :rtype: 2d bool array (Nxm)
+        """
+        return self._accepted
+
+    def set_initialized(self, value):
+        self._initialized = value
+
 
 if __name__ == "__main__":
     Q = np.diag([0.2**2, 0.2**2, 0.2**2, 0.05**2])
@@ -0,0 +1,130 @@
+from bisect import bisect_right
+from ekf import EKF8State
+
+
+class OOSMFilter(object):
+    """
+    Out-of-sequence measurement handling for an EKF8State. The last
+    filter steps (timestamp, measurements and posterior) are kept so a
+    late measurement is fused at its timestamp: the step before it is
+    restored and the following steps are replayed. The filter never
+    predicts backwards in time.
+    """
+    def __init__(self, Q, history=1000):
+        """
+        :param Q: acceleration noise covariance of the EKF8State
+        :param history: max number of steps kept for replay
+        :type Q: 4x4 array
+        :type history: integer > 1
+        """
+        self._ekf = EKF8State(Q)
+        self._history = history
+        self._times = []
+        self._steps = []
+        self.late = 0
+        self.dropped = 0
+        self.replayed = 0
+
+    def __len__(self):
+        return len(self._steps)
+
+    def initialize(self, t, x, P):
+        """ Sets the initial state, any previous history is discarded.
+
+        :param t: timestamp
+        :param x: state
+        :param P: covariance
+        :type t: float
+        :type x: 1d array (8 element)
+        :type P: 2d array (8x8 element)
+        """
+        self._times = [t]
+        self._steps = [(x.copy(), P.copy(), [])]
+        self._ekf.set_initialized(True)
+
+    def state(self, t=None):
+        """ Latest estimate or the estimate of the step at t, which
+        includes the measurements received so far up to t.
+
+        :param t: timestamp of a step in the history
+        :type t: float
+        :return: timestamp, state and covariance
+        :rtype: 3-element tuple (t, x, P)
+        """
+        if not self._steps:
+            raise ValueError("Filter not initialized")
+        i = len(self._steps) if t is None else bisect_right(self._times, t)
+        if i == 0 or (t is not None and self._times[i - 1] != t):
+            raise KeyError("No step at %r" % (t,))
+        x, P, _ = self._steps[i - 1]
+        return (self._times[i - 1], x, P)
+
+    def _step(self, x, P, dt, measurements):
+        x, P = self._ekf.prediction(x, P, dt)
+        for z, index, R, gate in measurements:
+            x, P = self._ekf.selection_correction(z, index, R, gate)
+        return (x.copy(), P.copy())
+
+    def _insert(self, t, measurements):
+        """Adds measurements at t (none for a prediction step) and
+        replays the steps after them"""
+        if not self._steps:
+            raise ValueError("Filter not initialized")
+        i = bisect_right(self._times, t)
+        if i and self._times[i - 1] == t:
+            # a step at t already exists
+            i -= 1
+            if not measurements:
+                return True
+            if i == 0:
+                self.dropped += 1
+                return False
+            self._steps[i][2].extend(measurements)
+        elif i == 0:
+            # older than the history, it can not be fused
+            self.dropped += 1
+            return False
+        else:
+            self._times.insert(i, t)
+            self._steps.insert(i, (None, None, list(measurements)))
+        if i < len(self._steps) - 1:
+            self.late += 1
+
+        # replay from the modified step
+        x, P, _ = self._steps[i - 1]
+        for k in range(i, len(self._steps)):
+            x, P = self._step(x, P, self._times[k] - self._times[k - 1], self._steps[k][2])
+            self._steps[k] = (x, P, self._steps[k][2])
+        self.replayed += len(self._steps) - i - 1
+
+        excess = len(self._steps) - self._history
+        if excess > 0:
+            del self._times[:excess]
+            del self._steps[:excess]
+        return True
+
+    def prediction(self, t):
+        """ Adds a step without measurements at t, e.g. to get the
+        state at a sensor timestamp.
+
+        :param t: timestamp
+        :type t: float
+        :return: True unless t is older than the history
+        :rtype: bool
+        """
+        return self._insert(t, [])
+
+    def selection_correction(self, t, z, index, R, gate=None):
+        """ Fuses a measurement of the state elements in index taken at
+        t, in or out of sequence (see EKFBase.selection_correction).
+
+        :param t: timestamp
+        :param z: measurement
+        :param index: observed state elements
+        :param R: measurement covariance
+        :param gate: per-element rejection threshold or None
+        :type t: float
+        :return: True unless t is older than the history
+        :rtype: bool
+        """
+        return self._insert(t, [(z, index, R, gate)])
@@ -0,0 +1,194 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+class RTSSmoother(object):
+    """
+    Rauch-Tung-Striebel smoother over the history of an EKF. The filter
+    steps are stored while filtering and smoothed backwards afterwards.
+
+    Steps are kept in chunks with the covariances packed as upper
+    triangles. Full chunks can be spilled to .npy files, so only one
+    chunk is in memory while filtering and smoothing.
+    """
+    def __init__(self, size=8, chunk_size=4096, directory=None):
+        """
+        :param size: state size
+        :param chunk_size: steps per chunk
+        :param directory: where full chunks are spilled, kept in memory
+            if None or in a temporary directory if True
+        :type size: integer > 0
+        :type chunk_size: integer > 0
+        :type directory: None, bool or string
+        """
+        self._size = size
+        self._chunk_size = chunk_size
+        self._triu = np.triu_indices(size)
+        self._tmpdir = None
+        if directory is True:
+            directory = self._tmpdir = tempfile.mkdtemp()
+        elif directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._directory = directory or None
+
+        self._chunks = []
+        self._chunk = None
+        self._len = 0
+        self._pending = False
+
+    def __len__(self):
+        return self._len
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Removes the temporary spill directory, if any"""
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def _new_chunk(self):
+        n, m, c = self._size, len(self._triu[0]), self._chunk_size
+        return {
+            "t": np.empty(c), "x": np.empty((c, n)), "P": np.empty((c, m)),
+            "x_pred": np.empty((c, n)), "P_pred": np.empty((c, m)),
+            "F": np.empty((c, n, n))}
+
+    def _spill(self):
+        chunk = self._chunk
+        if self._directory is not None:
+            index = len(self._chunks)
+            fn = {}
+            for k, v in chunk.items():
+                fn[k] = os.path.join(self._directory, "chunk%06d.%s.npy" % (index, k))
+                np.save(fn[k], v)
+            chunk = fn
+        self._chunks.append(chunk)
+        self._chunk = None
+
+    def _load(self, index):
+        chunk = self._chunks[index] if index < len(self._chunks) else self._chunk
+        if chunk is None or not isinstance(chunk["t"], str):
+            return chunk
+        return dict((k, np.load(fn, mmap_mode="r")) for k, fn in chunk.items())
+
+    def add_prediction(self, x, P, F):
+        """ Stores the prediction of the next step.
+
+        :param x: predicted state
+        :param P: predicted covariance
+        :param F: Jacobian of the prediction respect to the previous state
+        :type x: 1d array
+        :type P: 2d array
+        :type F: 2d array
+        """
+        if not self._len:
+            raise ValueError("The first step has no prediction")
+        if self._chunk is None:
+            self._chunk = self._new_chunk()
+        i = self._len % self._chunk_size
+        self._chunk["x_pred"][i] = x
+        self._chunk["P_pred"][i] = P[self._triu]
+        self._chunk["F"][i] = F
+        self._pending = True
+
+    def add_posterior(self, t, x, P):
+        """ Stores the filter estimate of a step: after the corrections
+        of the step, or the prediction itself if it had none. Every
+        step but the first must have a prediction.
+
+        :param t: timestamp
+        :param x: state
+        :param P: covariance
+        :type t: float
+        :type x: 1d array
+        :type P: 2d array
+        """
+        if self._len and not self._pending:
+            raise ValueError("Step without prediction")
+        if self._chunk is None:
+            self._chunk = self._new_chunk()
+        i = self._len % self._chunk_size
+        self._chunk["t"][i] = t
+        self._chunk["x"][i] = x
+        self._chunk["P"][i] = P[self._triu]
+        self._len += 1
+        self._pending = False
+        if i + 1 == self._chunk_size:
+            self._spill()
+
+    def _unpack(self, packed):
+        P = np.empty(packed.shape[:-1] + (self._size, self._size))
+        P[..., self._triu[0], self._triu[1]] = packed
+        P[..., self._triu[1], self._triu[0]] = packed
+        return P
+
+    def iter_smooth(self):
+        """ Backward pass. Chunks are smoothed from the last one to the
+        first one, the gains of each chunk computed at once.
+
+        :return: iterator of (t, x, P) of each chunk, in reverse order
+        :rtype: iterator of 3-element tuples (1d array, 2d array, 3d array)
+        """
+        if self._pending:
+            raise ValueError("Last prediction without posterior")
+        chunks = len(self._chunks) + (self._chunk is not None)
+        following = None
+        x_next = P_next = None
+
+        for index in reversed(range(chunks)):
+            chunk = self._load(index)
+            n = min(self._chunk_size, self._len - index * self._chunk_size)
+            t = np.array(chunk["t"][:n])
+            x = np.array(chunk["x"][:n])
+            P = self._unpack(chunk["P"][:n])
+
+            # the prediction of step k+1 is stored with step k+1, the
+            # next chunk's first one for the last step of the chunk
+            x_pred = np.array(chunk["x_pred"][1:n])
+            P_pred = self._unpack(chunk["P_pred"][1:n])
+            F = np.array(chunk["F"][1:n])
+            if following is not None:
+                x_pred = np.r_[x_pred, following[0][None]]
+                P_pred = np.r_[P_pred, following[1][None]]
+                F = np.r_[F, following[2][None]]
+
+            # C = P F' P_pred^-1 for every step of the chunk, with the
+            # pseudo-inverse if a prediction is singular (e.g. dt = 0
+            # right after a partial initialization)
+            PFt = np.swapaxes(np.matmul(F, P[:len(F)]), 1, 2)
+            try:
+                C = np.swapaxes(np.linalg.solve(P_pred, np.swapaxes(PFt, 1, 2)), 1, 2)
+            except np.linalg.LinAlgError:
+                C = np.matmul(PFt, np.linalg.pinv(P_pred))
+
+            if x_next is None:
+                x_next, P_next = x[n - 1], P[n - 1]
+                last = n - 1
+            else:
+                last = n
+            for k in reversed(range(last)):
+                Ck = C[k]
+                x_next = x[k] + np.dot(Ck, x_next - x_pred[k])
+                P_next = P[k] + np.dot(np.dot(Ck, P_next - P_pred[k]), Ck.T)
+                x[k] = x_next
+                P[k] = P_next
+
+            following = (np.array(chunk["x_pred"][0]), self._unpack(chunk["P_pred"][0]),
+                         np.array(chunk["F"][0]))
+            yield (t, x, P)
+
+    def smooth(self):
+        """ Smoothed trajectory of all the stored steps.
+
+        :return: timestamps, states and covariances
+        :rtype: 3-element tuple (1d array, 2d array, 3d array)
+        """
+        chunks = list(self.iter_smooth())[::-1]
+        if not chunks:
+            n = self._size
+            return (np.empty(0), np.empty((0, n)), np.empty((0, n, n)))
+        return tuple(np.concatenate(c) for c in zip(*chunks))
@@ -0,0 +1,314 @@
+import os
+import unittest
+import numpy as np
+import numpy.testing as npt
+from ekf import EKF8State, EKF8StateBatch
+from smoother import RTSSmoother
+from oosm import OOSMFilter
+
+
+class EKFTest(unittest.TestCase):
+    def setUp(self):
+        self.Q = np.diag([0.2**2, 0.2**2, 0.2**2, 0.05**2])
+        self.x = np.zeros(8) + 0.1
+        self.P = np.diag(np.ones(8) * 10)
+        self.z = np.array([0.24, -0.05, -0.01, 0.18])
+        self.H = np.zeros((4, 8))
+        self.H[[0, 1, 2, 3], [4, 5, 6, 2]] = 1
+        self.R = np.diag([0.1, 0.1, 0.1, 0.2])
+
+    def reference_prediction(self, x, P, dt):
+        cy = np.cos(x[3])
+        sy = np.sin(x[3])
+        dt2 = dt**2
+        x_ref = np.array([
+            x[0] + x[4]*dt*cy - x[5]*dt*sy,
+            x[1] + x[4]*dt*sy + x[5]*dt*cy,
+            x[2] + x[6]*dt,
+            x[3] + x[7]*dt,
+            x[4], x[5], x[6], x[7]])
+        Jx = np.eye(8)
+        Jx[0, 3:6] = [-(x[4]*dt)*sy-(x[5]*dt)*cy, dt*cy, -dt*sy]
+        Jx[1, 3:6] = [(x[4]*dt)*cy-(x[5]*dt)*sy, dt*sy, dt*cy]
+        Jx[2, 6] = Jx[3, 7] = dt
+        Jq = np.array([
+            [0.5*dt2*cy, -0.5*dt2*sy, 0, -0.5*(x[4]*dt)*dt2*sy-0.5*(x[5]*dt)*dt2*cy],
+            [0.5*dt2*sy,  0.5*dt2*cy, 0,  0.5*(x[4]*dt)*dt2*cy-0.5*(x[5]*dt)*dt2*sy],
+            [0, 0, 0.5*dt2, 0],
+            [0, 0, 0, 0.5*dt2],
+            [dt, 0, 0, 0],
+            [0, dt, 0, 0],
+            [0, 0, dt, 0],
+            [0, 0, 0, dt]])
+        P_ref = np.dot(np.dot(Jx, P), Jx.T) + np.dot(np.dot(Jq, self.Q), Jq.T)
+        return (x_ref, P_ref, Jx, Jq)
+
+    def reference_correction(self, x, P):
+        S = np.dot(np.dot(self.H, P), self.H.T) + self.R
+        K = np.dot(np.dot(P, self.H.T), np.linalg.inv(S))
+        y = self.z - np.dot(self.H, x)
+        return (x + np.dot(K, y), np.dot(np.eye(8) - np.dot(K, self.H), P), y, S)
+
+    def test_prediction(self):
+        ekf = EKF8State(self.Q)
+        x = np.array([1., 2., 3., 0.7, 0.5, -0.2, 0.1, 0.05])
+        P = np.diag(np.arange(1., 9.))
+        P[0, 3] = P[3, 0] = 0.2
+        for dt in [0.5, 0.1, 2.0]:
+            x_ref, P_ref, Jx, Jq = self.reference_prediction(x, P, dt)
+            x, P = ekf.prediction(x, P, dt)
+            npt.assert_almost_equal(x, x_ref)
+            npt.assert_almost_equal(P, P_ref)
+            npt.assert_almost_equal(ekf.jacobians()[0], Jx)
+            npt.assert_almost_equal(ekf.jacobians()[1], Jq)
+
+    def test_correction(self):
+        ekf = EKF8State(self.Q)
+        x, P = ekf.prediction(self.x, self.P, 0.5)
+        x_ref, P_ref, y_ref, S_ref = self.reference_correction(x, P)
+
+        for joseph in [True, False]:
+            ekf.prediction(self.x, self.P, 0.5)
+            x, P = ekf.correction(self.z, self.H, self.R, joseph=joseph)
+            npt.assert_almost_equal(x, x_ref)
+            npt.assert_almost_equal(P, P_ref)
+            npt.assert_array_equal(P, P.T)
+
+            y, S = ekf.innovation()
+            npt.assert_almost_equal(y, y_ref)
+            npt.assert_almost_equal(S, S_ref)
+
+    def test_selection_correction(self):
+        ekf = EKF8State(self.Q)
+        ekf.prediction(self.x, self.P, 0.5)
+        x_ref, P_ref = ekf.correction(self.z, self.H, self.R)
+        y_ref, S_ref = ekf.innovation()
+
+        ekf.prediction(self.x, self.P, 0.5)
+        x, P = ekf.selection_correction(self.z, np.array([4, 5, 6, 2]), self.R)
+        npt.assert_almost_equal(x, x_ref)
+        npt.assert_almost_equal(P, P_ref)
+        npt.assert_array_equal(P, P.T)
+        npt.assert_almost_equal(ekf.innovation()[0], y_ref)
+        npt.assert_almost_equal(ekf.innovation()[1], S_ref)
+
+    def test_sequential_correction(self):
+        ekf = EKF8State(self.Q)
+        index = np.array([4, 5, 6, 2])
+        ekf.prediction(self.x, self.P, 0.5)
+        x_ref, P_ref = ekf.selection_correction(self.z, index, self.R)
+
+        ekf.prediction(self.x, self.P, 0.5)
+        x, P = ekf.sequential_correction(self.z, index, self.R.diagonal())
+        npt.assert_almost_equal(x, x_ref)
+        npt.assert_almost_equal(P, P_ref)
+        npt.assert_array_equal(P, P.T)
+        self.assertTrue(ekf.accepted().all())
+
+        # outlier in the second element
+        z = self.z.copy()
+        z[1] = 100
+        ekf.prediction(self.x, self.P, 0.5)
+        x, P = ekf.selection_correction(z, index, self.R, gate=9.0)
+        npt.assert_array_equal(ekf.accepted(), [True, False, True, True])
+        self.assertLess(abs(x[5]), 1)
+
+        ekf.prediction(self.x, self.P, 0.5)
+        self.assertRaises(ValueError, ekf.selection_correction, z, index, self.R + 0.01, 9.0)
+
+    def test_batch(self):
+        scales = [0.5, 1.0, 2.0]
+        Qs = np.array([self.Q * k for k in scales])
+        Rs = np.array([self.R * k for k in scales])
+        index = np.array([4, 5, 6, 2])
+
+        batch = EKF8StateBatch(Qs)
+        x = np.tile(self.x, (3, 1))
+        P = np.tile(self.P, (3, 1, 1))
+        for step in range(3):
+            x, P = batch.prediction(x, P, 0.5)
+            xb, Pb = batch.correction(self.z, self.H, Rs)
+            xs, Ps = batch.prediction(xb, Pb, 0.2)
+            xs, Ps = batch.selection_correction(self.z + 0.1, index, Rs)
+            x, P = xs, Ps
+
+        for i, k in enumerate(scales):
+            ekf = EKF8State(self.Q * k)
+            x, P = self.x, self.P
+            for step in range(3):
+                ekf.prediction(x, P, 0.5)
+                x_ref, P_ref = ekf.correction(self.z, self.H, self.R * k)
+                ekf.prediction(x_ref, P_ref, 0.2)
+                x, P = ekf.selection_correction(self.z + 0.1, index, self.R * k)
+            npt.assert_almost_equal(xb[i], x_ref)
+            npt.assert_almost_equal(Pb[i], P_ref)
+            npt.assert_almost_equal(xs[i], x)
+            npt.assert_almost_equal(Ps[i], P)
+
+    def test_batch_gating(self):
+        index = np.array([4, 5, 6, 2])
+        zs = np.array([self.z, self.z, self.z])
+        zs[1:, 1] = 100  # outlier, gated in filter 1 only
+        gates = [9.0, 9.0, None]
+
+        batch = EKF8StateBatch(np.tile(self.Q, (3, 1, 1)))
+        self.assertFalse(batch._initialized)
+        x, P = batch.initialization(zs, index, self.R)
+        self.assertTrue(batch._initialized)
+        npt.assert_array_equal(x[:, index], zs)
+        npt.assert_array_equal(P[0][index][:, index], self.R)
+        batch.prediction(np.tile(self.x, (3, 1)), np.tile(self.P, (3, 1, 1)), 0.5)
+        xb, Pb = batch.selection_correction(
+            zs, index, self.R, np.array([np.inf if g is None else g for g in gates]))
+        npt.assert_array_equal(batch.accepted()[:, 1], [True, False, True])
+
+        for i, gate in enumerate(gates):
+            ekf = EKF8State(self.Q)
+            ekf.prediction(self.x, self.P, 0.5)
+            x, P = ekf.selection_correction(zs[i], index, self.R, gate)
+            npt.assert_almost_equal(xb[i], x)
+            npt.assert_almost_equal(Pb[i], P)
+
+        batch.prediction(xb, Pb, 0.5)
+        self.assertRaises(ValueError, batch.selection_correction, self.z, index, self.R + 0.01, 9.0)
+
+    def test_lazy_prediction(self):
+        ekf = EKF8State(self.Q)
+        self.assertAlmostEqual(ekf.defer(0.2), 0.2)
+        self.assertAlmostEqual(ekf.defer(0.1), 0.3)
+        x, P = ekf.prediction(self.x, self.P, 0.2)
+        x_ref, P_ref = self.reference_prediction(self.x, self.P, 0.5)[0:2]
+        npt.assert_almost_equal(x, x_ref)
+        npt.assert_almost_equal(P, P_ref)
+
+        ekf.defer(0.5)
+        x, P = ekf.flush(self.x, self.P)
+        npt.assert_almost_equal(x, x_ref)
+        x, P = ekf.prediction(self.x, self.P, 0.5)
+        npt.assert_almost_equal(P, P_ref)
+
+        dts = np.array([0.0, 0.1, 0.5, 2.0])
+        x, P = ekf.predict_many(self.x, self.P, dts)
+        self.assertEqual(P.shape, (4, 8, 8))
+        for i, dt in enumerate(dts):
+            x_ref, P_ref = self.reference_prediction(self.x, self.P, dt)[0:2]
+            npt.assert_almost_equal(x[i], x_ref)
+            npt.assert_almost_equal(P[i], P_ref)
+        xs = np.array([self.x, self.x + 1])
+        x, P = ekf.predict_many(xs, self.P, [0.5, 0.5])
+        npt.assert_almost_equal(x[1], self.reference_prediction(xs[1], self.P, 0.5)[0])
+
+    def test_correction_not_positive_definite(self):
+        ekf = EKF8State(self.Q)
+        ekf.prediction(self.x, self.P, 0.5)
+        self.assertRaises(np.linalg.LinAlgError, ekf.correction, self.z, self.H, -self.R * 1e3)
+
+class SmootherTest(unittest.TestCase):
+    def filter(self, smoothers):
+        """Filters a random sequence of steps, returns the reference
+        RTS smoothing computed with full arrays"""
+        rng = np.random.RandomState(0)
+        ekf = EKF8State(np.diag([0.2**2, 0.2**2, 0.2**2, 0.05**2]))
+        index = np.array([4, 5, 6, 2])
+        R = np.diag([0.1, 0.1, 0.1, 0.2])
+        x, P = np.zeros(8), np.eye(8)
+        steps = [(0.0, x, P, None, None, None)]
+        for s in smoothers:
+            s.add_posterior(0.0, x, P)
+        for k in range(1, 30):
+            x, P = ekf.prediction(x, P, rng.uniform(0.05, 0.5))
+            prediction = (x.copy(), P.copy(), ekf.jacobians()[0])
+            for s in smoothers:
+                s.add_prediction(*prediction)
+            if k % 3:
+                x, P = ekf.selection_correction(rng.normal(0, 0.3, 4), index, R)
+            x, P = x.copy(), P.copy()
+            steps.append((float(k),  x, P) + prediction)
+            for s in smoothers:
+                s.add_posterior(float(k), x, P)
+
+        xs, Ps = [steps[-1][1]], [steps[-1][2]]
+        for k in reversed(range(len(steps) - 1)):
+            x_pred, P_pred, F = steps[k + 1][3:]
+            C = np.dot(np.dot(steps[k][2], F.T), np.linalg.inv(P_pred))
+            xs.insert(0, steps[k][1] + np.dot(C, xs[0] - x_pred))
+            Ps.insert(0, steps[k][2] + np.dot(np.dot(C, Ps[0] - P_pred), C.T))
+        return (np.array([s[0] for s in steps]), np.array(xs), np.array(Ps))
+
+    def test_smoother(self):
+        smoothers = [RTSSmoother(), RTSSmoother(chunk_size=7), RTSSmoother(chunk_size=10, directory=True)]
+        t_ref, x_ref, P_ref = self.filter(smoothers)
+        for s in smoothers:
+            self.assertEqual(len(s), 30)
+            t, x, P = s.smooth()
+            npt.assert_array_equal(t, t_ref)
+            npt.assert_almost_equal(x, x_ref)
+            npt.assert_almost_equal(P, P_ref)
+        self.assertEqual(len(os.listdir(smoothers[2]._directory)), 3 * 6)
+        smoothers[2].close()
+
+        s = RTSSmoother()
+        self.assertRaises(ValueError, s.add_prediction, np.zeros(8), np.eye(8), np.eye(8))
+        s.add_posterior(0.0, np.zeros(8), np.eye(8))
+        self.assertRaises(ValueError, s.add_posterior, 1.0, np.zeros(8), np.eye(8))
+
+
+class OOSMTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.Q = np.diag([0.2**2, 0.2**2, 0.2**2, 0.05**2])
+        self.events = []
+        t = 0.0
+        for k in range(60):
+            t += rng.uniform(0.05, 0.3)
+            if k % 3 == 0:
+                self.events.append((t, rng.normal(0, 0.3, 4), np.array([4, 5, 6, 2]), np.diag([0.1, 0.1, 0.1, 0.2])))
+            elif k % 3 == 1:
+                self.events.append((t, rng.normal(0, 0.3, 1), np.array([3]), np.diag([0.04])))
+            else:
+                self.events.append((t, None, None, None))
+
+    def feed(self, f, events):
+        f.initialize(0.0, np.zeros(8), np.eye(8))
+        for t, z, index, R in events:
+            if z is None:
+                f.prediction(t)
+            else:
+                f.selection_correction(t, z, index, R)
+        return f
+
+    def test_in_order(self):
+        f = self.feed(OOSMFilter(self.Q), self.events)
+        ekf = EKF8State(self.Q)
+        x, P, t_prev = np.zeros(8), np.eye(8), 0.0
+        for t, z, index, R in self.events:
+            x, P = ekf.prediction(x, P, t - t_prev)
+            if z is not None:
+                x, P = ekf.selection_correction(z, index, R)
+            t_prev = t
+        npt.assert_almost_equal(f.state()[1], x)
+        npt.assert_almost_equal(f.state()[2], P)
+        self.assertEqual((f.late, f.dropped, f.replayed), (0, 0, 0))
+
+    def test_late(self):
+        ref = self.feed(OOSMFilter(self.Q), self.events)
+
+        # each event delayed up to 5 positions
+        order = np.argsort(np.arange(len(self.events)) + np.random.RandomState(1).uniform(0, 5, len(self.events)))
+        f = self.feed(OOSMFilter(self.Q, history=20), [self.events[i] for i in order])
+        self.assertGreater(f.late, 0)
+        self.assertEqual(f.dropped, 0)
+        self.assertEqual(len(f), 20)
+        npt.assert_almost_equal(f.state()[1], ref.state()[1])
+        npt.assert_almost_equal(f.state()[2], ref.state()[2])
+        t = self.events[-5][0]
+        npt.assert_almost_equal(f.state(t)[1], ref.state(t)[1])
+
+        # older than the history
+        self.assertFalse(f.selection_correction(0.01, np.zeros(1), np.array([3]), np.diag([0.04])))
+        self.assertEqual(f.dropped, 1)
+        self.assertRaises(KeyError, f.state, 0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
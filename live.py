@@ -0,0 +1,116 @@
+import sys
+import time
+import collections
+import numpy as np
+from Queue import Queue
+from util import ingest
+from util import measurement_8state as meas
+from ekf.oosm import OOSMFilter
+import odometry
+
+
+class LiveOdometry(object):
+    def __init__(self, dvl_config=odometry.dvl_config, imu_config=odometry.imu_config,
+                 ekf_config=odometry.ekf_config, history=1000, gps_history=10000):
+        """ Odometry of messages as they arrive, fused at their timestamp
+        by an OOSMFilter so late messages are handled.
+
+        :param dvl_config: dvl configuration
+        :param imu_config: imu configuration
+        :param ekf_config: filter configuration
+        :param history: filter steps kept to fuse late messages
+        :param gps_history: last gps fixes kept, (t, utm) in gps
+        """
+        self.dvl_config = dvl_config
+        self.imu_config = imu_config
+        self.stdev_dvl = {
+            "bottom": np.append(dvl_config["stdev_bottom"], dvl_config["stdev_depth"]),
+            "water": np.append(dvl_config["stdev_water"], dvl_config["stdev_depth"])
+            }
+        self.stdev_imu = np.array([imu_config["stdev_orientation"][2], imu_config["stdev_angular_velocity"][2]])
+        Q = np.diag(ekf_config["stdev_velocity_model"][[0, 1, 2, 5], ]**2)
+        self.filter = OOSMFilter(Q, history)
+        self.initialized = False
+        self.gps = collections.deque(maxlen=gps_history)
+
+    def process(self, key, row):
+        """Fuses a message, returns False if it could not be fused"""
+        t = row[0]
+        if key == "dvl":
+            z, H, R = meas.dvl(row, self.dvl_config["pose"], self.stdev_dvl)
+            index = meas.DVL_INDEX
+            gate = self.dvl_config["gate"]
+        elif key == "imu":
+            z, H, R = meas.imu(row, self.imu_config["pose"], self.stdev_imu)
+            index = meas.IMU_INDEX
+            gate = None
+        elif key == "mis":
+            return self.filter.prediction(t) if self.initialized else False
+        elif key == "gps":
+            self.gps.append((t,) + meas.gps(row))
+            return True
+        else:
+            return False
+
+        if not self.initialized:
+            self.filter.initialize(t, np.dot(H.T, z), np.dot(np.dot(H.T, R), H))
+            self.initialized = True
+            return True
+        return self.filter.selection_correction(t, z, index, R, gate)
+
+
+def run(sources, keys, window=0.5, queue_size=1000, report=None):
+    """ Runs the live odometry over started or not started sources
+    until all of them end.
+
+    :param sources: function that returns the sources of a queue
+    :param keys: ids of the sources
+    :param window: reorder window in seconds
+    :param queue_size: max messages waiting to be merged
+    :param report: seconds between metric reports, none if None
+    :return: odometry and metrics
+    :rtype: 2-element tuple (LiveOdometry, Metrics)
+    """
+    queue = Queue(queue_size)
+    sources = sources(queue)
+    for s in sources:
+        if not s.is_alive():
+            s.start()
+
+    metrics = ingest.Metrics()
+    merger = ingest.Merger(queue, keys, window, metrics=metrics)
+    live = LiveOdometry()
+    last = time.time()
+    try:
+        for key, row, arrival in merger:
+            live.process(key, row)
+            metrics.done(arrival)
+            if report is not None and time.time() - last > report:
+                print_summary(metrics.summary(), live)
+                last = time.time()
+    finally:
+        for s in sources:
+            s.stop()
+    return (live, metrics)
+
+
+def print_summary(summary, live):
+    print("%(processed)d msgs (%(rate).0f/s, %(late)d late) queue %(depth_mean).1f/%(depth_max)d "
+          "latency p50 %(latency_p50).4fs p99 %(latency_p99).4fs" % summary),
+    if live.initialized:
+        t, x, P = live.filter.state()
+        print("t %.2f x %.2f y %.2f yaw %.2f" % (t, x[0], x[1], x[3]))
+    else:
+        print("")
+
+
+def main():
+    speed = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    keys = sorted(odometry.filenames)
+    live, metrics = run(lambda q: ingest.replay(odometry.filenames, q, speed), keys, report=5.0)
+    print_summary(metrics.summary(), live)
+    print("late fused %d, dropped %d, replayed steps %d" % (
+        live.filter.late, live.filter.dropped, live.filter.replayed))
+
+if __name__ == "__main__":
+    main()
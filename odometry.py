@@ -1,10 +1,10 @@
 import numpy as np
 from util import o2ca2_dataset as dataset
 from util import measurement_8state as meas
-from ekf.ekf import EKF8State
+from util.trajectory import TrajectoryRecorder
+from ekf.ekf import EKF8State, EKF8StateBatch
 from ekf.tools import *
 import time
-import matplotlib.pyplot as plt
 
 
 dvl_config = {
@@ -13,7 +13,8 @@ dvl_config = {
     "stdev_bottom": np.array([0.3, 0.3, 0.15]),  # m/s
     "stdev_water": np.array([0.6, 0.6, 0.3]),  # m/s
     "stdev_yaw": 0.2,  # rad
-    "stdev_depth": 0.02  # m
+    "stdev_depth": 0.02,  # m
+    "gate": None  # per-element outlier rejection threshold (y^2/s), e.g. 9
     }
 
 imu_config = {
@@ -56,114 +57,348 @@ def update_time(curr_time, timestamp):
     return (timestamp, timestamp-prev_time)
 
 
-def main():
-    print("Loading data..."),
-    start = time.time()
-    D = dataset.O2CA2Dataset(filenames)
-    stop = time.time()
-    print("[DONE]  %.3fs" % (stop-start))
+def stdev_dvl(dvl_config):
+    """Bottom and water track [u, v, w, depth] uncertainty of a dvl configuration"""
+    return {
+        "bottom": np.append(dvl_config["stdev_bottom"], dvl_config["stdev_depth"]),
+        "water": np.append(dvl_config["stdev_water"], dvl_config["stdev_depth"])
+        }
 
+
+def stdev_imu(imu_config):
+    """[yaw, yaw rate] uncertainty of an imu configuration"""
+    return np.array([imu_config["stdev_orientation"][2], imu_config["stdev_angular_velocity"][2]])
+
+
+def model_noise(ekf_config):
+    """Model uncertainty Q (u, v, w and r accelerations) of a filter configuration"""
+    return np.diag(ekf_config["stdev_velocity_model"][[0, 1, 2, 5], ]**2)
+
+
+def run(D, dvl_config=dvl_config, imu_config=imu_config, mis_config=mis_config,
+        ekf_config=ekf_config, smoother=None, covariance_storage="full", lazy=False):
+    """Runs the filter over a dataset (no plotting).
+
+    :param D: dataset
+    :param dvl_config: dvl configuration
+    :param imu_config: imu configuration
+    :param mis_config: imaging sonar configuration
+    :param ekf_config: filter configuration
+    :param smoother: stores every filter step to be smoothed afterwards
+    :param covariance_storage: how the recorded covariances are stored
+        ('full', 'triu' or 'diag'), they are returned as full matrices
+    :param lazy: the filter is only propagated to the dvl and imu
+        timestamps, the states at the sonar timestamps are predicted
+        from the last posterior in batches (and not smoothed). Faster,
+        but a single prediction over the accumulated time adds other
+        process noise than the chain of steps, so the trajectory differs
+        (meters in XY over experiment3). Otherwise every sonar timestamp
+        is a filter step
+    :type D: O2CA2Dataset
+    :type smoother: RTSSmoother
+    :type covariance_storage: string
+    :type lazy: bool
+    :return: trajectory, covariances and ground truth, as arrays
+    :rtype: dictionary
+    """
     gps_initialized = False
     update_trajectory = False
-    timestamps = []
-    odometry = []
-    odometry_cov = []
+    trajectory = TrajectoryRecorder(8, covariance_storage)
 
     timestamps_imu = []
     imu = []
     timestamps_gps = []
     gps = []
 
-    mis_timestamps = []
-    mis_state = []
-    mis_cov = []
+    mis_trajectory = TrajectoryRecorder(8, covariance_storage)
+    mis_pending = []
 
     state = np.zeros(8)
     covariance = np.diag(np.ones(8))
     t = 0
 
-    stdev_dvl = {
-        "bottom": np.append(dvl_config["stdev_bottom"], dvl_config["stdev_depth"]),
-        "water": np.append(dvl_config["stdev_water"], dvl_config["stdev_depth"])
-        }
-
-    stdev_imu = np.array([imu_config["stdev_orientation"][2], imu_config["stdev_angular_velocity"][2]])
-
-    Q = np.diag(ekf_config["stdev_velocity_model"][[0, 1, 2, 5], ]**2)
-    ekf = EKF8State(Q)
-    try:
-        while True:
-            _type, data = D.next()
-            if _type is "dvl":
-                t, dt = update_time(t, data[0])
-                z, H, R = meas.dvl(data, dvl_config["pose"], stdev_dvl)
+    dvl_stdev = stdev_dvl(dvl_config)
+    imu_stdev = stdev_imu(imu_config)
+    ekf = EKF8State(model_noise(ekf_config))
+    H_dvl = meas.selection(meas.DVL_INDEX)
+    H_imu = meas.selection(meas.IMU_INDEX)
+
+    def record_mis():
+        """Predicts the pending sonar timestamps at once"""
+        if mis_pending:
+            ts, dts, xs, Ps = zip(*mis_pending)
+            x, P = ekf.predict_many(np.array(xs), np.array(Ps), dts)
+            mis_trajectory.extend(ts, x, P)
+            del mis_pending[:]
+
+    keys = D.keys
+    for block, source, row in D.iter_blocks():
+        # measurements of the whole block at once, the loop only indexes them
+        data = dict(zip(keys, block))
+        if len(data.get("dvl", ())):
+            z_dvl, R_dvl, _ = meas.dvl_batch(data["dvl"], dvl_config["pose"], dvl_stdev)
+        if len(data.get("imu", ())):
+            z_imu, R_imu = meas.imu_batch(data["imu"], imu_config["pose"], imu_stdev)
+        if len(data.get("gps", ())):
+            utm_gps = meas.gps_batch(data["gps"])
+
+        for _type, i in zip([keys[s] for s in source.tolist()], row.tolist()):
+            if _type == "dvl":
+                t, dt = update_time(t, data["dvl"][i, 0])
+                z, R = z_dvl[i], R_dvl[i]
 
                 if not ekf._initialized:
-                    state = np.dot(H.T, z)
-                    covariance = np.dot(np.dot(H.T, R), H)
+                    state = np.dot(H_dvl.T, z)
+                    covariance = np.dot(np.dot(H_dvl.T, R), H_dvl)
                     ekf.set_initialized(True)
                 else:
                     state, covariance = ekf.prediction(state, covariance, dt)
-                    state, covariance = ekf.correction(z, H, R)
+                    if smoother is not None:
+                        smoother.add_prediction(state, covariance, ekf.jacobians()[0])
+                    state, covariance = ekf.selection_correction(z, meas.DVL_INDEX, R, dvl_config["gate"])
                     update_trajectory = True
+                if smoother is not None:
+                    smoother.add_posterior(t, state, covariance)
 
-            elif _type is "imu":
-                t, dt = update_time(t, data[0])
-                z, H, R = meas.imu(data, imu_config["pose"], stdev_imu)
+            elif _type == "imu":
+                t, dt = update_time(t, data["imu"][i, 0])
+                z, R = z_imu[i], R_imu[i]
 
                 if not ekf._initialized:
-                    state = np.dot(H.T, z)
-                    covariance = np.dot(np.dot(H.T, R), H)
+                    state = np.dot(H_imu.T, z)
+                    covariance = np.dot(np.dot(H_imu.T, R), H_imu)
                     ekf.set_initialized(True)
                 else:
                     state, covariance = ekf.prediction(state, covariance, dt)
-                    state, covariance = ekf.correction(z, H, R)
+                    if smoother is not None:
+                        smoother.add_prediction(state, covariance, ekf.jacobians()[0])
+                    state, covariance = ekf.selection_correction(z, meas.IMU_INDEX, R)
+                if smoother is not None:
+                    smoother.add_posterior(t, state, covariance)
 
                 timestamps_imu.append(t)
                 imu.append(z[0])
 
-            elif _type is "mis":
+            elif _type == "mis":
                 if ekf._initialized:
-                    t, dt = update_time(t, data[0])
+                    t, dt = update_time(t, data["mis"][i, 0])
+                    if lazy:
+                        mis_pending.append((t, ekf.defer(dt), state, covariance))
+                        if len(mis_pending) == 4096:
+                            record_mis()
+                        continue
+
                     state, covariance = ekf.prediction(state, covariance, dt)
+                    if smoother is not None:
+                        smoother.add_prediction(state, covariance, ekf.jacobians()[0])
+                        smoother.add_posterior(t, state, covariance)
 
                     # temporary to generate a subdataset
-                    mis_timestamps.append(t)
-                    mis_state.append(state)
-                    mis_cov.append(covariance)
+                    mis_trajectory.append(t, state, covariance)
 
-            elif _type is "gps":
-                utm = meas.gps(data)
+            elif _type == "gps":
+                utm = utm_gps[i]
                 if not gps_initialized:
                     utm_init = utm - state[0:2]
                     gps_initialized = True
 
-                timestamps_gps.append(data[0])
+                timestamps_gps.append(data["gps"][i, 0])
                 gps.append(list(utm - utm_init))
 
             if update_trajectory:
-                timestamps.append(t)
-                odometry.append(state[[0, 1, 2, 3], ])
-                odometry_cov.append(covariance)
+                trajectory.append(t, state, covariance)
                 update_trajectory = False
-    except EOFError:
-        pass
+        record_mis()
+
+    return {
+        "timestamps": trajectory.timestamps,
+        "odometry": trajectory.states[:, 0:4],
+        "odometry_cov": trajectory.covariances,
+        "timestamps_gps": np.asarray(timestamps_gps),
+        "gps": np.asarray(gps),
+        "timestamps_imu": np.asarray(timestamps_imu),
+        "imu": np.asarray(imu),
+        "mis_timestamps": mis_trajectory.timestamps,
+        "mis_state": mis_trajectory.states,
+        "mis_cov": mis_trajectory.covariances
+        }
+
+
+def _distinct(settings):
+    """Distinct sensor settings (arrays) and the index of each one in them"""
+    first = {}
+    which = [first.setdefault(np.asarray(v, dtype=float).tobytes(), len(first)) for v in settings]
+    unique = [None] * len(first)
+    for v, k in zip(settings, which):
+        unique[k] = v
+    return (unique, np.array(which, dtype=np.intp))
+
+
+def run_batch(D, configs, covariances=False):
+    """Runs one filter per configuration over a single replay of the
+    dataset: the filters are stepped together (EKF8StateBatch) and the
+    measurements of each distinct sensor pose and uncertainty are
+    computed once per block. Same steps as run (not lazy, no smoother),
+    the dvl gate may differ between configurations.
+
+    :param D: dataset
+    :param configs: dvl_config, imu_config and ekf_config of each filter
+        (see run), the defaults of the ones not given
+    :param covariances: record the covariances, 64 floats per filter
+        and step
+    :type D: O2CA2Dataset
+    :type configs: list of dictionaries
+    :type covariances: bool
+    :return: result of each filter as run, without 'odometry_cov' and
+        'mis_cov' unless covariances are recorded
+    :rtype: list of dictionaries
+    """
+    defaults = {"dvl_config": dvl_config, "imu_config": imu_config, "ekf_config": ekf_config}
+    configs = [dict(defaults, **c) for c in configs]
+    n = len(configs)
+    dvl_settings, dvl_which = _distinct(
+        [np.r_[c["dvl_config"]["pose"], stdev_dvl(c["dvl_config"])["bottom"],
+               stdev_dvl(c["dvl_config"])["water"]] for c in configs])
+    imu_settings, imu_which = _distinct(
+        [np.r_[c["imu_config"]["pose"], stdev_imu(c["imu_config"])] for c in configs])
+    gates = [c["dvl_config"]["gate"] for c in configs]
+    gate = None if all(g is None for g in gates) else \
+        np.array([np.inf if g is None else g for g in gates], dtype=float)
+
+    ekf = EKF8StateBatch([model_noise(c["ekf_config"]) for c in configs])
+    trajectory = TrajectoryRecorder(8*n, None)
+    trajectory_cov = TrajectoryRecorder(64*n, None)
+    mis_trajectory = TrajectoryRecorder(8*n, None)
+    mis_trajectory_cov = TrajectoryRecorder(64*n, None)
+
+    gps_initialized = False
+    update_trajectory = False
+    timestamps_imu = []
+    imu = []
+    timestamps_gps = []
+    gps = []
+
+    state = np.zeros((n, 8))
+    covariance = np.tile(np.eye(8), (n, 1, 1))
+    t = 0
+
+    def record(recorder, recorder_cov):
+        recorder.append(t, state.ravel())
+        if covariances:
+            recorder_cov.append(t, covariance.ravel())
+
+    keys = D.keys
+    for block, source, row in D.iter_blocks():
+        data = dict(zip(keys, block))
+        if len(data.get("dvl", ())):
+            z_dvl, R_dvl = [np.array(v) for v in zip(*[
+                meas.dvl_batch(data["dvl"], v[0:6], {"bottom": v[6:10], "water": v[10:14]})[0:2]
+                for v in dvl_settings])]
+        if len(data.get("imu", ())):
+            z_imu, R_imu = [np.array(v) for v in zip(*[
+                meas.imu_batch(data["imu"], v[0:6], v[6:8]) for v in imu_settings])]
+        if len(data.get("gps", ())):
+            utm_gps = meas.gps_batch(data["gps"])
+
+        for _type, i in zip([keys[s] for s in source.tolist()], row.tolist()):
+            if _type == "dvl":
+                t, dt = update_time(t, data["dvl"][i, 0])
+                z, R = z_dvl[dvl_which, i], R_dvl[dvl_which, i]
+
+                if not ekf._initialized:
+                    state, covariance = ekf.initialization(z, meas.DVL_INDEX, R)
+                else:
+                    state, covariance = ekf.prediction(state, covariance, dt)
+                    state, covariance = ekf.selection_correction(z, meas.DVL_INDEX, R, gate)
+                    update_trajectory = True
+
+            elif _type == "imu":
+                t, dt = update_time(t, data["imu"][i, 0])
+                z, R = z_imu[imu_which, i], R_imu[imu_which, i]
+
+                if not ekf._initialized:
+                    state, covariance = ekf.initialization(z, meas.IMU_INDEX, R)
+                else:
+                    state, covariance = ekf.prediction(state, covariance, dt)
+                    state, covariance = ekf.selection_correction(z, meas.IMU_INDEX, R)
+
+                timestamps_imu.append(t)
+                imu.append(z[:, 0])
+
+            elif _type == "mis":
+                if ekf._initialized:
+                    t, dt = update_time(t, data["mis"][i, 0])
+                    state, covariance = ekf.prediction(state, covariance, dt)
+                    record(mis_trajectory, mis_trajectory_cov)
+
+            elif _type == "gps":
+                utm = utm_gps[i]
+                if not gps_initialized:
+                    utm_init = utm - state[:, 0:2]
+                    gps_initialized = True
+
+                timestamps_gps.append(data["gps"][i, 0])
+                gps.append(utm - utm_init)
+
+            if update_trajectory:
+                record(trajectory, trajectory_cov)
+                update_trajectory = False
+
+    states = trajectory.states.reshape(-1, n, 8)
+    mis_states = mis_trajectory.states.reshape(-1, n, 8)
+    gps = np.reshape(gps, (-1, n, 2))
+    imu = np.reshape(imu, (-1, n))
+    results = []
+    for f in range(n):
+        result = {
+            "timestamps": trajectory.timestamps,
+            "odometry": states[:, f, 0:4],
+            "timestamps_gps": np.asarray(timestamps_gps),
+            "gps": gps[:, f],
+            "timestamps_imu": np.asarray(timestamps_imu),
+            "imu": imu[:, f],
+            "mis_timestamps": mis_trajectory.timestamps,
+            "mis_state": mis_states[:, f]
+            }
+        if covariances:
+            result["odometry_cov"] = trajectory_cov.states.reshape(-1, n, 8, 8)[:, f]
+            result["mis_cov"] = mis_trajectory_cov.states.reshape(-1, n, 8, 8)[:, f]
+        results.append(result)
+    return results
+
+
+def errors(result):
+    """XY error respect to the gps and yaw error respect to the imu
+    of a run result"""
+    err = get_error(
+        result["timestamps"], result["odometry"][:, [0, 1]].T,
+        result["timestamps_gps"], result["gps"][:, ::-1].T).T
+    err_yaw = get_error(
+        result["timestamps"], result["odometry"][:, 3],
+        result["timestamps_imu"], result["imu"].T).T
+    return (err, err_yaw)
+
+
+def main():
+    import matplotlib.pyplot as plt
+
+    print("Loading data..."),
+    start = time.time()
+    D = dataset.O2CA2Dataset(filenames, cache=True)
+    stop = time.time()
+    print("[DONE]  %.3fs" % (stop-start))
 
-    timestamps = np.asarray(timestamps)
-    odometry = np.asarray(odometry)
-    odometry_cov = np.asarray(odometry_cov)
-    timestamps_gps = np.asarray(timestamps_gps)
-    gps = np.asarray(gps)
-    timestamps_imu = np.asarray(timestamps_imu)
-    imu = np.asarray(imu)
+    result = run(D)
+    timestamps = result["timestamps"]
+    odometry = result["odometry"]
+    gps = result["gps"]
 
     print("Computing error..."),
     start = time.time()
-    err = get_error(timestamps, odometry[:, [0, 1]].T, timestamps_gps, gps[:, ::-1].T).T
-    err_yaw = get_error(timestamps, odometry[:, 3], timestamps_imu, imu.T).T
+    err, err_yaw = errors(result)
     stop = time.time()
     print("[DONE] %.3fs" % (stop - start))
-    sigma = get_sigma(odometry_cov)
+    sigma = get_sigma(result["odometry_cov"])
 
     timestamps = timestamps - timestamps[0]
     fig1 = plot_error(
@@ -0,0 +1,165 @@
+import csv
+import itertools
+import copy
+import time
+import numpy as np
+from multiprocessing import Pool, cpu_count
+from util import o2ca2_dataset as dataset
+from util.util import normalize
+import odometry
+
+
+# dataset shared with the (forked) workers, loaded once by sweep()
+_dataset = None
+
+
+def grid(overrides):
+    """Cartesian product of configuration overrides.
+
+    :param overrides: values to try for each 'config.key', e.g.
+        {'ekf.stdev_velocity_model': [v1, v2], 'dvl.gate': [None, 9]}
+    :type overrides: dictionary of lists
+    :return: one dictionary of {'config.key': value} per run
+    :rtype: list of dictionaries
+    """
+    keys = sorted(overrides)
+    return [dict(zip(keys, values)) for values in itertools.product(*[overrides[k] for k in keys])]
+
+
+def configure(overrides):
+    """Returns odometry.run keyword arguments with the overrides applied
+    to copies of the default configurations of odometry.py."""
+    configs = {
+        "dvl_config": copy.deepcopy(odometry.dvl_config),
+        "imu_config": copy.deepcopy(odometry.imu_config),
+        "mis_config": copy.deepcopy(odometry.mis_config),
+        "ekf_config": copy.deepcopy(odometry.ekf_config)
+        }
+    for k, v in overrides.items():
+        name, key = k.split(".", 1)
+        configs[name + "_config"][key] = v
+    return configs
+
+
+def rms_error(result):
+    """RMS of the XY error respect to the gps and yaw error
+    respect to the imu of an odometry.run result"""
+    err, err_yaw = odometry.errors(result)
+    rms_xy = np.sqrt(np.nanmean(err**2, axis=0))
+    rms_yaw = np.sqrt(np.nanmean(normalize(err_yaw)**2))
+    return (rms_xy[0], rms_xy[1], rms_yaw)
+
+
+def evaluate(overrides):
+    """Pool worker: runs the filter with a set of overrides on the
+    shared dataset"""
+    start = time.time()
+    try:
+        rms_x, rms_y, rms_yaw = rms_error(odometry.run(_dataset, **configure(overrides)))
+        error = ""
+    except Exception as e:
+        rms_x = rms_y = rms_yaw = np.nan
+        error = repr(e)
+
+    row = dict(overrides)
+    row.update({
+        "rms_x": rms_x, "rms_y": rms_y, "rms_yaw": rms_yaw,
+        "time": time.time() - start, "error": error})
+    return row
+
+
+def evaluate_batch(runs):
+    """Pool worker: runs the filters of several sets of overrides
+    together (odometry.run_batch) on the shared dataset, the time of
+    each run is its share of the batch"""
+    start = time.time()
+    try:
+        errors = [rms_error(r) for r in odometry.run_batch(_dataset, [configure(o) for o in runs])]
+        error = ""
+    except Exception as e:
+        errors = [(np.nan, np.nan, np.nan)] * len(runs)
+        error = repr(e)
+
+    elapsed = (time.time() - start) / len(runs)
+    rows = []
+    for overrides, (rms_x, rms_y, rms_yaw) in zip(runs, errors):
+        row = dict(overrides)
+        row.update({
+            "rms_x": rms_x, "rms_y": rms_y, "rms_yaw": rms_yaw,
+            "time": elapsed, "error": error})
+        rows.append(row)
+    return rows
+
+
+def sweep(D, overrides, processes=None, batched=False):
+    """Runs the filter for every combination of overrides in a process
+    pool. The dataset is shared with the workers by fork, not pickled.
+
+    :param D: dataset
+    :param overrides: values to try for each 'config.key' (see grid)
+    :param processes: number of processes, all the cores if None
+    :param batched: each process runs its share of the combinations in
+        a single replay of the dataset (see odometry.run_batch) instead
+        of one replay per combination
+    :type D: O2CA2Dataset
+    :type overrides: dictionary of lists
+    :type processes: integer > 0
+    :type batched: bool
+    :return: overrides, errors and time of each run
+    :rtype: list of dictionaries
+    """
+    global _dataset
+    _dataset = D
+
+    pool = Pool(processes)
+    try:
+        runs = grid(overrides)
+        if not batched:
+            return pool.map(evaluate, runs, chunksize=1)
+        n = min(processes or cpu_count(), len(runs))
+        chunks = [runs[i::n] for i in range(n)]
+        rows = pool.map(evaluate_batch, chunks, chunksize=1)
+        # back to the grid order
+        return [rows[i % n][i // n] for i in range(len(runs))]
+    finally:
+        pool.close()
+        pool.join()
+        _dataset = None
+
+
+def write_csv(filename, rows):
+    """Writes sweep results, arrays as space separated values"""
+    def fmt(v):
+        if isinstance(v, np.ndarray):
+            return " ".join(repr(e) for e in v.ravel().tolist())
+        return v
+
+    keys = sorted(set(k for r in rows for k in r))
+    with open(filename, "w") as f:
+        writer = csv.DictWriter(f, keys)
+        writer.writeheader()
+        for r in rows:
+            writer.writerow({k: fmt(v) for k, v in r.items()})
+
+
+def main():
+    import sys
+    batched = "--batched" in sys.argv[1:]
+    args = [a for a in sys.argv[1:] if a != "--batched"]
+    output = args[0] if args else "sweep.csv"
+
+    # example grid, model noise on u, v, w, r and dvl gating
+    model = odometry.ekf_config["stdev_velocity_model"]
+    overrides = {
+        "ekf.stdev_velocity_model": [model * k for k in [0.5, 1, 2]],
+        "dvl.gate": [None, 9.0, 16.0]
+        }
+
+    D = dataset.O2CA2Dataset(odometry.filenames, cache=True)
+    start = time.time()
+    rows = sweep(D, overrides, batched=batched)
+    print("%d runs in %.3fs" % (len(rows), time.time() - start))
+    write_csv(output, rows)
+
+if __name__ == "__main__":
+    main()
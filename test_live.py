@@ -0,0 +1,30 @@
+import unittest
+import numpy as np
+import live
+
+
+class LiveTest(unittest.TestCase):
+    def test_run_metrics(self):
+        def sources(queue):
+            # rows already waiting when the merger starts
+            for t in [1.0, 2.0, 3.0]:
+                queue.put(("mis", np.array([t, 0]), 0.0))
+            queue.put(("mis", None, 0.0))
+            return []
+
+        odometry, metrics = live.run(sources, ["mis"])
+        summary = metrics.summary()
+        self.assertEqual(summary["received"], 3)
+        self.assertEqual(summary["processed"], 3)
+        self.assertGreater(summary["depth_max"], 0)
+        self.assertGreater(summary["depth_mean"], 0)
+
+    def test_gps_history(self):
+        odometry = live.LiveOdometry(gps_history=2)
+        for t in [1.0, 2.0, 3.0]:
+            self.assertTrue(odometry.process("gps", np.array([t, 4212.225, 306.2832, 1, -2.1])))
+        self.assertEqual([g[0] for g in odometry.gps], [2.0, 3.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+import numpy as np
+from util import o2ca2_dataset as dataset
+import odometry
+import sweep
+
+
+class RunBatchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # first minutes of experiment3, with gps fixes
+        D = dataset.O2CA2Dataset(odometry.filenames)
+        data = dict(zip(D.keys, next(D.iter_blocks())[0]))
+        end = data["dvl"][0, 0] + 300
+        cls.D = dataset.O2CA2Dataset.from_arrays(
+            dict((k, v[v[:, 0] < end]) for k, v in data.items()))
+
+    def test_matches_scalar_runs(self):
+        model = odometry.ekf_config["stdev_velocity_model"]
+        pose = odometry.dvl_config["pose"] + np.array([0, 0, 0, 0, 0, 0.1])
+        configs = [sweep.configure(o) for o in [
+            {},
+            {"ekf.stdev_velocity_model": model * 2},
+            {"dvl.gate": 9.0},
+            {"dvl.pose": pose, "dvl.gate": 4.0, "imu.stdev_orientation": np.array([np.nan, np.nan, 0.1])}
+            ]]
+        results = odometry.run_batch(self.D, configs, covariances=True)
+        self.assertEqual(len(results), len(configs))
+
+        for config, result in zip(configs, results):
+            expected = odometry.run(self.D, **config)
+            self.assertGreater(len(expected["gps"]), 0)
+            for k in sorted(expected):
+                np.testing.assert_allclose(result[k], expected[k], rtol=1e-9, atol=1e-9, err_msg=k)
+            np.testing.assert_allclose(sweep.rms_error(result), sweep.rms_error(expected), rtol=1e-9)
+
+    def test_default_configs(self):
+        result = odometry.run_batch(self.D, [{}])[0]
+        expected = odometry.run(self.D)
+        np.testing.assert_allclose(result["odometry"], expected["odometry"], rtol=1e-9, atol=1e-9)
+        self.assertNotIn("odometry_cov", result)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,293 @@
+import time
+import heapq
+import threading
+from collections import deque
+from Queue import Empty
+import numpy as np
+
+""" Live ingestion of O2CA2 sensor streams. Each stream is read by its
+    own thread that parses lines into rows and puts them in a bounded
+    queue, which blocks the readers when the consumer falls behind
+    (backpressure). A Merger pops the queue and releases the rows in
+    timestamp order within a reorder window.
+"""
+
+
+def parse_line(line, comments="%", delimiter=" "):
+    """ Parses a log line.
+
+    :return: row or None for comments and empty lines
+    :rtype: 1d array
+    """
+    line = line.split(comments, 1)[0].strip()
+    if not line:
+        return None
+    if delimiter.strip():
+        line = line.replace(delimiter, " ")
+    return np.fromstring(line, sep=" ")
+
+
+class Source(threading.Thread):
+    """Thread that reads the lines of one sensor into a queue as
+    (id, row, arrival time) and (id, None, time) at the end"""
+    def __init__(self, key, queue, comments="%", delimiter=" "):
+        super(Source, self).__init__(name="source-%s" % key)
+        self.daemon = True
+        self.key = key
+        self.queue = queue
+        self.comments = comments
+        self.delimiter = delimiter
+        self._stop_event = threading.Event()
+
+    def lines(self):
+        """Iterator of text lines"""
+        raise NotImplementedError
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run(self):
+        try:
+            for line in self.lines():
+                if self.stopped():
+                    break
+                row = parse_line(line, self.comments, self.delimiter)
+                if row is not None:
+                    self.queue.put((self.key, row, time.time()))
+        finally:
+            self.queue.put((self.key, None, time.time()))
+
+
+class StreamSource(Source):
+    """Reads lines from a file object, e.g. a pipe or socket.makefile()"""
+    def __init__(self, key, queue, stream, **kwargs):
+        super(StreamSource, self).__init__(key, queue, **kwargs)
+        self.stream = stream
+
+    def lines(self):
+        return iter(self.stream.readline, "")
+
+
+class TailSource(Source):
+    """Follows a file as it grows (as tail -f). Ends when stopped or
+    after idle seconds without new lines, if set."""
+    def __init__(self, key, queue, filename, poll=0.05, idle=None, **kwargs):
+        super(TailSource, self).__init__(key, queue, **kwargs)
+        self.filename = filename
+        self.poll = poll
+        self.idle = idle
+
+    def lines(self):
+        with open(self.filename) as f:
+            last = time.time()
+            partial = ""
+            while not self.stopped():
+                line = f.readline()
+                if line:
+                    partial += line
+                    if partial.endswith("\n"):
+                        yield partial
+                        partial = ""
+                    last = time.time()
+                elif self.idle is not None and time.time() - last > self.idle:
+                    break
+                else:
+                    time.sleep(self.poll)
+
+
+class ReplayClock(object):
+    """Shared clock of the replayed logs: log time t0 is now and
+    'speed' log seconds pass every second (as fast as possible if
+    speed is None)"""
+    def __init__(self, t0, speed=1.0):
+        self.t0 = t0
+        self.speed = speed
+        self.start = time.time()
+
+    def wait(self, t):
+        if self.speed is None:
+            return
+        delay = (t - self.t0) / self.speed - (time.time() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ReplaySource(Source):
+    """Replays a log file at the pace of a ReplayClock"""
+    def __init__(self, key, queue, filename, clock, **kwargs):
+        super(ReplaySource, self).__init__(key, queue, **kwargs)
+        self.filename = filename
+        self.clock = clock
+
+    def lines(self):
+        with open(self.filename) as f:
+            for line in f:
+                row = parse_line(line, self.comments, self.delimiter)
+                if row is not None:
+                    self.clock.wait(row[0])
+                yield line
+
+
+def first_timestamp(filename, comments="%", delimiter=" "):
+    """Timestamp of the first row of a log"""
+    with open(filename) as f:
+        for line in f:
+            row = parse_line(line, comments, delimiter)
+            if row is not None:
+                return row[0]
+    return None
+
+
+def replay(filenames, queue, speed=1.0):
+    """ Stand-in for the vehicle: sources that replay logs at real
+    (speed 1) or accelerated speed, all with the same clock.
+
+    :param filenames: filenames of the dataset
+    :param queue: queue shared by the sources
+    :param speed: log seconds per second, as fast as possible if None
+    :type filenames: dictionary of form {'id':filename}
+    :return: sources, not started
+    :rtype: list of ReplaySource
+    """
+    t0 = min(t for t in (first_timestamp(fn) for fn in filenames.values()) if t is not None)
+    clock = ReplayClock(t0, speed)
+    return [ReplaySource(k, queue, fn, clock) for k, fn in sorted(filenames.items())]
+
+
+class Metrics(object):
+    """Message counts, queue depth and end-to-end latency (arrival of
+    a line to the end of its processing)"""
+    def __init__(self, size=10000):
+        self.received = 0
+        self.processed = 0
+        self.late = 0
+        self.max_depth = 0
+        self._depth = deque(maxlen=size)
+        self._latency = deque(maxlen=size)
+        self.start = time.time()
+
+    def depth(self, depth):
+        self._depth.append(depth)
+        self.max_depth = max(self.max_depth, depth)
+
+    def done(self, arrival):
+        self.processed += 1
+        self._latency.append(time.time() - arrival)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """ Summary of the last samples.
+
+        :return: counts, rate (msgs/s), mean and max queue depth and
+            latency percentiles (s)
+        :rtype: dictionary
+        """
+        elapsed = time.time() - self.start
+        latency = np.percentile(self._latency, percentiles) if self._latency else [np.nan]*len(percentiles)
+        result = {
+            "received": self.received, "processed": self.processed, "late": self.late,
+            "rate": self.processed / elapsed if elapsed > 0 else np.nan,
+            "depth_mean": np.mean(self._depth) if self._depth else 0.0,
+            "depth_max": self.max_depth}
+        for p, l in zip(percentiles, latency):
+            result["latency_p%d" % p] = l
+        return result
+
+
+class Merger(object):
+    def __init__(self, queue, keys, window=0.5, max_pending=100000, metrics=None):
+        """ Merges the rows of several sources in timestamp order. Each
+        source is assumed to be in order, so a row is released once
+        every active source has received a row as new as it. A source
+        is not waited for when the queue is empty and it has been silent
+        for 'window' seconds (wall time). Rows older than the last
+        released one are still released but counted as late. Rows with
+        the same timestamp are released in the order of keys (as the
+        offline merge of O2CA2Dataset for sorted keys).
+
+        :param queue: queue of the sources
+        :param keys: ids of the sources
+        :param window: seconds of silence after which a source is not
+            waited for
+        :param max_pending: max rows waiting, the oldest are released
+            when there are more
+        :param metrics: metrics to update
+        :type keys: list of strings
+        :type window: float
+        :type max_pending: integer > 0
+        :type metrics: Metrics
+        """
+        self.queue = queue
+        now = time.time()
+        self._watermark = dict((k, -np.inf) for k in keys)
+        self._rank = dict((k, i) for i, k in enumerate(keys))
+        self._last = dict((k, now) for k in keys)
+        self.window = window
+        self.max_pending = max_pending
+        self.metrics = metrics or Metrics()
+        self._heap = []
+        self._seq = 0
+        self._released = -np.inf
+
+    def finished(self):
+        return not self._watermark and not self._heap
+
+    def _push(self, item):
+        key, row, arrival = item
+        if row is None:
+            self._watermark.pop(key, None)
+            return
+        self.metrics.received += 1
+        t = row[0]
+        self._watermark[key] = max(self._watermark.get(key, -np.inf), t)
+        self._last[key] = arrival
+        heapq.heappush(self._heap, (t, self._rank.get(key, len(self._rank)), self._seq, key, row, arrival))
+        self._seq += 1
+
+    def _limit(self, drained):
+        """Newest timestamp that every source has reached"""
+        if drained:
+            # sources that are not blocked by backpressure and silent
+            deadline = time.time() - self.window
+            marks = [v for k, v in self._watermark.items() if self._last[k] > deadline]
+        else:
+            marks = self._watermark.values()
+        return min(marks) if marks else np.inf
+
+    def poll(self, timeout=None):
+        """ Waits up to timeout seconds for new rows and returns the
+        released ones.
+
+        :return: (id, row, arrival time) in timestamp order
+        :rtype: list of 3-element tuples
+        """
+        self.metrics.depth(self.queue.qsize())
+        drained = True
+        if self._watermark:
+            try:
+                self._push(self.queue.get(timeout=timeout))
+                for i in range(self.queue.qsize()):
+                    self._push(self.queue.get_nowait())
+                drained = self.queue.empty()
+            except Empty:
+                pass
+
+        limit = self._limit(drained)
+        released = []
+        while self._heap:
+            t, _, _, key, row, arrival = self._heap[0]
+            if t > limit and len(self._heap) <= self.max_pending:
+                break
+            heapq.heappop(self._heap)
+            if t < self._released:
+                self.metrics.late += 1
+            self._released = max(self._released, t)
+            released.append((key, row, arrival))
+        return released
+
+    def __iter__(self):
+        while not self.finished():
+            for item in self.poll(timeout=0.1):
+                yield item
@@ -84,6 +84,127 @@ def inv(a, Pa=None):
     return (r, P)
 
 
+def compose_jacobians(a, b):
+    """Jacobians of the 3dof composition of arrays of poses 'a' and 'b'
+    respect to 'a' and 'b'. Leading dimensions are broadcast.
+
+    :param a: [x, y, theta] poses
+    :param b: [x, y, theta] poses or [x, y] points
+    :type a: (..., 3) array
+    :type b: (..., 3) or (..., 2) array
+    :return: Jacobians respect to 'a' and 'b'
+    :rtype: 2-element tuple ((..., k, 3) array, (..., k, k) array), k = 2 or 3
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    st = np.sin(a[..., 2])
+    ct = np.cos(a[..., 2])
+    shape = np.broadcast(a[..., 0], b[..., 0]).shape
+    k = b.shape[-1]
+
+    J1 = np.zeros(shape + (k, 3))
+    J1[..., 0, 0] = 1
+    J1[..., 1, 1] = 1
+    J1[..., 0, 2] = -b[..., 0]*st - b[..., 1]*ct
+    J1[..., 1, 2] = b[..., 0]*ct - b[..., 1]*st
+
+    J2 = np.zeros(shape + (k, k))
+    J2[..., 0, 0] = ct
+    J2[..., 0, 1] = -st
+    J2[..., 1, 0] = st
+    J2[..., 1, 1] = ct
+    if k == 3:
+        J1[..., 2, 2] = 1
+        J2[..., 2, 2] = 1
+    return (J1, J2)
+
+
+def compose_batch(a, b, Pa=None, Pb=None):
+    """3dof [x, y, theta] composition of arrays of poses 'a' and 'b'
+    with covariance -if provided. Leading dimensions are broadcast,
+    e.g. a trajectory (N, 3) composed with a pose (3,) or a single pose
+    (3,) composed with a scan of points (M, 2).
+
+    :param a: [x, y, theta] poses
+    :param b: [x, y, theta] poses or [x, y] points
+    :param Pa: a covariances
+    :param Pb: b covariances
+    :type a: (..., 3) array
+    :type b: (..., 3) or (..., 2) array
+    :type Pa: (..., 3, 3) array
+    :type Pb: (..., 3, 3) or (..., 2, 2) array
+    :return: composition with covariance -if provided
+    :rtype: 2-element tuple (r, P) or (r, None)
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    st = np.sin(a[..., 2])
+    ct = np.cos(a[..., 2])
+
+    r = [b[..., 0]*ct - b[..., 1]*st + a[..., 0],
+         b[..., 0]*st + b[..., 1]*ct + a[..., 1]]
+    if b.shape[-1] == 3:
+        r.append(normalize(a[..., 2] + b[..., 2]))
+    r = np.stack(np.broadcast_arrays(*r), axis=-1)
+
+    P = None
+    if Pa is not None and Pb is not None:
+        J1, J2 = compose_jacobians(a, b)
+        P = np.matmul(np.matmul(J1, Pa), np.swapaxes(J1, -1, -2)) + \
+            np.matmul(np.matmul(J2, Pb), np.swapaxes(J2, -1, -2))
+    return (r, P)
+
+
+def inv_jacobian(a):
+    """Jacobian of the 3dof inversion of an array of poses 'a'.
+
+    :param a: [x, y, theta] poses
+    :type a: (..., 3) array
+    :return: Jacobian respect to 'a'
+    :rtype: (..., 3, 3) array
+    """
+    a = np.asarray(a, dtype=float)
+    st = np.sin(a[..., 2])
+    ct = np.cos(a[..., 2])
+
+    J = np.zeros(a.shape + (3,))
+    J[..., 0, 0] = -ct
+    J[..., 0, 1] = -st
+    J[..., 0, 2] = a[..., 0]*st - a[..., 1]*ct
+    J[..., 1, 0] = st
+    J[..., 1, 1] = -ct
+    J[..., 1, 2] = a[..., 0]*ct + a[..., 1]*st
+    J[..., 2, 2] = -1
+    return J
+
+
+def inv_batch(a, Pa=None):
+    """3dof [x, y, theta] inversion of an array of poses 'a' with
+    covariance -if provided.
+
+    :param a: [x, y, theta] poses
+    :param Pa: a covariances
+    :type a: (..., 3) array
+    :type Pa: (..., 3, 3) array
+    :return: inversion with covariance -if provided
+    :rtype: 2-element tuple (r, P) or (r, None)
+    """
+    a = np.asarray(a, dtype=float)
+    st = np.sin(a[..., 2])
+    ct = np.cos(a[..., 2])
+
+    r = np.stack([
+        -a[..., 0]*ct - a[..., 1]*st,
+        a[..., 0]*st - a[..., 1]*ct,
+        -a[..., 2]], axis=-1)
+
+    P = None
+    if Pa is not None:
+        J = inv_jacobian(a)
+        P = np.matmul(np.matmul(J, Pa), np.swapaxes(J, -1, -2))
+    return (r, P)
+
+
 def main():
     a = np.array([2.0, 2.0, np.pi])
     Pa = np.diag([0.1, 0.1, 0.1])
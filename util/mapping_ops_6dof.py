@@ -102,6 +102,158 @@ def inv(a, Pa=None):
     return (r, P)
 
 
+def _trig(a):
+    """sin/cos of roll, pitch and yaw of an array of poses"""
+    return (np.sin(a[..., 3]), np.cos(a[..., 3]), np.sin(a[..., 4]), np.cos(a[..., 4]),
+            np.sin(a[..., 5]), np.cos(a[..., 5]))
+
+
+def compose_jacobians(a, b):
+    """Jacobians of the 6DoF composition of arrays of poses 'a' and 'b'
+    respect to 'a' and 'b'. Leading dimensions are broadcast.
+
+    :param a: [x, y, z, roll, pitch, yaw] poses
+    :param b: [x, y, z, roll, pitch, yaw] poses or [x, y, z] points
+    :type a: (..., 6) array
+    :type b: (..., 6) or (..., 3) array
+    :return: Jacobians respect to 'a' and 'b'
+    :rtype: 2-element tuple ((..., k, 6) array, (..., k, k) array), k = 3 or 6
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    sr, cr, sp, cp, sy, cy = _trig(a)
+    b0, b1, b2 = b[..., 0], b[..., 1], b[..., 2]
+    shape = np.broadcast(a[..., 0], b0).shape
+    k = b.shape[-1]
+
+    Ja = np.zeros(shape + (k, 6))
+    Ja[..., 0, 0] = Ja[..., 1, 1] = Ja[..., 2, 2] = 1
+    Ja[..., 0, 3] = b1*(sp*cr*cy + sr*sy) + b2*(-sp*sr*cy + sy*cr)
+    Ja[..., 0, 4] = -b0*sp*cy + b1*sr*cp*cy + b2*cp*cr*cy
+    Ja[..., 0, 5] = -b0*sy*cp + b1*(-sp*sr*sy - cr*cy) + b2*(-sp*sy*cr + sr*cy)
+    Ja[..., 1, 3] = b1*(sp*sy*cr - sr*cy) + b2*(-sp*sr*sy - cr*cy)
+    Ja[..., 1, 4] = -b0*sp*sy + b1*sr*sy*cp + b2*sy*cp*cr
+    Ja[..., 1, 5] = b0*cp*cy + b1*(sp*sr*cy - sy*cr) + b2*(sp*cr*cy + sr*sy)
+    Ja[..., 2, 3] = b1*cp*cr - b2*sr*cp
+    Ja[..., 2, 4] = -b0*cp - b1*sp*sr - b2*sp*cr
+
+    Jb = np.zeros(shape + (k, k))
+    Jb[..., 0, 0] = cp*cy
+    Jb[..., 0, 1] = sp*sr*cy - sy*cr
+    Jb[..., 0, 2] = sp*cr*cy + sr*sy
+    Jb[..., 1, 0] = sy*cp
+    Jb[..., 1, 1] = sp*sr*sy + cr*cy
+    Jb[..., 1, 2] = sp*sy*cr - sr*cy
+    Jb[..., 2, 0] = -sp
+    Jb[..., 2, 1] = sr*cp
+    Jb[..., 2, 2] = cp*cr
+    if k == 6:
+        Ja[..., 3, 3] = Ja[..., 4, 4] = Ja[..., 5, 5] = 1
+        Jb[..., 3, 3] = Jb[..., 4, 4] = Jb[..., 5, 5] = 1
+    return (Ja, Jb)
+
+
+def compose_batch(a, b, Pa=None, Pb=None):
+    """6DoF composition of arrays of poses 'a' and 'b' with covariance
+    -if provided. Leading dimensions are broadcast, e.g. a trajectory
+    (N, 6) composed with a pose (6,) or a single pose (6,) composed
+    with a set of points (M, 3).
+
+    :param a: [x, y, z, roll, pitch, yaw] poses
+    :param b: [x, y, z, roll, pitch, yaw] poses or [x, y, z] points
+    :param Pa: a covariances
+    :param Pb: b covariances
+    :type a: (..., 6) array
+    :type b: (..., 6) or (..., 3) array
+    :type Pa: (..., 6, 6) array
+    :type Pb: (..., 6, 6) or (..., 3, 3) array
+    :return: composition with covariance -if provided
+    :rtype: 2-element tuple (r, P) or (r, None)
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    sr, cr, sp, cp, sy, cy = _trig(a)
+    b0, b1, b2 = b[..., 0], b[..., 1], b[..., 2]
+
+    r = [a[..., 0] + b0*cp*cy + b1*(sp*sr*cy - sy*cr) + b2*(sp*cr*cy + sr*sy),
+         b0*sy*cp + a[..., 1] + b1*(sp*sr*sy + cr*cy) + b2*(sp*sy*cr - sr*cy),
+         -b0*sp + b1*sr*cp + a[..., 2] + b2*cp*cr]
+    if b.shape[-1] == 6:
+        r.extend(normalize(a[..., i] + b[..., i]) for i in [3, 4, 5])
+    r = np.stack(np.broadcast_arrays(*r), axis=-1)
+
+    P = None
+    if Pa is not None and Pb is not None:
+        Ja, Jb = compose_jacobians(a, b)
+        P = np.matmul(np.matmul(Ja, Pa), np.swapaxes(Ja, -1, -2)) + \
+            np.matmul(np.matmul(Jb, Pb), np.swapaxes(Jb, -1, -2))
+    return (r, P)
+
+
+def inv_jacobian(a):
+    """Jacobian of the 6DoF inversion of an array of poses 'a'.
+
+    :param a: [x, y, z, roll, pitch, yaw] poses
+    :type a: (..., 6) array
+    :return: Jacobian respect to 'a'
+    :rtype: (..., 6, 6) array
+    """
+    a = np.asarray(a, dtype=float)
+    sr, cr, sp, cp, sy, cy = _trig(a)
+    a0, a1, a2 = a[..., 0], a[..., 1], a[..., 2]
+
+    J = np.zeros(a.shape + (6,))
+    J[..., 0, 0] = -cp*cy
+    J[..., 0, 1] = -sp*sr*cy - sy*cr
+    J[..., 0, 2] = sp*cr*cy - sr*sy
+    J[..., 0, 3] = -a1*(sp*cr*cy - sr*sy) - a2*(sp*sr*cy + sy*cr)
+    J[..., 0, 4] = a0*sp*cy - a1*sr*cp*cy + a2*cp*cr*cy
+    J[..., 0, 5] = a0*sy*cp - a1*(-sp*sr*sy + cr*cy) - a2*(sp*sy*cr + sr*cy)
+    J[..., 1, 0] = sy*cp
+    J[..., 1, 1] = sp*sr*sy - cr*cy
+    J[..., 1, 2] = -sp*sy*cr - sr*cy
+    J[..., 1, 3] = -a1*(-sp*sy*cr - sr*cy) - a2*(-sp*sr*sy + cr*cy)
+    J[..., 1, 4] = -a0*sp*sy + a1*sr*sy*cp - a2*sy*cp*cr
+    J[..., 1, 5] = a0*cp*cy - a1*(-sp*sr*cy - sy*cr) - a2*(sp*cr*cy - sr*sy)
+    J[..., 2, 0] = -sp
+    J[..., 2, 1] = sr*cp
+    J[..., 2, 2] = -cp*cr
+    J[..., 2, 3] = a1*cp*cr + a2*sr*cp
+    J[..., 2, 4] = -a0*cp - a1*sp*sr + a2*sp*cr
+    J[..., 3, 3] = J[..., 4, 4] = J[..., 5, 5] = -1
+    return J
+
+
+def inv_batch(a, Pa=None):
+    """6DoF inversion of an array of poses 'a' with covariance
+    -if provided.
+
+    :param a: [x, y, z, roll, pitch, yaw] poses
+    :param Pa: a covariances
+    :type a: (..., 6) array
+    :type Pa: (..., 6, 6) array
+    :return: inversion with covariance -if provided
+    :rtype: 2-element tuple (r, P) or (r, None)
+    """
+    a = np.asarray(a, dtype=float)
+    sr, cr, sp, cp, sy, cy = _trig(a)
+    a0, a1, a2 = a[..., 0], a[..., 1], a[..., 2]
+
+    r = np.stack([
+        -a0*cp*cy - a1*(sp*sr*cy + sy*cr) - a2*(-sp*cr*cy + sr*sy),
+        a0*sy*cp - a1*(-sp*sr*sy + cr*cy) - a2*(sp*sy*cr + sr*cy),
+        -a0*sp + a1*sr*cp - a2*cp*cr,
+        -a[..., 3],
+        -a[..., 4],
+        -a[..., 5]], axis=-1)
+
+    P = None
+    if Pa is not None:
+        J = inv_jacobian(a)
+        P = np.matmul(np.matmul(J, Pa), np.swapaxes(J, -1, -2))
+    return (r, P)
+
+
 def main():
     a = np.array([2, 2, 2, np.pi, np.pi, np.pi])
     Pa = np.diag([0.1, 0.1, 0.1, 0.1, 0.1, 0.1])
@@ -1,4 +1,5 @@
 import util
+import utm
 import numpy as np
 
 """ 8-state [x, y ,z, yaw, u, v, w, r] measurements from O2CA2 datasets
@@ -7,6 +8,52 @@ import numpy as np
     information
 """
 
+# state elements observed by each sensor
+DVL_INDEX = np.array([4, 5, 6, 2])
+IMU_INDEX = np.array([3])
+
+
+def selection(index, size=8):
+    """Returns the observation model H that selects the state elements
+    in index. The array is read-only as it is shared between calls."""
+    H = np.zeros((len(index), size))
+    H[np.arange(len(index)), index] = 1
+    H.setflags(write=False)
+    return H
+
+
+_DVL_H = selection(DVL_INDEX)
+_IMU_H = selection(IMU_INDEX)
+_covariances = {}
+_rotations = {}
+_projections = {}
+
+
+def diagonal_covariance(stdev):
+    """Returns the (read-only) covariance diag(stdev**2), cached
+    as measurement noise is constant for a given configuration."""
+    key = stdev.tobytes()
+    try:
+        return _covariances[key]
+    except KeyError:
+        R = np.diag(stdev**2)
+        R.setflags(write=False)
+        _covariances[key] = R
+        return R
+
+
+def mount_rotation(pose):
+    """Returns the (read-only) rotation matrix of a sensor mount
+    [x, y, z, roll, pitch, yaw], cached as sensor poses are fixed."""
+    key = np.asarray(pose[3:6], dtype=float).tobytes()
+    try:
+        return _rotations[key]
+    except KeyError:
+        R = util.rpy(pose[3], pose[4], pose[5])
+        R.setflags(write=False)
+        _rotations[key] = R
+        return R
+
 
 def imu(msg, pose, stdev):
     """Returns IMU measurement z, observation model H and
@@ -18,7 +65,7 @@ def imu(msg, pose, stdev):
     :type msg: 1d array
     :type pose: 1d array
     :type stdev: dictionary of type (key: 4-element array)
-    :return: (z, H, R)
+    :return: (z, H, R), H selects the elements in IMU_INDEX
     :rtype: 3-element tuple
     """
 
@@ -36,9 +83,8 @@ def imu(msg, pose, stdev):
 
     # lower error. still don't know why
     z = np.array([orientation[2]])
-    H = np.array([
-        [0, 0, 0, 1, 0, 0, 0, 0]], dtype=float)
-    R = np.diag([stdev[0]**2])
+    H = _IMU_H
+    R = diagonal_covariance(stdev[0:1])
     return (z, H, R)
 
 
@@ -52,35 +98,127 @@ def dvl(msg, pose, stdev):
     :type msg: 1d array
     :type pose: 1d array
     :type stdev: dictionary of type (key: 4-element array)
-    :return: (z, H, R)
+    :return: (z, H, R), H selects the elements in DVL_INDEX
     :rtype: 3-element tuple
     """
 
     # bottom velocity
     if msg[14] == 1:
-        rpy = util.rpy(pose[3], pose[4], pose[5])
+        rpy = mount_rotation(pose)
         vel_dvl = msg[11:14] / 100.
-        cov = stdev["bottom"]**2
+        R = diagonal_covariance(stdev["bottom"])
     else:  # water velocity
         rot = msg[24:21:-1] * np.pi / 180
         rpy = util.rpy(rot[0], rot[1], rot[2])
         vel_dvl = msg[7:10] / 100
-        cov = stdev["water"]**2
+        R = diagonal_covariance(stdev["water"])
 
-    vel_base = np.dot(rpy, np.c_[vel_dvl]).T[0]
+    vel_base = np.dot(rpy, vel_dvl)
     depth = 0.003772250*(msg[26]-1440)
 
     z = np.r_[vel_base, depth]
-    H = np.array([
-        [0, 0, 0, 0, 1, 0, 0, 0],
-        [0, 0, 0, 0, 0, 1, 0, 0],
-        [0, 0, 0, 0, 0, 0, 1, 0],
-        [0, 0, 1, 0, 0, 0, 0, 0]], dtype=float)
-    R = np.diag(cov)
+    H = _DVL_H
 
     return (z, H, R)
 
 
+def imu_batch(data, pose, stdev):
+    """Returns the IMU measurements of a whole log at once, as imu
+    does for each message.
+
+    :param data: O2CA2 dataset imu log
+    :param pose: imu pose [x, y, z, roll, pitch, yaw] from the robot 0
+    :param stdev: standard devidation of the measurements
+    :type data: 2d array
+    :type pose: 1d array
+    :type stdev: 2-element array
+    :return: (z, R), z[i] and R[i] are the measurement of data[i]
+    :rtype: 2-element tuple ((N, 1) array, (N, 1, 1) read-only array)
+    """
+    z = util.normalize(data[:, 3:4]*np.pi/180 + pose[5])
+    R = np.broadcast_to(diagonal_covariance(stdev[0:1]), (len(data), 1, 1))
+    return (z, R)
+
+
+def dvl_batch(data, pose, stdev):
+    """Returns the DVL measurements of a whole log at once, as dvl
+    does for each message.
+
+    :param data: O2CA2 dataset dvl log
+    :param pose: dvl pose [x, y, z, roll, pitch, yaw] from the robot 0
+    :param stdev: standard devidation of the measurements
+    :type data: 2d array
+    :type pose: 1d array
+    :type stdev: dictionary of type (key: 4-element array)
+    :return: (z, R, bottom), z[i] and R[i] are the measurement of
+        data[i] and bottom[i] is True if it is bottom velocity
+    :rtype: 3-element tuple ((N, 4) array, (N, 4, 4) array, (N,) bool array)
+    """
+    bottom = data[:, 14] == 1
+
+    # bottom velocity in the dvl mount frame, water velocity in the
+    # frame given by the message attitude
+    rot = data[:, 24:21:-1] * np.pi / 180
+    rpy = util.rpy(rot[:, 0], rot[:, 1], rot[:, 2])
+    rpy[bottom] = mount_rotation(pose)
+    vel_dvl = np.where(bottom[:, None], data[:, 11:14], data[:, 7:10]) / 100.
+    vel_base = np.matmul(rpy, vel_dvl[:, :, None])[:, :, 0]
+    depth = 0.003772250*(data[:, 26]-1440)
+
+    z = np.c_[vel_base, depth]
+    R = np.where(bottom[:, None, None],
+                 diagonal_covariance(stdev["bottom"]), diagonal_covariance(stdev["water"]))
+    return (z, R, bottom)
+
+
+def nmea_to_degrees(value):
+    """Returns NMEA ddmm.mmmm coordinates in decimal degrees."""
+    value = np.asarray(value) / 100.
+    degrees = np.floor(value)
+    return degrees + (value - degrees)*100/60
+
+
+def projection(proj='utm', zone='31T', datum='WGS84'):
+    """Returns a pyproj projection, cached as building one is
+    expensive. None if pyproj is not available."""
+    key = (proj, zone, datum)
+    try:
+        return _projections[key]
+    except KeyError:
+        pass
+    try:
+        from pyproj import Proj
+    except ImportError:
+        # cached too, so the import is not retried on every fix
+        _projections[key] = None
+        return None
+    _projections[key] = Proj(proj=proj, zone=zone, datum=datum)
+    return _projections[key]
+
+
+def gps_batch(data, proj='utm', zone='31T', datum='WGS84'):
+    """Returns the gps coordinates of a whole log at once in Eastings
+    and Northings. Falls back to utm.project when pyproj is not
+    available.
+
+    :param data: O2CA2 dataset gps log
+    :param proj: projection type
+    :param zone: UTM zone
+    :param datum: geodeic datum
+    :return: (x, y) in UTM of each row
+    :rtype: (N, 2) array
+    """
+    latlon = nmea_to_degrees(data[:, 1:3])
+    p = projection(proj, zone, datum)
+    if p is not None:
+        x, y = p(latlon[:, 1], latlon[:, 0])
+    elif proj == 'utm':
+        x, y = utm.project(latlon[:, 0], latlon[:, 1], zone, datum)
+    else:
+        raise ImportError("pyproj is required for '%s' projections" % proj)
+    return np.c_[x, y]
+
+
 def gps(msg, proj='utm', zone='31T', datum='WGS84'):
     """Returns gps coordinates in Easings and Northings.
 
@@ -91,9 +229,5 @@ def gps(msg, proj='utm', zone='31T', datum='WGS84'):
     :return: (x, y) in UTM
     :rtype: 2-element tuple
     """
-
-    from pyproj import Proj
-    proj = Proj(proj=proj, zone=zone, datum=datum)
-    latlon = np.floor(msg[1:3]/100)+((msg[1:3]/100)-np.floor(msg[1:3]/100))*100/60
-    x, y = proj(latlon[1], latlon[0])
+    x, y = gps_batch(msg[None], proj, zone, datum)[0]
     return (x, y)
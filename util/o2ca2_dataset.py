@@ -1,58 +1,374 @@
+import os
+import shutil
+import hashlib
+import tempfile
 import numpy as np
 from itertools import islice
 
 
+CACHE_DIR = ".o2ca2_cache"
+
+
+def cache_filename(filename, cache_dir=None, num_registers=None, comments="%", delimiter=" "):
+    """ Returns the binary cache file associated with a log file.
+    The name is keyed by the source path, size and modification time
+    as well as the parsing options, so a modified log is never read
+    from a stale cache.
+
+    :param filename: log filename
+    :param cache_dir: cache directory. Next to the log if None
+    :param num_registers: max lines per dataset file including comments
+    :param comments: character for comments
+    :param delimiter: character for delimiter
+    :return: cache filename
+    :rtype: string
+    """
+    filename = os.path.abspath(filename)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(filename), CACHE_DIR)
+
+    st = os.stat(filename)
+    key = "%s|%d|%r|%s|%s|%s" % (
+        filename, st.st_size, st.st_mtime, num_registers, comments, delimiter)
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "%s.%s.npy" % (os.path.basename(filename), digest))
+
+
+def load(filename, num_registers=None, comments="%", delimiter=" ", cache=None):
+    """ Loads a log file in a 2d array. When cache is enabled the parsed
+    array is stored as .npy the first time and memory-mapped (read-only)
+    afterwards.
+
+    :param filename: log filename
+    :param num_registers: max lines per dataset file including comments
+    :param comments: character for comments
+    :param delimiter: character for delimiter
+    :param cache: cache directory, True for the default one or None
+    :type filename: string
+    :type num_registers: integer > 0
+    :type comments: character
+    :type delimiter: character
+    :type cache: None, bool or string
+    :return: log data
+    :rtype: 2d array
+    """
+    if cache:
+        cache_dir = cache if not isinstance(cache, bool) else None
+        fn = cache_filename(filename, cache_dir, num_registers, comments, delimiter)
+        if os.path.exists(fn):
+            return np.load(fn, mmap_mode="r").view(np.ndarray)
+
+    with open(filename) as f:
+        data = np.genfromtxt(
+            islice(f, num_registers),
+            comments=comments,
+            delimiter=delimiter)
+
+    if cache:
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        # write and rename so a concurrent reader never sees a partial file
+        tmp = "%s.%d.tmp" % (fn, os.getpid())
+        with open(tmp, "wb") as f:
+            np.save(f, data)
+        os.rename(tmp, fn)
+    return data
+
+
+def _load_cached(args):
+    """Pool worker: parses a log into the cache and returns its filename"""
+    filename, num_registers, comments, delimiter, cache_dir = args
+    load(filename, num_registers, comments, delimiter, cache_dir or True)
+    return cache_filename(filename, cache_dir, num_registers, comments, delimiter)
+
+
+def load_parallel(filename, workers, num_registers=None, comments="%", delimiter=" ", cache=None):
+    """ Loads several log files, each one parsed in its own process.
+    Arrays are passed back through the binary cache instead of being
+    pickled. A temporary cache is used (and copied to memory) when
+    cache is not enabled.
+
+    :param filename: filenames of the dataset
+    :param workers: max number of processes
+    :param num_registers: max lines per dataset file including comments
+    :param comments: character for comments
+    :param delimiter: character for delimiter
+    :param cache: cache directory, True for the default one or None
+    :type filename: dictionary of form {'id':filename}
+    :type workers: integer > 0
+    :return: log data of each file
+    :rtype: dictionary of form {'id': 2d array}
+    """
+    from multiprocessing import Pool
+
+    tmpdir = None
+    if not cache:
+        tmpdir = tempfile.mkdtemp()
+    cache_dir = tmpdir or (cache if not isinstance(cache, bool) else None)
+
+    keys = sorted(filename)
+    pool = Pool(min(workers, len(keys)))
+    try:
+        fns = pool.map(
+            _load_cached,
+            [(filename[k], num_registers, comments, delimiter, cache_dir) for k in keys],
+            chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    try:
+        data = {}
+        for k, fn in zip(keys, fns):
+            data[k] = np.load(fn, mmap_mode="r").view(np.ndarray)
+            if tmpdir:
+                data[k] = np.array(data[k])
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+    return data
+
+
+def parse(lines, comments="%", delimiter=" "):
+    """ Parses log lines in a 2d array. Faster than genfromtxt but
+    every line must have the same number of numeric columns.
+
+    :param lines: text lines
+    :param comments: character for comments
+    :param delimiter: character for delimiter
+    :type lines: iterable of strings
+    :type comments: character
+    :type delimiter: character
+    :return: log data
+    :rtype: 2d array
+    """
+    lines = [l for l in (l.split(comments, 1)[0].strip() for l in lines) if l]
+    if not lines:
+        return np.empty((0, 0))
+    if delimiter.strip():
+        lines = [l.replace(delimiter, " ") for l in lines]
+
+    cols = len(lines[0].split())
+    data = np.fromstring(" ".join(lines), sep=" ")
+    if data.size != len(lines) * cols:
+        raise ValueError("Inconsistent number of columns (expected %d)" % cols)
+    return data.reshape(-1, cols)
+
+
+def read_chunks(filename, chunk_size, num_registers=None, comments="%", delimiter=" "):
+    """ Reads a log file in chunks of at most chunk_size lines, so memory
+    does not depend on the file length.
+
+    :param filename: log filename
+    :param chunk_size: max lines per chunk including comments
+    :param num_registers: max lines of the file including comments
+    :param comments: character for comments
+    :param delimiter: character for delimiter
+    :type filename: string
+    :type chunk_size: integer > 0
+    :type num_registers: integer > 0
+    :type comments: character
+    :type delimiter: character
+    :return: iterator of non-empty 2d arrays
+    """
+    with open(filename) as f:
+        lines = islice(f, num_registers)
+        while True:
+            block = list(islice(lines, chunk_size))
+            if not block:
+                break
+            data = parse(block, comments, delimiter)
+            if len(data):
+                yield data
+
+
+def _read_whole_timestamps(filename, chunk_size, num_registers=None, comments="%", delimiter=" "):
+    """Chunks of read_chunks joined so that the rows of a timestamp are
+    never split between two chunks (a chunk may exceed chunk_size)"""
+    pending = None
+    for chunk in read_chunks(filename, chunk_size, num_registers, comments, delimiter):
+        if pending is not None and chunk[0, 0] == pending[-1, 0]:
+            pending = np.concatenate([pending, chunk])
+            continue
+        if pending is not None:
+            yield pending
+        pending = chunk
+    if pending is not None:
+        yield pending
+
+
+def merge_order(timestamps):
+    """ Global order of several sorted timestamp arrays computed at once
+    with a stable argsort, so ties keep the array order.
+
+    :param timestamps: list of timestamps
+    :type timestamps: list of 1d arrays
+    :return: array index and position within that array of each entry
+    :rtype: 2-element tuple (source, index) of 1d int arrays
+    """
+    if not len(timestamps):
+        return (np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp))
+    source = np.concatenate([np.full(len(t), i, dtype=np.intp) for i, t in enumerate(timestamps)])
+    index = np.concatenate([np.arange(len(t)) for t in timestamps])
+    order = np.argsort(np.concatenate(timestamps), kind="mergesort")
+    return (source[order], index[order])
+
+
+def tile(data, times, gap=1.0):
+    """ Longer synthetic mission made of the logs repeated one after
+    the other, timestamps shifted by the mission duration plus gap.
+
+    :param data: log data of each sensor
+    :param times: number of repetitions
+    :param gap: seconds between repetitions
+    :type data: dictionary of form {'id': 2d array}
+    :type times: integer > 0
+    :return: log data of each sensor
+    :rtype: dictionary of form {'id': 2d array}
+    """
+    start = min(v[0, 0] for v in data.values() if len(v))
+    end = max(v[-1, 0] for v in data.values() if len(v))
+    tiled = {}
+    for k, v in data.items():
+        tiled[k] = np.tile(v, (times, 1))
+        tiled[k][:, 0] += np.repeat(np.arange(times) * (end - start + gap), len(v))
+    return tiled
+
+
 class O2CA2Dataset:
-    def __init__(self, filename, num_registers=None, comments="%", delimiter=" "):
-        """ Loads files in a dictionary with a sensor id
+    def __init__(self, filename, num_registers=None, comments="%", delimiter=" ", cache=None,
+                 chunk_size=None, workers=None):
+        """ Loads files in a dictionary with a sensor id. When chunk_size
+        is set the files are not loaded but streamed in chunks while
+        iterating, so arbitrarily long logs can be replayed.
 
         :param filename: filenames of the dataset
         :param num_registers: max lines per dataset file including comments
         :param comments: character for comments
         :param delimiter: character for delimiter
+        :param cache: binary cache directory, True to store it next to
+            each log file or None to parse the text logs every time
         :type filename: dictionary of form {'id':filename}
         :type num_registers: integer > 0
         :type comments: character
         :type delimiter: character
+        :param chunk_size: lines per chunk in streaming mode
+        :param workers: number of processes to parse the files in
+            parallel, not with chunk_size
+        :type cache: None, bool or string
+        :type chunk_size: integer > 0
+        :type workers: integer > 0
         """
         self._data = {}
+        self._keys = sorted(filename)
+        self._iter = None
+
+        if chunk_size is not None:
+            if workers and workers > 1:
+                raise ValueError("Streamed files (chunk_size) are not parsed by workers")
+            self._streaming = (filename, chunk_size, num_registers, comments, delimiter)
+            return
+
+        self._streaming = None
+        if workers and workers > 1:
+            self._data = load_parallel(filename, workers, num_registers, comments, delimiter, cache)
+        else:
+            for k, v in filename.iteritems():
+                self._data[k] = load(v, num_registers, comments, delimiter, cache)
+        self._source, self._row = merge_order([self._data[k][:, 0] for k in self._keys])
+
+    @classmethod
+    def from_arrays(cls, data):
+        """ Dataset of already loaded logs.
 
-        for k, v in filename.iteritems():
-            with open(v) as f:
-                self._data[k] = np.genfromtxt(
-                    islice(f, num_registers),
-                    comments=comments,
-                    delimiter=delimiter)
+        :param data: log data of each sensor
+        :type data: dictionary of form {'id': 2d array}
+        :rtype: O2CA2Dataset
+        """
+        D = cls({})
+        D._data = dict(data)
+        D._keys = sorted(data)
+        D._source, D._row = merge_order([D._data[k][:, 0] for k in D._keys])
+        return D
+
+    @property
+    def keys(self):
+        """Sorted sensor ids"""
+        return list(self._keys)
 
-        self._index = {k: 0 for k in self._data}
-        self._timestamp = {k: self._data[k][v][0] for k, v in self._index.iteritems()}
+    def __len__(self):
+        if self._streaming:
+            raise TypeError("Length not available in streaming mode")
+        return len(self._row)
+
+    def __iter__(self):
+        """ Iterates over all the data entries according to timestamp.
+        Entries with the same timestamp keep the sensor id order.
+
+        :return: iterator of (type, data)
+        """
+        keys = self._keys
+        for data, source, row in self.iter_blocks():
+            for s, i in zip(source.tolist(), row.tolist()):
+                yield (keys[s], data[s][i])
+
+    def iter_blocks(self):
+        """ Iterates over blocks of data entries. The whole dataset is a
+        single block unless it is streamed. Each block has the data of
+        every sensor (as in keys) and the merge order of its entries.
+
+        :return: iterator of (data, source, index) where data[source[i]][index[i]]
+            is the i-th entry of the block
+        :rtype: iterator of 3-element tuples (list of 2d arrays, 1d array, 1d array)
+        """
+        if not self._streaming:
+            yield ([self._data[k] for k in self._keys], self._source, self._row)
+            return
+
+        filename, chunk_size, num_registers, comments, delimiter = self._streaming
+        # a timestamp never spans two chunks, so every row at the
+        # watermark is released together with the chunk that sets it
+        readers = [_read_whole_timestamps(filename[k], chunk_size, num_registers, comments, delimiter)
+                   for k in self._keys]
+        chunks = [next(r, None) for r in readers]
+        empty = np.empty((0, 0))
+
+        while any(c is not None for c in chunks):
+            # entries up to the earliest chunk end are known to be in order
+            watermark = min(c[-1, 0] for c in chunks if c is not None)
+            data = []
+            for i, c in enumerate(chunks):
+                if c is None:
+                    data.append(empty)
+                    continue
+                end = np.searchsorted(c[:, 0], watermark, side="right")
+                data.append(c[:end])
+                chunks[i] = c[end:] if end < len(c) else next(readers[i], None)
+
+            source, row = merge_order([d[:, 0] if d.size else d.ravel() for d in data])
+            yield (data, source, row)
 
     def next(self):
         """ Returns next sensor type and data entry according to timestamp.
-        Raises EOFError when one or more components are not present
+        Raises EOFError when all the entries have been returned
 
         :return: sensor type and data register
         :rtype: 2-element tuple (type, data)
         """
+        if self._iter is None:
+            self._iter = iter(self)
         try:
-            _type = min(self._timestamp,  key=self._timestamp.get)
-            data = self._data[_type][self._index[_type]]
-            self._index[_type] += 1
-            self._timestamp[_type] = self._data[_type][self._index[_type]][0]  # timestamp as a value
-            return (_type, data)
-        except Exception as e:
-            raise EOFError(e)
+            return next(self._iter)
+        except StopIteration:
+            raise EOFError("no more registers")
 
 
 def main():
     fn = {"dvl": "../experiment3/_040825_1735_DVL.log"}
     dset = O2CA2Dataset(fn, 20)
-    try:
-        while True:
-            t, d = dset.next()
-            print t, d
-    except EOFError:
-        print "DONE"
+    for t, d in dset:
+        print t, d
+    print "DONE"
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,149 @@
+import numpy as np
+from util import normalize
+import mapping_ops_3dof as mops3dof
+import mapping_ops_6dof as mops6dof
+
+""" Accumulation (prefix compositions) of a chain of relative poses
+    x0 + d1 + d2 + ... + dn with covariance.
+
+    The Jacobian respect to 'a' of a composition a + b is of the form
+    I + N with N non-zero only in the position/angle block, so the
+    product of any run of them is I + (sum of those blocks). That lets
+    the covariance recursion P_k = J1 P_k-1 J1' + J2 Pd J2' be written
+    with prefix sums, which gives all the covariances at once and the
+    covariance between any two nodes in constant time.
+"""
+
+
+def _ops(n):
+    """Mapping ops and number of position elements of a pose size"""
+    if n == 3:
+        return (mops3dof, 2)
+    if n == 6:
+        return (mops6dof, 3)
+    raise ValueError("Poses must have 3 or 6 elements, not %d" % n)
+
+
+def _t(A):
+    return np.swapaxes(A, -1, -2)
+
+
+class PoseChain(object):
+    def __init__(self, d, Pd=None, x0=None, P0=None):
+        """ Chain of nodes x0, x0 + d1, x0 + d1 + d2, ... of 3dof
+        [x, y, theta] or 6DoF [x, y, z, roll, pitch, yaw] poses.
+
+        :param d: relative poses
+        :param Pd: relative pose covariances, the same for all if 2d
+        :param x0: first node, the origin if None
+        :param P0: first node covariance, zero if None
+        :type d: (N, 3) or (N, 6) array
+        :type Pd: (N, n, n) or (n, n) array
+        :type x0: n-element array
+        :type P0: nxn array
+        """
+        d = np.asarray(d, dtype=float)
+        n = d.shape[-1]
+        ops, t = _ops(n)
+        self._t = t
+        x0 = np.zeros(n) if x0 is None else np.asarray(x0, dtype=float).ravel()
+
+        # the rotation of each composition only depends on the angles
+        # of the previous node, positions are their cumulative sum
+        angles = normalize(x0[t:] + np.cumsum(np.r_[np.zeros((1, n - t)), d[:, t:]], axis=0))
+        prev = np.c_[np.zeros((len(d), t)), angles[:-1]]
+        steps = ops.compose_batch(prev, d[:, :t])[0]
+        positions = x0[:t] + np.cumsum(np.r_[np.zeros((1, t)), steps], axis=0)
+        self.poses = np.c_[positions, angles]
+
+        self.cov = None
+        if Pd is None:
+            return
+
+        J1, J2 = ops.compose_jacobians(prev, d)
+        Q = np.matmul(np.matmul(J2, Pd), _t(J2))
+        S = np.cumsum(np.r_[np.zeros((1, t, n - t)), J1[:, :t, t:]], axis=0)
+        # the products below are invariant to an offset of S, centering
+        # it keeps the prefix sums small on long chains
+        S = S - S.mean(axis=0)
+        L = Q[:, t:, :]
+        SW = np.matmul(S[1:], Q[:, t:, t:])
+
+        def prefix(A):
+            return np.cumsum(np.r_[np.zeros((1,) + A.shape[1:]), A], axis=0)
+
+        self._S = S
+        self._sums = (prefix(Q), prefix(L), prefix(np.matmul(S[1:], L)),
+                      prefix(SW), prefix(np.matmul(SW, _t(S[1:]))))
+
+        self.cov = self._increments(np.zeros(len(self.poses), dtype=np.intp),
+                                    np.arange(len(self.poses)))
+        if P0 is not None:
+            Phi = np.tile(np.eye(n), (len(self.poses), 1, 1))
+            Phi[:, :t, t:] += S - S[0]
+            self.cov += np.matmul(np.matmul(Phi, P0), _t(Phi))
+
+    def __len__(self):
+        return len(self.poses)
+
+    def _increments(self, i, j):
+        """Covariance of node j due to the relative poses between
+        nodes i and j (i <= j)"""
+        t = self._t
+        P, L, SL, SW, SWS = [s[j] - s[i] for s in self._sums]
+        Sj = self._S[j]
+
+        # sum over k of (I + N(Sj - Sk)) Qk (I + N(Sj - Sk))', with
+        # N(X) Q = [X Q[t:, :]; 0]
+        B = np.matmul(Sj, L) - SL
+        C = np.matmul(SW, _t(Sj))
+        P[:, :t, :] += B
+        P[:, :, :t] += _t(B)
+        P[:, :t, :t] += np.matmul(np.matmul(Sj, P[:, t:, t:]), _t(Sj)) - C - _t(C) + SWS
+        return 0.5 * (P + _t(P))
+
+    def between(self, i, j):
+        """ Relative pose -x_i + x_j between nodes i and j with the
+        covariance of the relative poses that link them (node i taken
+        as known).
+
+        :param i: first node indices
+        :param j: second node indices, j >= i
+        :type i: integer or 1d int array
+        :type j: integer or 1d int array
+        :return: relative poses with covariance -if provided
+        :rtype: 2-element tuple (r, P) or (r, None)
+        """
+        i, j = np.broadcast_arrays(np.asarray(i, dtype=np.intp), np.asarray(j, dtype=np.intp))
+        if np.any(i > j):
+            raise ValueError("First node after second node")
+        ops = _ops(self.poses.shape[-1])[0]
+        xi, _ = ops.inv_batch(self.poses[i])
+        r, _ = ops.compose_batch(xi, self.poses[j])
+
+        P = None
+        if self.cov is not None:
+            Pij = self._increments(i.ravel(), j.ravel()).reshape(i.shape + self.cov.shape[1:])
+            J = ops.compose_jacobians(xi, self.poses[j])[1]
+            P = np.matmul(np.matmul(J, Pij), _t(J))
+        return (r, P)
+
+
+def accumulate(d, Pd=None, x0=None, P0=None):
+    """ All the prefix compositions x0 + d1 + ... + dk, k = 1..N, of
+    3dof or 6DoF relative poses with covariance -if provided. Same as
+    folding compose over d but vectorized.
+
+    :param d: relative poses
+    :param Pd: relative pose covariances, the same for all if 2d
+    :param x0: initial pose, the origin if None
+    :param P0: initial pose covariance, zero if None
+    :type d: (N, 3) or (N, 6) array
+    :type Pd: (N, n, n) or (n, n) array
+    :type x0: n-element array
+    :type P0: nxn array
+    :return: accumulated poses with covariance -if provided
+    :rtype: 2-element tuple (r, P) or (r, None)
+    """
+    chain = PoseChain(d, Pd, x0, P0)
+    return (chain.poses[1:], None if chain.cov is None else chain.cov[1:])
@@ -0,0 +1,202 @@
+import numpy as np
+from util import normalize
+import mapping_ops_3dof as mops3dof
+
+""" Assembly of imaging sonar returns into motion-corrected scans. The
+    beams of a scan are taken over several seconds, so each return is
+    placed with the vehicle pose at its own timestamp and the scan is
+    expressed relative to the pose at its central time.
+"""
+
+# [x, y, yaw] elements of an 8-state
+POSE_INDEX = np.array([0, 1, 3])
+
+
+def point_covariance(ranges, bearings, stdev_linear, stdev_angular):
+    """ Covariance of the [x, y] of returns with range and bearing
+    uncertainty.
+
+    :type ranges: 1d array (N)
+    :type bearings: 1d array (N)
+    :rtype: 3d array (Nx2x2)
+    """
+    c = np.cos(bearings)
+    s = np.sin(bearings)
+    J = np.empty((len(ranges), 2, 2))
+    J[:, 0, 0] = c
+    J[:, 0, 1] = -ranges * s
+    J[:, 1, 0] = s
+    J[:, 1, 1] = ranges * c
+    var = np.array([stdev_linear**2, stdev_angular**2])
+    return np.matmul(J * var, np.swapaxes(J, 1, 2))
+
+
+def relative_poses(poses, P, reference, P_reference, dt):
+    """ Poses relative to a reference pose of the same trajectory. The
+    covariance of each one is the uncertainty gained (or lost, before the
+    reference) since the reference, P - P_reference, rotated to the
+    reference frame; the filter does not provide the cross-covariances
+    of its steps. Negative eigenvalues are clipped.
+
+    :param poses: [x, y, theta] poses
+    :param P: covariances of the poses
+    :param reference: [x, y, theta] reference pose
+    :param P_reference: covariance of the reference pose
+    :param dt: time of each pose respect to the reference
+    :type poses: 2d array (Nx3)
+    :type P: 3d array (Nx3x3)
+    :type dt: 1d array (N)
+    :return: relative poses and covariances
+    :rtype: 2-element tuple (Nx3 array, Nx3x3 array)
+    """
+    inv_ref = mops3dof.inv_batch(reference)[0]
+    d = mops3dof.compose_batch(inv_ref, poses)[0]
+
+    D = (P - P_reference) * np.where(dt < 0, -1.0, 1.0)[:, None, None]
+    D = 0.5 * (D + np.swapaxes(D, 1, 2))
+    w, V = np.linalg.eigh(D)
+    D = np.matmul(V * np.clip(w, 0, None)[:, None, :], np.swapaxes(V, 1, 2))
+
+    J2 = mops3dof.compose_jacobians(inv_ref, poses)[1]
+    return (d, np.matmul(np.matmul(J2, D), np.swapaxes(J2, 1, 2)))
+
+
+def assemble(t, points, points_cov, trajectory, mount, reference_time=None):
+    """ Motion-corrected scan of returns taken at different times.
+
+    :param t: timestamp of each return
+    :param points: [x, y] of each return in the sensor frame
+    :param points_cov: covariance of each return
+    :param trajectory: vehicle trajectory (8-state)
+    :param mount: [x, y, theta] of the sensor in the vehicle frame
+    :param reference_time: time of the scan pose, the central one of the
+        returns within the trajectory if None
+    :type t: 1d array (N)
+    :type points: 2d array (Nx2)
+    :type points_cov: 3d array (Nx2x2)
+    :type trajectory: Trajectory
+    :type mount: 3-element array
+    :return: scan with its time ('t'), pose and covariance ('pose',
+        'cov') and the timestamps, [x, y] and covariances relative to the
+        scan pose of the returns within the trajectory ('t_points',
+        'points', 'cov_points'). None if no return is within the
+        trajectory or the scan pose is not
+    :rtype: dictionary
+    """
+    x, P = trajectory.query(t)
+    valid = ~np.isnan(x[:, 0])
+    if not valid.any():
+        return None
+    t = t[valid]
+    poses = x[valid][:, POSE_INDEX]
+    covs = P[valid][:, POSE_INDEX][:, :, POSE_INDEX]
+
+    if reference_time is None:
+        reference_time = 0.5 * (t[0] + t[-1])
+    x, P = trajectory.query([reference_time])
+    if np.isnan(x[0, 0]):
+        return None
+    reference = x[0, POSE_INDEX]
+    P_reference = P[0][POSE_INDEX][:, POSE_INDEX]
+
+    # sensor -> vehicle at the return time -> vehicle at the scan time
+    m, P_m = mops3dof.compose_batch(mount, points[valid], np.zeros((3, 3)), points_cov[valid])
+    d, P_d = relative_poses(poses, covs, reference, P_reference, t - reference_time)
+    q, P_q = mops3dof.compose_batch(d, m, P_d, P_m)
+    return {
+        "t": reference_time,
+        "pose": reference,
+        "cov": P_reference,
+        "t_points": t,
+        "points": q,
+        "cov_points": P_q
+        }
+
+
+class ScanAssembler(object):
+    def __init__(self, trajectory, mount, stdev_linear, stdev_angular, scan_angle=2*np.pi):
+        """ Groups returns (see segmentation.BeamSegmenter) in scans of
+        scan_angle of sonar rotation and assembles each one once it is
+        complete.
+
+        :param trajectory: vehicle trajectory (8-state)
+        :param mount: [x, y, theta] of the sensor in the vehicle frame
+        :param stdev_linear: range uncertainty (m)
+        :param stdev_angular: bearing uncertainty (rad)
+        :param scan_angle: rotation of the sensor head per scan (rad)
+        :type trajectory: Trajectory
+        :type mount: 3-element array
+        """
+        self.trajectory = trajectory
+        self.mount = np.asarray(mount, dtype=float)
+        self.stdev_linear = stdev_linear
+        self.stdev_angular = stdev_angular
+        self.scan_angle = scan_angle
+        self._pending = []
+        self._angle = 0.0
+        self._bearing = None
+
+    @classmethod
+    def from_config(cls, trajectory, config, scan_angle=2*np.pi):
+        """Assembler of a mis configuration (pose, stdev_linear and stdev_angular)"""
+        mount = np.asarray(config["pose"])[[0, 1, 5]]
+        return cls(trajectory, mount, config["stdev_linear"], config["stdev_angular"], scan_angle)
+
+    def _assemble(self):
+        t, bearing, ranges = [np.concatenate(v) for v in zip(*self._pending)]
+        self._pending = []
+        points = np.c_[ranges * np.cos(bearing), ranges * np.sin(bearing)]
+        points_cov = point_covariance(ranges, bearing, self.stdev_linear, self.stdev_angular)
+        return assemble(t, points, points_cov, self.trajectory, self.mount)
+
+    def add(self, returns):
+        """ Adds returns, in time order.
+
+        :param returns: 't', 'bearing' and 'range' of each return
+        :type returns: dictionary of 1d arrays
+        :return: scans completed by these returns (see assemble), but
+            those out of the trajectory
+        :rtype: list of dictionaries
+        """
+        t = np.asarray(returns["t"])
+        bearing = np.asarray(returns["bearing"])
+        ranges = np.asarray(returns["range"])
+        if not len(t):
+            return []
+
+        previous = bearing[0] if self._bearing is None else self._bearing
+        angle = self._angle + np.cumsum(np.abs(normalize(np.diff(np.r_[previous, bearing]))))
+        self._bearing = bearing[-1]
+
+        scans = []
+        start = 0
+        while True:
+            # first return that closes the scan belongs to the next one
+            i = start + np.searchsorted(angle[start:], self.scan_angle - 1e-9)
+            if i == len(t):
+                break
+            self._pending.append((t[start:i], bearing[start:i], ranges[start:i]))
+            if sum(len(p[0]) for p in self._pending):
+                scan = self._assemble()
+                if scan is not None:
+                    scans.append(scan)
+            self._pending = []
+            angle[i:] -= angle[i]
+            start = i
+        self._pending.append((t[start:], bearing[start:], ranges[start:]))
+        self._angle = angle[-1]
+        return scans
+
+    def flush(self):
+        """ Assembles the incomplete last scan.
+
+        :return: scan or None if there are no returns pending or they
+            are out of the trajectory
+        :rtype: dictionary
+        """
+        if not sum(len(p[0]) for p in self._pending):
+            self._pending = []
+            return None
+        scan = self._assemble()
+        self._angle = 0.0
+        return scan
@@ -0,0 +1,201 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from util import normalize
+import mapping_ops_3dof as mops3dof
+import scan
+
+""" 2d scan matching: point-to-point ICP and probabilistic ICP (pIC,
+    Montesano et al. 2005) with Mahalanobis association. The nearest
+    neighbours are searched in a kd-tree of the reference scan and every
+    iteration is vectorized over the points.
+
+    Both return the pose x of the new scan in the reference scan frame
+    (x + new ~ ref) and its covariance, a relative pose measurement.
+"""
+
+
+def _inv2(S):
+    """Inverse of an array of 2x2 matrices"""
+    a = S[..., 0, 0]
+    b = S[..., 0, 1]
+    c = S[..., 1, 0]
+    d = S[..., 1, 1]
+    det = a*d - b*c
+    W = np.empty(S.shape)
+    W[..., 0, 0] = d / det
+    W[..., 0, 1] = -b / det
+    W[..., 1, 0] = -c / det
+    W[..., 1, 1] = a / det
+    return W
+
+
+def align(new, ref):
+    """ Least squares rigid transform between paired points, x such
+    that x + new ~ ref (closed form).
+
+    :type new: 2d array (Nx2)
+    :type ref: 2d array (Nx2)
+    :rtype: 3-element array [x, y, theta]
+    """
+    mn = new.mean(axis=0)
+    mr = ref.mean(axis=0)
+    H = np.dot((new - mn).T, ref - mr)
+    theta = np.arctan2(H[0, 1] - H[1, 0], H[0, 0] + H[1, 1])
+    c = np.cos(theta)
+    s = np.sin(theta)
+    return np.array([
+        mr[0] - (c*mn[0] - s*mn[1]),
+        mr[1] - (s*mn[0] + c*mn[1]),
+        theta])
+
+
+def icp(ref, new, x0=None, max_iterations=50, tolerance=1e-6, max_distance=np.inf, tree=None):
+    """ Point-to-point ICP. Each point of the new scan is paired with its
+    nearest reference point (closer than max_distance) and the transform
+    of the pairs solved in closed form, until it changes less than
+    tolerance. The covariance is s^2 (J'J)^-1 with the residual variance
+    s^2 of the final pairs.
+
+    :param ref: reference scan points
+    :param new: new scan points
+    :param x0: initial guess, zero if None
+    :param max_iterations: max iterations
+    :param tolerance: convergence threshold of the change of x
+    :param max_distance: max distance (m) of a pair
+    :param tree: kd-tree of ref, built if None
+    :type ref: 2d array (Nx2)
+    :type new: 2d array (Mx2)
+    :type x0: 3-element array
+    :type tree: cKDTree
+    :return: pose, covariance and 'iterations', 'matches', 'converged'
+        and 'error' (mean squared distance of the pairs)
+    :rtype: 3-element tuple (3-element array, 3x3 array, dictionary)
+    """
+    ref = np.asarray(ref, dtype=float)
+    new = np.asarray(new, dtype=float)
+    tree = cKDTree(ref) if tree is None else tree
+    x = np.zeros(3) if x0 is None else np.array(x0, dtype=float)
+    info = {"iterations": 0, "matches": 0, "converged": False, "error": np.nan}
+
+    for k in range(max_iterations):
+        info["iterations"] = k + 1
+        d, j = tree.query(mops3dof.compose_batch(x, new)[0], distance_upper_bound=max_distance)
+        m = np.isfinite(d)
+        if np.count_nonzero(m) < 3:
+            break
+        x_prev = x
+        x = align(new[m], ref[j[m]])
+        dx = x - x_prev
+        dx[2] = normalize(dx[2])
+        if np.max(np.abs(dx)) < tolerance:
+            info["converged"] = True
+            break
+
+    if np.count_nonzero(m) < 3:
+        return (x, np.full((3, 3), np.nan), info)
+    e = ref[j[m]] - mops3dof.compose_batch(x, new[m])[0]
+    J = mops3dof.compose_jacobians(x, new[m])[0]
+    s2 = np.sum(e**2) / max(2*len(e) - 3, 1)
+    info["matches"] = len(e)
+    info["error"] = np.mean(np.sum(e**2, axis=1))
+    return (x, s2 * np.linalg.inv(np.einsum('nki,nkj->ij', J, J)), info)
+
+
+def pic(ref, ref_cov, new, new_cov, x0, P0, confidence=0.95, candidates=5,
+        max_iterations=50, tolerance=1e-6, tree=None):
+    """ Probabilistic ICP. Each new point, with the uncertainty of the
+    point and of the pose x, is paired with the Mahalanobis-closest of
+    its candidates nearest reference points if they are compatible
+    (within the chi-square bound of confidence). x is updated with a
+    Gauss-Newton step of the Mahalanobis error of the pairs, until it
+    changes less than tolerance; its covariance is (J'S^-1J)^-1.
+
+    :param ref: reference scan points
+    :param ref_cov: covariance of each reference point
+    :param new: new scan points
+    :param new_cov: covariance of each new point
+    :param x0: initial guess, e.g. from odometry
+    :param P0: initial guess covariance, used for the association
+    :param confidence: association confidence
+    :param candidates: nearest (euclidean) points tested per new point
+    :param max_iterations: max iterations
+    :param tolerance: convergence threshold of the change of x
+    :param tree: kd-tree of ref, built if None
+    :type ref: 2d array (Nx2)
+    :type ref_cov: 3d array (Nx2x2)
+    :type new: 2d array (Mx2)
+    :type new_cov: 3d array (Mx2x2)
+    :type x0: 3-element array
+    :type P0: 3x3 array
+    :type confidence: float in (0, 1)
+    :type candidates: integer > 0
+    :type tree: cKDTree
+    :return: pose, covariance and 'iterations', 'matches', 'converged'
+        and 'error' (mean squared Mahalanobis distance of the pairs)
+    :rtype: 3-element tuple (3-element array, 3x3 array, dictionary)
+    """
+    ref = np.asarray(ref, dtype=float)
+    new = np.asarray(new, dtype=float)
+    tree = cKDTree(ref) if tree is None else tree
+    x = np.array(x0, dtype=float)
+    bound = -2 * np.log(1 - confidence)  # chi-square, 2 dof
+    rows = np.arange(len(new))
+    info = {"iterations": 0, "matches": 0, "converged": False, "error": np.nan}
+    P = np.full((3, 3), np.nan)
+
+    for k in range(max_iterations):
+        info["iterations"] = k + 1
+        q = mops3dof.compose_batch(x, new)[0]
+        J1, J2 = mops3dof.compose_jacobians(x, new)
+        C_new = np.matmul(np.matmul(J2, new_cov), np.swapaxes(J2, 1, 2))
+        C_q = C_new + np.matmul(np.matmul(J1, P0), np.swapaxes(J1, 1, 2))
+
+        d, j = tree.query(q, k=candidates)
+        d = d.reshape(len(q), -1)
+        j = np.minimum(j.reshape(len(q), -1), len(ref) - 1)
+        e = ref[j] - q[:, None]
+        W = _inv2(C_q[:, None] + ref_cov[j])
+        D2 = np.einsum('nki,nkij,nkj->nk', e, W, e)
+        D2[~np.isfinite(d)] = np.inf
+
+        best = np.argmin(D2, axis=1)
+        m = D2[rows, best] < bound
+        if np.count_nonzero(m) < 2:
+            break
+        jm = j[rows, best][m]
+        em = e[rows, best][m]
+        Wm = _inv2(ref_cov[jm] + C_new[m])
+        Jm = J1[m]
+        H = np.einsum('nki,nkl,nlj->ij', Jm, Wm, Jm)
+        g = np.einsum('nki,nkl,nl->i', Jm, Wm, em)
+        dx = np.linalg.solve(H, g)
+        x = x + dx
+        x[2] = normalize(x[2])
+        P = np.linalg.inv(H)
+        info["matches"] = len(em)
+        info["error"] = np.mean(np.einsum('ni,nij,nj->n', em, Wm, em))
+        if np.max(np.abs(dx)) < tolerance:
+            info["converged"] = True
+            break
+    return (x, P, info)
+
+
+def match_scans(ref_scan, new_scan, method="pic", **kwargs):
+    """ Matches two assembled scans (see scan.ScanAssembler). The
+    initial guess is the relative pose of the scans given by the
+    trajectory.
+
+    :param method: 'pic' or 'icp'
+    :return: pose of the new scan in the reference scan frame, its
+        covariance and the matching information (see icp and pic)
+    :rtype: 3-element tuple (3-element array, 3x3 array, dictionary)
+    """
+    x0, P0 = scan.relative_poses(
+        new_scan["pose"][None], new_scan["cov"][None], ref_scan["pose"], ref_scan["cov"],
+        np.array([new_scan["t"] - ref_scan["t"]]))
+    if method == "icp":
+        return icp(ref_scan["points"], new_scan["points"], x0[0], **kwargs)
+    if method == "pic":
+        return pic(ref_scan["points"], ref_scan["cov_points"], new_scan["points"],
+                   new_scan["cov_points"], x0[0], P0[0], **kwargs)
+    raise ValueError("Unknown method %r" % (method,))
@@ -0,0 +1,141 @@
+import numpy as np
+import o2ca2_dataset as dataset
+
+""" Segmentation of imaging sonar (mis) beams: the bins of each beam
+    above a threshold within a range window, of which the strongest
+    ones at least min_distance apart are kept as returns. Many beams
+    (e.g. whole scans) are processed at once.
+"""
+
+# columns of a raw beam row: timestamp, bearing (rad) and the bins
+TIME = 0
+BEARING = 1
+FIRST_BIN = 2
+
+
+def bin_ranges(num_bins, resolution):
+    """Range (m) of the center of each bin"""
+    return (np.arange(num_bins) + 0.5) * resolution
+
+
+def polar_to_cartesian(ranges, bearings):
+    """[x, y] (sensor frame) of returns at ranges and bearings"""
+    return np.c_[ranges * np.cos(bearings), ranges * np.sin(bearings)]
+
+
+def segment(bins, resolution, threshold, init_range, max_range, min_distance, max_ranges):
+    """ Returns of a batch of beams. Bins over threshold between
+    init_range and max_range are candidates, the strongest one of each
+    beam is taken and the candidates closer than min_distance to it are
+    discarded, up to max_ranges times.
+
+    :param bins: intensity of each bin of each beam
+    :param resolution: bin size (m)
+    :param threshold: min intensity (exclusive)
+    :param init_range: min range (m), e.g. to skip the near-field noise
+    :param max_range: max range (m)
+    :param min_distance: min distance (m) between returns of a beam
+    :param max_ranges: max returns per beam
+    :type bins: 2d array (beams x bins)
+    :type max_ranges: integer > 0
+    :return: beam index, range and intensity of each return, by beam
+        and from the strongest return of each beam
+    :rtype: 3-element tuple of 1d arrays
+    """
+    bins = np.asarray(bins)
+    r = bin_ranges(bins.shape[1], resolution)
+    window = (r >= init_range) & (r <= max_range)
+    candidates = np.where((bins > threshold) & window, bins, -np.inf)
+
+    beams = np.arange(len(bins))
+    found_beam = []
+    found_bin = []
+    for k in range(max_ranges):
+        j = np.argmax(candidates, axis=1)
+        hit = np.isfinite(candidates[beams, j])
+        if not hit.any():
+            break
+        found_beam.append(beams[hit])
+        found_bin.append(j[hit])
+        if k + 1 < max_ranges:
+            # the bin itself, even if min_distance is under the bin size
+            candidates[beams[hit], j[hit]] = -np.inf
+            near = np.abs(r - r[j][:, None]) < min_distance
+            candidates[near & hit[:, None]] = -np.inf
+
+    if not found_beam:
+        return (np.empty(0, dtype=np.intp), np.empty(0), np.empty(0))
+    beam = np.concatenate(found_beam)
+    b = np.concatenate(found_bin)
+    # stable, the returns of a beam stay from the strongest
+    order = np.argsort(beam, kind="mergesort")
+    beam = beam[order]
+    b = b[order]
+    return (beam, r[b], bins[beam, b])
+
+
+def beam_chunks(filename, chunk_size=4096, cache=None, comments="%", delimiter=" "):
+    """ Raw beams of a log in chunks. With cache the log is memory-mapped
+    from the binary cache (parsed once), otherwise it is streamed from
+    the text file; memory does not depend on the mission length.
+
+    :param filename: log filename
+    :param chunk_size: beams per chunk
+    :param cache: cache directory, True for the default one or None
+    :type filename: string
+    :type chunk_size: integer > 0
+    :type cache: None, bool or string
+    :return: iterator of 2d arrays (beams x [t, bearing, bins])
+    """
+    if not cache:
+        for chunk in dataset.read_chunks(filename, chunk_size, comments=comments, delimiter=delimiter):
+            yield chunk
+        return
+    beams = dataset.load(filename, comments=comments, delimiter=delimiter, cache=cache)
+    for i in range(0, len(beams), chunk_size):
+        yield beams[i:i + chunk_size]
+
+
+class BeamSegmenter(object):
+    def __init__(self, resolution, threshold, init_range, max_range, min_distance, max_ranges):
+        """ Segmentation of raw beam rows [t, bearing, bins...], see
+        segment for the parameters.
+        """
+        self.resolution = resolution
+        self.threshold = threshold
+        self.init_range = init_range
+        self.max_range = max_range
+        self.min_distance = min_distance
+        self.max_ranges = max_ranges
+
+    @classmethod
+    def from_config(cls, config):
+        """Segmenter of a mis configuration (resolution_linear and segmentation)"""
+        return cls(config["resolution_linear"], **config["segmentation"])
+
+    def segment(self, beams):
+        """ Returns of a batch of beams.
+
+        :param beams: raw beams
+        :type beams: 2d array (beams x [t, bearing, bins])
+        :return: timestamp, bearing, range, intensity and [x, y] in the
+            sensor frame of each return
+        :rtype: dictionary of arrays
+        """
+        beams = np.asarray(beams)
+        index, ranges, intensity = segment(
+            beams[:, FIRST_BIN:], self.resolution, self.threshold, self.init_range,
+            self.max_range, self.min_distance, self.max_ranges)
+        bearing = beams[index, BEARING]
+        return {
+            "t": beams[index, TIME],
+            "bearing": bearing,
+            "range": ranges,
+            "intensity": intensity,
+            "xy": polar_to_cartesian(ranges, bearing)
+            }
+
+    def iter_segment(self, chunks):
+        """Returns of each chunk of beams (e.g. from beam_chunks)"""
+        for chunk in chunks:
+            yield self.segment(chunk)
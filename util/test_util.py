@@ -1,15 +1,45 @@
+import os
+import sys
+import shutil
+import tempfile
 import unittest
 import numpy as np
 import numpy.testing as npt
 import util
 import mapping_ops_3dof as mops3dof
 import mapping_ops_6dof as mops6dof
+import o2ca2_dataset
+import pose_chain
+import measurement_8state as meas
+import utm
+import trajectory
+import ingest
+import segmentation
+import scan
+import scan_matching
+from Queue import Queue
+from StringIO import StringIO
 
 
 class UtilTest(unittest.TestCase):
     def test_normalize(self):
         self.assertEqual(util.normalize(0.0), 0.0)
         self.assertLessEqual(util.normalize(4.0), 0.0)
+        npt.assert_almost_equal(util.normalize(np.array([0.0, 4.0, -4.0])),
+                                [0.0, 4.0 - 2*np.pi, 2*np.pi - 4.0])
+
+    def test_rpy(self):
+        angles = np.random.RandomState(0).uniform(-np.pi, np.pi, (4, 3))
+        R = util.rpy(angles[:, 0], angles[:, 1], angles[:, 2])
+        self.assertEqual(R.shape, (4, 3, 3))
+        for i in range(4):
+            npt.assert_almost_equal(R[i], util.rpy(*angles[i]))
+            npt.assert_almost_equal(np.dot(R[i], R[i].T), np.eye(3))
+        self.assertEqual(util.rpy(0, 0, angles[:, 2]).shape, (4, 3, 3))
+
+        pose = np.array([1, 2, 3, np.pi, 0, np.pi/3])
+        npt.assert_almost_equal(meas.mount_rotation(pose), util.rpy(np.pi, 0, np.pi/3))
+        self.assertIs(meas.mount_rotation(pose.copy()), meas.mount_rotation(pose))
 
     def test_compose_3dof(self):
         a = np.array([5., 5., np.pi])
@@ -58,5 +88,478 @@ class UtilTest(unittest.TestCase):
         npt.assert_almost_equal(mops6dof.compose(r, a)[0], np.zeros(6))
         self.assertEqual(Pr.shape, (6, 6))
 
+    def test_batch_3dof(self):
+        rng = np.random.RandomState(0)
+        a = rng.uniform(-4, 4, (5, 3))
+        b = rng.uniform(-4, 4, (5, 3))
+        Pa = np.array([np.diag(d) for d in rng.uniform(0.1, 1, (5, 3))])
+        Pb = np.array([np.diag(d) for d in rng.uniform(0.1, 1, (5, 3))])
+
+        r, Pr = mops3dof.compose_batch(a, b, Pa, Pb)
+        ri, Pri = mops3dof.inv_batch(a, Pa)
+        rp, Prp = mops3dof.compose_batch(a, b[:, 0:2], Pa, Pb[:, 0:2, 0:2])
+        for i in range(5):
+            r_ref, P_ref = mops3dof.compose(a[i], b[i], Pa[i], Pb[i])
+            npt.assert_almost_equal(r[i], r_ref)
+            npt.assert_almost_equal(Pr[i], P_ref)
+            r_ref, P_ref = mops3dof.inv(a[i], Pa[i])
+            npt.assert_almost_equal(ri[i], r_ref)
+            npt.assert_almost_equal(Pri[i], P_ref)
+            r_ref, P_ref = mops3dof.compose(a[i], b[i, 0:2], Pa[i], Pb[i, 0:2, 0:2])
+            npt.assert_almost_equal(rp[i], r_ref)
+            npt.assert_almost_equal(Prp[i], P_ref)
+
+        # one pose and many points
+        r, Pr = mops3dof.compose_batch(a[0], b[:, 0:2])
+        self.assertEqual(r.shape, (5, 2))
+        npt.assert_almost_equal(r[3], mops3dof.compose(a[0], b[3, 0:2])[0])
+
+    def test_batch_6dof(self):
+        rng = np.random.RandomState(0)
+        a = rng.uniform(-3, 3, (5, 6))
+        b = rng.uniform(-3, 3, (5, 6))
+        Pa = np.array([np.diag(d) for d in rng.uniform(0.1, 1, (5, 6))])
+        Pb = np.array([np.diag(d) for d in rng.uniform(0.1, 1, (5, 6))])
+
+        r, Pr = mops6dof.compose_batch(a, b, Pa, Pb)
+        ri, Pri = mops6dof.inv_batch(a, Pa)
+        rp, Prp = mops6dof.compose_batch(a, b[:, 0:3], Pa, Pb[:, 0:3, 0:3])
+        for i in range(5):
+            r_ref, P_ref = mops6dof.compose(a[i], b[i], Pa[i], Pb[i])
+            npt.assert_almost_equal(r[i], r_ref)
+            npt.assert_almost_equal(Pr[i], P_ref)
+            r_ref, P_ref = mops6dof.inv(a[i], Pa[i])
+            npt.assert_almost_equal(ri[i], r_ref)
+            npt.assert_almost_equal(Pri[i], P_ref)
+            r_ref, P_ref = mops6dof.compose(a[i], b[i, 0:3], Pa[i], Pb[i, 0:3, 0:3])
+            npt.assert_almost_equal(rp[i], r_ref)
+            npt.assert_almost_equal(Prp[i], P_ref)
+
+    def test_pose_chain(self):
+        rng = np.random.RandomState(0)
+        for mops, n in [(mops3dof, 3), (mops6dof, 6)]:
+            d = rng.uniform(-1, 1, (20, n))
+            Pd = np.array([np.diag(v) for v in rng.uniform(0.01, 0.1, (20, n))])
+            x0 = rng.uniform(-5, 5, n)
+            P0 = np.diag(rng.uniform(0.1, 1, n))
+
+            r, Pr = pose_chain.accumulate(d, Pd, x0, P0)
+            x, P = x0, P0
+            for k in range(20):
+                x, P = mops.compose(x, d[k], P, Pd[k])
+                npt.assert_almost_equal(util.normalize(r[k] - x), np.zeros(n))
+                npt.assert_almost_equal(Pr[k], P)
+
+        # relative pose and covariance of the 3dof links between two nodes
+        d = d[:, [0, 1, 5]]
+        Pd = Pd[:, [0, 1, 5]][:, :, [0, 1, 5]]
+        chain = pose_chain.PoseChain(d, Pd, x0[[0, 1, 5]])
+        r, Pr = chain.between([0, 5], [20, 12])
+        x, P = np.zeros(3), np.zeros((3, 3))
+        for k in range(5, 12):
+            x, P = mops3dof.compose(x, d[k], P, Pd[k])
+        npt.assert_almost_equal(r[1], x)
+        npt.assert_almost_equal(Pr[1], P)
+        npt.assert_almost_equal(r[0], mops3dof.compose(mops3dof.inv(chain.poses[0])[0], chain.poses[20])[0])
+        self.assertRaises(ValueError, chain.between, 3, 2)
+
+    def test_measurement_batch(self):
+        rng = np.random.RandomState(0)
+        data = rng.uniform(-100, 100, (6, 30))
+        data[:, 14] = [1, 0, 1, 1, 0, 0]
+        pose = np.array([0, 0, 0, np.pi, 0, np.pi/3])
+        stdev = {"bottom": np.array([0.3, 0.3, 0.15, 0.02]), "water": np.array([0.6, 0.6, 0.3, 0.02])}
+
+        z, R, bottom = meas.dvl_batch(data, pose, stdev)
+        npt.assert_array_equal(bottom, data[:, 14] == 1)
+        for i in range(6):
+            z_ref, H, R_ref = meas.dvl(data[i], pose, stdev)
+            npt.assert_almost_equal(z[i], z_ref)
+            npt.assert_array_equal(R[i], R_ref)
+
+        z, R = meas.imu_batch(data, pose, np.array([0.2, 0.2]))
+        for i in range(6):
+            z_ref, H, R_ref = meas.imu(data[i], pose, np.array([0.2, 0.2]))
+            npt.assert_almost_equal(z[i], z_ref)
+            npt.assert_array_equal(R[i], R_ref)
+
+    def test_gps(self):
+        # reference from proj: +proj=utm +zone=31 +datum=WGS84
+        x, y = utm.project(np.array([42.0, 41.5]), np.array([3.1, 2.8]))
+        npt.assert_allclose([x[0], y[0]], [508281.762576219, 4649781.060763332], atol=1e-6)
+        self.assertEqual(utm.zone_number('31T'), 31)
+        self.assertRaises(ValueError, utm.zone_number, 'T')
+        self.assertRaises(ValueError, utm.project, 42.0, 3.1, 31, 'unknown')
+
+        npt.assert_almost_equal(meas.nmea_to_degrees(4200.6), 42.01)
+        data = np.array([[0.0, 4200.0, 306.0], [1.0, 4130.0, 248.0]])
+        xy = meas.gps_batch(data)
+        npt.assert_allclose(xy, np.c_[x, y], atol=1e-6)
+        npt.assert_allclose(meas.gps(data[1]), xy[1], atol=1e-6)
+
+        # without pyproj the missing projection is cached as well
+        pyproj = sys.modules.get("pyproj")
+        sys.modules["pyproj"] = None
+        try:
+            self.assertIsNone(meas.projection(zone='30T'))
+            self.assertIn(('utm', '30T', 'WGS84'), meas._projections)
+        finally:
+            meas._projections.pop(('utm', '30T', 'WGS84'), None)
+            if pyproj is None:
+                del sys.modules["pyproj"]
+            else:
+                sys.modules["pyproj"] = pyproj
+
+    def test_scan_matching(self):
+        # walls of a rectangular tank, seen from a displaced pose
+        rng = np.random.RandomState(0)
+        u = rng.uniform(0, 1, 400)
+        ref = np.r_[np.c_[20 * u[:100], np.zeros(100)], np.c_[20 * u[100:200], 10 + np.zeros(100)],
+                    np.c_[np.zeros(100), 10 * u[200:300]], np.c_[20 + np.zeros(100), 10 * u[300:]]]
+        x = np.array([0.4, -0.3, 0.05])
+        new = mops3dof.compose_batch(mops3dof.inv_batch(x)[0], ref)[0] + rng.normal(0, 0.01, ref.shape)
+
+        est, P, info = scan_matching.icp(ref, new)
+        self.assertTrue(info["converged"])
+        npt.assert_almost_equal(est, x, decimal=2)
+        self.assertTrue(np.all(np.linalg.eigvalsh(P) > 0))
+
+        cov = np.tile(np.eye(2) * 0.01**2, (len(ref), 1, 1))
+        P0 = np.diag([0.5, 0.5, 0.1])**2
+        est, P, info = scan_matching.pic(ref, cov, new, cov, np.zeros(3), P0)
+        self.assertTrue(info["converged"])
+        npt.assert_almost_equal(est, x, decimal=2)
+        self.assertGreater(info["matches"], 300)
+        self.assertTrue(np.all(np.linalg.eigvalsh(P) > 0))
+        self.assertTrue(np.all(np.sqrt(np.diag(P)) < 0.01))
+
+        ref_scan = {"t": 0.0, "pose": np.zeros(3), "cov": np.eye(3), "points": ref, "cov_points": cov}
+        new_scan = {"t": 5.0, "pose": x + [0.1, 0.1, 0], "cov": np.eye(3) + P0, "points": new, "cov_points": cov}
+        for method in ["icp", "pic"]:
+            est = scan_matching.match_scans(ref_scan, new_scan, method)[0]
+            npt.assert_almost_equal(est, x, decimal=2)
+        self.assertRaises(ValueError, scan_matching.match_scans, ref_scan, new_scan, "ndt")
+
+
+class DatasetTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filenames = {
+            "a": os.path.join(self.tmpdir, "a.log"),
+            "b": os.path.join(self.tmpdir, "b.log")}
+        with open(self.filenames["a"], "w") as f:
+            f.write("% comment\r\n\r\n1.0 10 \r\n3.0 30 \r\n5.0 50 \r\n")
+        with open(self.filenames["b"], "w") as f:
+            f.write("2.0 20 200\n3.0 31 300\n4.0 40 400\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache(self):
+        data = o2ca2_dataset.load(self.filenames["a"])
+        cached = o2ca2_dataset.load(self.filenames["a"], cache=True)
+        fn = o2ca2_dataset.cache_filename(self.filenames["a"])
+        self.assertTrue(os.path.exists(fn))
+
+        cached = o2ca2_dataset.load(self.filenames["a"], cache=True)
+        self.assertIsInstance(cached.base, np.memmap)
+        npt.assert_array_equal(cached, data)
+
+        with open(self.filenames["a"], "a") as f:
+            f.write("7.0 70\n")
+        self.assertNotEqual(o2ca2_dataset.cache_filename(self.filenames["a"]), fn)
+        self.assertEqual(o2ca2_dataset.load(self.filenames["a"], cache=True).shape, (4, 2))
+
+    def test_merge(self):
+        dset = o2ca2_dataset.O2CA2Dataset(self.filenames)
+        msgs = list(dset)
+        self.assertEqual(len(msgs), len(dset))
+        self.assertEqual([k for k, d in msgs], ["a", "b", "a", "b", "b", "a"])
+        npt.assert_array_equal(msgs[3][1], [3.0, 31, 300])
+
+        dset = o2ca2_dataset.O2CA2Dataset(self.filenames)
+        for i in range(len(msgs)):
+            dset.next()
+        self.assertRaises(EOFError, dset.next)
+
+    def test_parallel(self):
+        data = o2ca2_dataset.load_parallel(self.filenames, 2)
+        for k, v in self.filenames.items():
+            npt.assert_array_equal(data[k], o2ca2_dataset.load(v))
+
+        cache = os.path.join(self.tmpdir, "cache")
+        data = o2ca2_dataset.load_parallel(self.filenames, 2, cache=cache)
+        self.assertIsInstance(data["b"].base, np.memmap)
+        self.assertEqual(len(os.listdir(cache)), 2)
+        self.assertRaises(ValueError, o2ca2_dataset.O2CA2Dataset, self.filenames, chunk_size=2, workers=2)
+
+    def test_streaming(self):
+        npt.assert_array_equal(
+            np.concatenate(list(o2ca2_dataset.read_chunks(self.filenames["a"], 2))),
+            o2ca2_dataset.load(self.filenames["a"]))
+
+        msgs = list(o2ca2_dataset.O2CA2Dataset(self.filenames))
+        for chunk_size in [1, 2, 10]:
+            dset = o2ca2_dataset.O2CA2Dataset(self.filenames, chunk_size=chunk_size)
+            streamed = list(dset)
+            self.assertEqual([k for k, d in streamed], [k for k, d in msgs])
+            for (k1, d1), (k2, d2) in zip(streamed, msgs):
+                npt.assert_array_equal(d1, d2)
+
+        # equal timestamps across a chunk boundary
+        filenames = {"a": os.path.join(self.tmpdir, "c.log"), "b": os.path.join(self.tmpdir, "d.log")}
+        with open(filenames["a"], "w") as f:
+            f.write("1 1\n2 2\n2 3\n3 4\n")
+        with open(filenames["b"], "w") as f:
+            f.write("2 5\n4 6\n")
+        msgs = [(k, d[1]) for k, d in o2ca2_dataset.O2CA2Dataset(filenames)]
+        self.assertEqual(msgs, [("a", 1), ("a", 2), ("a", 3), ("b", 5), ("a", 4), ("b", 6)])
+        for chunk_size in [1, 2, 3]:
+            dset = o2ca2_dataset.O2CA2Dataset(filenames, chunk_size=chunk_size)
+            self.assertEqual([(k, d[1]) for k, d in dset], msgs)
+
+    def test_tile(self):
+        data = o2ca2_dataset.load_parallel(self.filenames, 1)
+        tiled = o2ca2_dataset.tile(data, 3, gap=1.0)
+        self.assertEqual(tiled["a"].shape, (9, 2))
+        npt.assert_array_equal(tiled["a"][:, 0], [1, 3, 5, 6, 8, 10, 11, 13, 15])
+        npt.assert_array_equal(tiled["b"][3:6, 1:], data["b"][:, 1:])
+
+        dset = o2ca2_dataset.O2CA2Dataset.from_arrays(tiled)
+        msgs = list(dset)
+        self.assertEqual(len(msgs), 18)
+        self.assertEqual([k for k, d in msgs[6:12]], ["a", "b", "a", "b", "b", "a"])
+        self.assertEqual(len(list(o2ca2_dataset.O2CA2Dataset.from_arrays({}))), 0)
+
+    def test_segmentation(self):
+        bins = np.zeros((3, 100))
+        bins[0, [5, 30, 32, 60]] = [200, 120, 150, 90]  # 0.55m is before init_range
+        bins[1, 95] = 255  # 9.55m is beyond max_range
+        bins[2, 40] = 70  # under threshold
+        config = {"threshold": 80, "init_range": 1.0, "max_range": 9.0,
+                  "min_distance": 1.0, "max_ranges": 3}
+        beam, ranges, intensity = segmentation.segment(bins, 0.1, **config)
+        npt.assert_array_equal(beam, [0, 0])
+        npt.assert_almost_equal(ranges, [3.25, 6.05])
+        npt.assert_array_equal(intensity, [150, 90])
+
+        # every return is a different bin, even without min_distance
+        config_any = dict(config, init_range=0, max_range=5, min_distance=0)
+        beam, ranges, intensity = segmentation.segment(bins, 0.1, **config_any)
+        npt.assert_array_equal(beam, [0, 0, 0])
+        npt.assert_almost_equal(ranges, [0.55, 3.25, 3.05])
+        npt.assert_array_equal(intensity, [200, 150, 120])
+
+        fn = os.path.join(self.tmpdir, "is.log")
+        beams = np.c_[[10.0, 10.1, 10.2], [0, np.pi / 2, np.pi], bins]
+        np.savetxt(fn, np.tile(beams, (4, 1)))
+        segmenter = segmentation.BeamSegmenter.from_config(
+            {"resolution_linear": 0.1, "segmentation": config})
+        returns = segmenter.segment(beams)
+        npt.assert_almost_equal(returns["xy"], [[3.25, 0], [6.05, 0]])
+        npt.assert_array_equal(returns["t"], [10.0, 10.0])
+
+        for cache in [None, os.path.join(self.tmpdir, "cache")]:
+            chunks = list(segmentation.beam_chunks(fn, 5, cache=cache))
+            self.assertEqual([len(c) for c in chunks], [5, 5, 2])
+            results = list(segmenter.iter_segment(chunks))
+            self.assertEqual(sum(len(r["range"]) for r in results), 8)
+
+    def test_ingest(self):
+        self.assertIsNone(ingest.parse_line("% comment\r\n"))
+        self.assertIsNone(ingest.parse_line("\r\n"))
+        npt.assert_array_equal(ingest.parse_line("1.0 10 \r\n"), [1.0, 10])
+
+        msgs = list(o2ca2_dataset.O2CA2Dataset(self.filenames))
+        queue = Queue(2)
+        sources = ingest.replay(self.filenames, queue, speed=None)
+        sources.append(ingest.StreamSource("c", queue, StringIO("2.5 1\n6.0 2\n")))
+        for s in sources:
+            s.start()
+        merger = ingest.Merger(queue, ["a", "b", "c"], window=10.0)
+        merged = [(k, row) for k, row, arrival in merger]
+        for s in sources:
+            s.join()
+
+        self.assertEqual([k for k, row in merged if k != "c"], [k for k, d in msgs])
+        npt.assert_array_equal([row[0] for k, row in merged], [1, 2, 2.5, 3, 3, 4, 5, 6])
+        self.assertEqual(merger.metrics.received, 8)
+        self.assertEqual(merger.metrics.late, 0)
+
+        # equal timestamps in the order of keys, whatever the arrival
+        queue = Queue()
+        merger = ingest.Merger(queue, ["a", "b"])
+        for k in ["b", "a", "b", "a"]:
+            queue.put((k, np.array([3.0]), 0.0))
+        queue.put(("a", None, 0.0))
+        queue.put(("b", None, 0.0))
+        self.assertEqual([k for k, row, arrival in merger], ["a", "a", "b", "b"])
+
+        # a late row is released and counted
+        queue = Queue()
+        merger = ingest.Merger(queue, ["a"])
+        for t in [1.0, 3.0]:
+            queue.put(("a", np.array([t]), 0.0))
+        self.assertEqual([row[0] for k, row, arrival in merger.poll(0)], [1.0, 3.0])
+        queue.put(("a", np.array([2.0]), 0.0))
+        queue.put(("a", None, 0.0))
+        self.assertEqual([row[0] for k, row, arrival in merger], [2.0])
+        self.assertEqual(merger.metrics.late, 1)
+
+
+class TrajectoryTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.normal(size=(10, 3))
+        A = rng.normal(size=(10, 3, 3))
+        self.P = np.matmul(A, np.swapaxes(A, 1, 2))
+
+    def test_recorder(self):
+        for mode in ["full", "triu", "diag"]:
+            rec = trajectory.TrajectoryRecorder(3, mode, capacity=3)
+            for i in range(10):
+                rec.append(i, self.x[i], self.P[i])
+            self.assertEqual(len(rec), 10)
+            npt.assert_array_equal(rec.timestamps, np.arange(10))
+            npt.assert_array_equal(rec.states, self.x)
+            npt.assert_array_equal(rec.variances, self.P[:, [0, 1, 2], [0, 1, 2]])
+            if mode != "diag":
+                npt.assert_array_equal(rec.covariances, self.P)
+        npt.assert_array_equal(rec.covariances[4], np.diag(np.diag(self.P[4])))
+
+        for mode in ["full", "triu"]:
+            rec = trajectory.TrajectoryRecorder(3, mode, capacity=3)
+            rec.append(0, self.x[0], self.P[0])
+            rec.extend(np.arange(1, 10), self.x[1:], self.P[1:])
+            npt.assert_array_equal(rec.timestamps, np.arange(10))
+            npt.assert_array_equal(rec.states, self.x)
+            npt.assert_array_equal(rec.covariances, self.P)
+
+        rec = trajectory.TrajectoryRecorder(3, None)
+        rec.append(0, self.x[0])
+        self.assertRaises(ValueError, lambda: rec.covariances)
+        self.assertRaises(ValueError, trajectory.TrajectoryRecorder, 3, "lower")
+
+    def test_query(self):
+        t = np.array([0.0, 1.0, 1.0, 3.0])
+        x = np.array([[0, 0, 3.0], [2, 4, -3.0], [2, 4, -3.0], [6, 0, -2.0]])
+        traj = trajectory.Trajectory(t, x, self.P[:4], angles=(2,))
+        npt.assert_array_equal(traj.index([-1, 0, 0.5, 1, 2, 3, 4]), [-1, 0, 0, 2, 2, 3, 3])
+
+        q, P = traj.query([0.5, 1.0, 2.0, 3.0])
+        npt.assert_almost_equal(q[:, 0:2], [[1, 2], [2, 4], [4, 2], [6, 0]])
+        # across the +-pi discontinuity, not through 0
+        npt.assert_almost_equal(q[0, 2], util.normalize(3.0 + 0.5 * (2 * np.pi - 6)))
+        npt.assert_almost_equal(q[2, 2], -2.5)
+        npt.assert_almost_equal(P[0], 0.5 * (self.P[0] + self.P[1]))
+        npt.assert_almost_equal(P[3], self.P[3])
+
+        q, P = traj.query([-0.1, 3.1])
+        self.assertTrue(np.all(np.isnan(q)) and np.all(np.isnan(P)))
+        self.assertIsNone(traj.query([1.0], covariance=False)[1])
+
+        tw, xw, Pw = traj.window(0.5, 1.0)
+        npt.assert_array_equal(tw, [1.0, 1.0])
+        self.assertEqual(len(Pw), 2)
+        self.assertRaises(ValueError, trajectory.Trajectory, t[::-1], x)
+
+        rec = trajectory.TrajectoryRecorder(3, "triu")
+        rec.extend(np.arange(10), self.x, self.P)
+        q, P = trajectory.Trajectory.from_recorder(rec, angles=()).query([4.5])
+        npt.assert_almost_equal(q[0], 0.5 * (self.x[4] + self.x[5]))
+
+    def test_scan(self):
+        # straight trajectory turning at a constant rate, P grows with t
+        t = np.arange(0, 20.05, 0.1)
+        x = np.zeros((len(t), 8))
+        x[:, 0] = 0.5 * t
+        x[:, 1] = 0.2 * t
+        x[:, 3] = 0.1 * t
+        G = np.diag([0.01, 0.02, 0, 0.001, 0, 0, 0, 0])
+        P = np.eye(8) + t[:, None, None] * G
+        traj = trajectory.Trajectory(t, x, P)
+        mount = np.array([0.33, 0, np.pi])
+
+        # sonar head turning 2pi every 6s, one beam per step
+        bearing = util.normalize(2 * np.pi / 6 * t)
+        ranges = 5 + np.sin(t)
+        world = mops3dof.compose_batch(
+            mops3dof.compose_batch(x[:, [0, 1, 3]], mount)[0],
+            np.c_[ranges * np.cos(bearing), ranges * np.sin(bearing)])[0]
+
+        assembler = scan.ScanAssembler(traj, mount, 0.1, 0.05)
+        scans = []
+        for i in range(0, len(t), 7):
+            scans += assembler.add({"t": t[i:i+7], "bearing": bearing[i:i+7], "range": ranges[i:i+7]})
+        self.assertEqual(len(scans), 3)
+        scans.append(assembler.flush())
+        self.assertIsNone(assembler.flush())
+        self.assertEqual(sum(len(s["points"]) for s in scans), len(t))
+        self.assertEqual(len(scans[0]["points"]), 60)
+
+        for s in scans:
+            k = np.searchsorted(t, s["t_points"][0] - 1e-9)
+            npt.assert_almost_equal(
+                s["points"], mops3dof.compose_batch(
+                    mops3dof.inv_batch(s["pose"])[0], world[k:k + len(s["points"])])[0])
+            self.assertTrue(np.all(np.linalg.eigvalsh(s["cov_points"]) > 0))
+        # the point at the scan time only has the sensor uncertainty
+        s = scans[1]
+        k = np.argmin(np.abs(s["t_points"] - s["t"]))
+        self.assertLess(np.trace(s["cov_points"][k]), np.trace(s["cov_points"][0]))
+
+    def test_scan_outside(self):
+        t = np.arange(0, 10.05, 0.1)
+        x = np.zeros((len(t), 8))
+        x[:, 0] = t
+        traj = trajectory.Trajectory(t, x, np.eye(8) + t[:, None, None] * np.eye(8))
+        mount = np.zeros(3)
+
+        # returns from 2s before the trajectory starts
+        tr = np.arange(-2, 3.05, 0.1)
+        points = np.c_[np.ones(len(tr)), np.zeros(len(tr))]
+        cov = np.tile(np.eye(2) * 0.01, (len(tr), 1, 1))
+        s = scan.assemble(tr, points, cov, traj, mount)
+        self.assertEqual(len(s["points"]), np.count_nonzero(tr >= 0))
+        npt.assert_almost_equal(s["t"], 1.5)
+        npt.assert_almost_equal(s["points"][:, 0], 1 + s["t_points"] - 1.5)
+        self.assertFalse(np.any(np.isnan(s["cov_points"])))
+
+        self.assertIsNone(scan.assemble(tr - 5, points, cov, traj, mount))
+        self.assertIsNone(scan.assemble(tr, points, cov, traj, mount, reference_time=-1.0))
+
+        assembler = scan.ScanAssembler(traj, mount, 0.1, 0.05)
+        tr = np.arange(-20, 3.05, 0.1)
+        bearing = util.normalize(2 * np.pi / 6 * tr)
+        # the 3 complete scans are before the trajectory, the last one
+        # (from -2s) is partly within it
+        self.assertEqual(assembler.add({"t": tr, "bearing": bearing, "range": np.ones(len(tr))}), [])
+        s = assembler.flush()
+        npt.assert_almost_equal(s["t_points"][[0, -1]], [0, 3])
+
+    def test_ring(self):
+        rec = trajectory.TrajectoryRecorder(3, capacity=4, ring=True)
+        for i in range(10):
+            rec.append(i, self.x[i], self.P[i])
+            self.assertEqual(len(rec), min(i + 1, 4))
+        npt.assert_array_equal(rec.timestamps, [6, 7, 8, 9])
+        npt.assert_array_equal(rec.covariances, self.P[6:])
+
+    def test_memmap(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmpdir, "trajectory.bin")
+            rec = trajectory.TrajectoryRecorder(3, "triu", capacity=2, filename=fn)
+            for i in range(10):
+                rec.append(i, self.x[i], self.P[i])
+            rec.flush()
+            self.assertIsInstance(rec.rows(), np.memmap)
+            data = np.fromfile(fn).reshape(-1, 1 + 3 + 6)
+            npt.assert_array_equal(data[:10, 1:4], self.x)
+            npt.assert_array_equal(rec.covariances, self.P)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,283 @@
+import numpy as np
+from util import normalize
+
+""" Storage of filter trajectories: timestamps, states and covariances
+    of each step in one contiguous array, and queries of the state at
+    arbitrary times.
+"""
+
+COVARIANCE_MODES = ("full", "triu", "diag", None)
+
+
+class TrajectoryRecorder(object):
+    def __init__(self, state_size, covariance="full", capacity=1024, ring=False, filename=None):
+        """ Records timestamps, states and covariances as rows of a
+        preallocated array that grows by doubling (or a fixed-size
+        ring buffer that keeps the last entries).
+
+        :param state_size: state size
+        :param covariance: covariance storage, the full matrix, its upper
+            triangle, its diagonal or None to not store it
+        :param capacity: initial number of rows, the size of the ring
+        :param ring: keep only the last capacity entries
+        :param filename: backing file of a memory-mapped array, in
+            memory if None
+        :type state_size: integer > 0
+        :type covariance: one of COVARIANCE_MODES
+        :type capacity: integer > 0
+        :type ring: bool
+        :type filename: string
+        """
+        if covariance not in COVARIANCE_MODES:
+            raise ValueError("Unknown covariance mode %r" % (covariance,))
+        n = state_size
+        self._n = n
+        self._mode = covariance
+        if covariance == "full":
+            self._index = None
+            m = n*n
+        elif covariance == "triu":
+            self._index = np.triu_indices(n)
+            m = len(self._index[0])
+        elif covariance == "diag":
+            self._index = (np.arange(n), np.arange(n))
+            m = n
+        else:
+            self._index = None
+            m = 0
+
+        self._width = 1 + n + m
+        self._ring = ring
+        self._filename = filename
+        self._len = 0
+        self._count = 0
+        self._data = self._allocate(max(int(capacity), 1))
+
+    def _allocate(self, rows, mode="w+"):
+        if self._filename is None:
+            return np.empty((rows, self._width))
+        return np.memmap(self._filename, dtype=float, mode=mode, shape=(rows, self._width))
+
+    def _grow(self):
+        rows = 2*len(self._data)
+        if self._filename is None:
+            data = self._allocate(rows)
+            data[:self._len] = self._data[:self._len]
+        else:
+            # the file is extended in place, no copy
+            self._data.flush()
+            data = self._allocate(rows, "r+")
+        self._data = data
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def mode(self):
+        """Covariance storage mode"""
+        return self._mode
+
+    def append(self, t, x, P=None):
+        """ Records a step.
+
+        :param t: timestamp
+        :param x: state
+        :param P: covariance, ignored if covariances are not stored
+        :type t: float
+        :type x: 1d array
+        :type P: 2d array
+        """
+        if self._ring:
+            i = self._count % len(self._data)
+        else:
+            if self._len == len(self._data):
+                self._grow()
+            i = self._len
+        row = self._data[i]
+        n = self._n
+        row[0] = t
+        row[1:1+n] = x
+        if self._mode == "full":
+            row[1+n:] = np.ravel(P)
+        elif self._mode is not None:
+            row[1+n:] = P[self._index]
+        self._count += 1
+        self._len = min(self._count, len(self._data)) if self._ring else self._count
+
+    def extend(self, t, x, P=None):
+        """ Records several steps at once (see append).
+
+        :type t: 1d array (N)
+        :type x: 2d array (Nxn)
+        :type P: 3d array (Nxnxn)
+        """
+        if self._ring:
+            for i in range(len(t)):
+                self.append(t[i], x[i], None if P is None else P[i])
+            return
+        k = len(t)
+        while self._len + k > len(self._data):
+            self._grow()
+        rows = self._data[self._len:self._len + k]
+        n = self._n
+        rows[:, 0] = t
+        rows[:, 1:1+n] = x
+        if self._mode == "full":
+            rows[:, 1+n:] = np.reshape(P, (k, -1))
+        elif self._mode is not None:
+            rows[:, 1+n:] = np.asarray(P)[:, self._index[0], self._index[1]]
+        self._count += k
+        self._len = self._count
+
+    def rows(self):
+        """ Recorded rows in chronological order, [t, x, packed P].
+        A view unless the ring buffer has wrapped around.
+
+        :rtype: 2d array
+        """
+        if self._ring and self._count > len(self._data):
+            i = self._count % len(self._data)
+            return np.r_[self._data[i:], self._data[:i]]
+        return self._data[:self._len]
+
+    @property
+    def timestamps(self):
+        return self.rows()[:, 0]
+
+    @property
+    def states(self):
+        return self.rows()[:, 1:1+self._n]
+
+    @property
+    def variances(self):
+        """Diagonal of the covariances"""
+        n = self._n
+        packed = self.rows()[:, 1+n:]
+        if self._mode == "full":
+            return packed[:, ::n+1]
+        if self._mode == "triu":
+            return packed[:, self._index[0] == self._index[1]]
+        if self._mode == "diag":
+            return packed
+        raise ValueError("Covariances not recorded")
+
+    @property
+    def covariances(self):
+        """ Covariance matrices, a view in full mode or unpacked
+        (symmetric or diagonal) otherwise.
+
+        :rtype: (N, n, n) array
+        """
+        n = self._n
+        packed = self.rows()[:, 1+n:]
+        if self._mode == "full":
+            return packed.reshape(-1, n, n)
+        if self._mode is None:
+            raise ValueError("Covariances not recorded")
+        P = np.zeros((len(packed), n, n))
+        P[:, self._index[0], self._index[1]] = packed
+        P[:, self._index[1], self._index[0]] = packed
+        return P
+
+    def flush(self):
+        """Writes a memory-mapped recording to its file"""
+        if self._filename is not None:
+            self._data.flush()
+
+
+class Trajectory(object):
+    def __init__(self, timestamps, states, covariances=None, angles=(3,)):
+        """ State (and covariance) queries at arbitrary times of a
+        filter trajectory, e.g. the vehicle pose at each sonar beam.
+        Queries of many times are answered at once: the step before
+        each time is found with a binary search and the states of the
+        step and the following one are interpolated.
+
+        :param timestamps: sorted timestamps of the steps
+        :param states: state of each step
+        :param covariances: covariance of each step, or None
+        :param angles: state elements that are angles (the yaw of an
+            8-state trajectory), interpolated along the shortest arc
+        :type timestamps: 1d array (N)
+        :type states: 2d array (Nxn)
+        :type covariances: 3d array (Nxnxn)
+        :type angles: tuple of integers
+        """
+        self._t = np.asarray(timestamps, dtype=float)
+        if len(self._t) == 0:
+            raise ValueError("Empty trajectory")
+        if np.any(np.diff(self._t) < 0):
+            raise ValueError("Timestamps must be sorted")
+        self._x = np.asarray(states, dtype=float)
+        self._P = None if covariances is None else np.asarray(covariances, dtype=float)
+        self._angles = np.asarray(angles, dtype=np.intp)
+
+    @classmethod
+    def from_recorder(cls, recorder, angles=(3,)):
+        """Trajectory of the steps of a TrajectoryRecorder"""
+        P = None if recorder.mode is None else recorder.covariances
+        return cls(recorder.timestamps, recorder.states, P, angles)
+
+    def __len__(self):
+        return len(self._t)
+
+    @property
+    def timestamps(self):
+        return self._t
+
+    def index(self, t):
+        """ Interval index: the last step at or before each time, -1
+        before the first step.
+
+        :param t: timestamps
+        :type t: float or 1d array
+        :rtype: integer or 1d int array
+        """
+        return np.searchsorted(self._t, t, side="right") - 1
+
+    def window(self, start, end):
+        """ Steps within [start, end], as views.
+
+        :return: timestamps, states and covariances (None if not stored)
+        :rtype: 3-element tuple (1d array, 2d array, 3d array)
+        """
+        i = np.searchsorted(self._t, start, side="left")
+        j = np.searchsorted(self._t, end, side="right")
+        P = None if self._P is None else self._P[i:j]
+        return (self._t[i:j], self._x[i:j], P)
+
+    def query(self, t, covariance=True):
+        """ Interpolated states at each time. Elements are interpolated
+        linearly, angles along the shortest arc and normalized, and the
+        covariances element-wise. Times out of the trajectory get NaN.
+
+        :param t: timestamps, in any order
+        :param covariance: interpolate the covariances too
+        :type t: 1d array (M)
+        :type covariance: bool
+        :return: states and covariances (None if not stored or requested)
+        :rtype: 2-element tuple (Mxn array, Mxnxn array)
+        """
+        t = np.atleast_1d(np.asarray(t, dtype=float))
+        last = len(self._t) - 1
+        i = np.clip(self.index(t), 0, max(last - 1, 0))
+        j = np.minimum(i + 1, last)
+
+        dt = self._t[j] - self._t[i]
+        a = np.zeros(len(t))
+        np.divide(t - self._t[i], dt, out=a, where=dt > 0)
+        outside = (t < self._t[0]) | (t > self._t[last])
+
+        x0 = self._x[i]
+        d = self._x[j] - x0
+        d[:, self._angles] = normalize(d[:, self._angles])
+        x = x0 + a[:, None] * d
+        x[:, self._angles] = normalize(x[:, self._angles])
+        x[outside] = np.nan
+
+        P = None
+        if covariance and self._P is not None:
+            P0 = self._P[i]
+            P = P0 + a[:, None, None] * (self._P[j] - P0)
+            P[outside] = np.nan
+        return (x, P)
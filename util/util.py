@@ -2,12 +2,14 @@ import numpy as np
 
 
 def normalize(angle):
-    """Returns angle (in rads) in (-pi, pi] range ."""
+    """Returns angle (in rads) in (-pi, pi] range. Arrays are
+    normalized element-wise."""
     return angle + (2 * np.pi) * np.floor((np.pi - angle) / (2 * np.pi))
 
 
 def rpy(roll, pitch, yaw):
-    """Returns 3d rotation matrix in rads."""
+    """Returns 3d rotation matrix in rads. Angles can be arrays (they
+    are broadcast) to get a stack of matrices of shape (..., 3, 3)."""
     sr = np.sin(roll)
     cr = np.cos(roll)
     sp = np.sin(pitch)
@@ -15,10 +17,17 @@ def rpy(roll, pitch, yaw):
     sy = np.sin(yaw)
     cy = np.cos(yaw)
 
-    return np.array([
-        [cy*cp, -sy*cr + cy*sp*sr, sy*sr + cy*sp*cr],
-        [sy*cp, cy*cr + sr*sy*sp, -sr*cy + sy*sp*cr],
-        [-sp, cp*sr, cp*cr]])
+    R = np.empty(np.broadcast(sr, sp, sy).shape + (3, 3))
+    R[..., 0, 0] = cy*cp
+    R[..., 0, 1] = -sy*cr + cy*sp*sr
+    R[..., 0, 2] = sy*sr + cy*sp*cr
+    R[..., 1, 0] = sy*cp
+    R[..., 1, 1] = cy*cr + sr*sy*sp
+    R[..., 1, 2] = -sr*cy + sy*sp*cr
+    R[..., 2, 0] = -sp
+    R[..., 2, 1] = cp*sr
+    R[..., 2, 2] = cp*cr
+    return R
 
 
 
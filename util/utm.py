@@ -0,0 +1,72 @@
+import re
+import numpy as np
+
+""" Pure NumPy UTM projection (Krueger series) used when pyproj is
+    not available. It agrees with proj to well below a millimetre
+    inside the zone.
+"""
+
+# semi-major axis (m) and flattening
+ELLIPSOIDS = {
+    "WGS84": (6378137.0, 1/298.257223563),
+    "GRS80": (6378137.0, 1/298.257222101),
+    "NAD83": (6378137.0, 1/298.257222101)
+    }
+
+K0 = 0.9996
+FALSE_EASTING = 500000.0
+FALSE_NORTHING_SOUTH = 10000000.0
+
+
+def zone_number(zone):
+    """Returns the number of a UTM zone such as 31 or '31T'."""
+    match = re.match(r"\s*(\d+)", str(zone))
+    if match is None or not 1 <= int(match.group(1)) <= 60:
+        raise ValueError("Invalid UTM zone %r" % (zone,))
+    return int(match.group(1))
+
+
+def project(lat, lon, zone='31T', datum='WGS84', south=False):
+    """Returns UTM Eastings and Northings of geographic coordinates.
+    The zone letter is ignored (as proj does), use south for the
+    southern hemisphere.
+
+    :param lat: latitude in degrees
+    :param lon: longitude in degrees
+    :param zone: UTM zone
+    :param datum: geodetic datum, one of ELLIPSOIDS
+    :param south: southern hemisphere (false northing of 10000 km)
+    :type lat: float or array
+    :type lon: float or array
+    :return: (x, y) in UTM
+    :rtype: 2-element tuple of floats or arrays
+    """
+    try:
+        a, f = ELLIPSOIDS[datum.upper()]
+    except KeyError:
+        raise ValueError("Unknown datum %r" % (datum,))
+
+    n = f / (2 - f)
+    A = a / (1 + n) * (1 + n**2/4 + n**4/64)
+    alpha = [n/2 - 2*n**2/3 + 5*n**3/16 + 41*n**4/180,
+             13*n**2/48 - 3*n**3/5 + 557*n**4/1440,
+             61*n**3/240 - 103*n**4/140,
+             49561*n**4/161280]
+
+    phi = np.radians(lat)
+    dlon = np.radians(np.asarray(lon) - (6*zone_number(zone) - 183))
+    e = 2*np.sqrt(n) / (1 + n)
+    sin_phi = np.sin(phi)
+    t = np.sinh(np.arctanh(sin_phi) - e*np.arctanh(e*sin_phi))
+    xi = np.arctan2(t, np.cos(dlon))
+    eta = np.arctanh(np.sin(dlon) / np.sqrt(1 + t**2))
+
+    x = eta
+    y = xi
+    for j, aj in enumerate(alpha, 1):
+        x = x + aj*np.cos(2*j*xi)*np.sinh(2*j*eta)
+        y = y + aj*np.sin(2*j*xi)*np.cosh(2*j*eta)
+
+    x = FALSE_EASTING + K0*A*x
+    y = K0*A*y + (FALSE_NORTHING_SOUTH if south else 0.0)
+    return (x, y)